@@ -1,28 +1,110 @@
 #!/usr/bin/env python3
+"""
+Only the stacks selected with the "stacks" context (comma separated, globs allowed) are built, plus the stacks
+they reference. Without it every stack is built:
+
+    cdk deploy lambda -c stacks=lambda       # builds combined-vpc (for the EFS access point) and lambda
+    cdk synth -c stacks='combined-*'
+
+Construct modules are imported by the stack that needs them, so a selective synth doesn't load the rest.
+"""
+import fnmatch
 
 from aws_cdk import core
-from cdk_lambda_vpc.combined_stack import CombinedStack
-from cdk_lambda_vpc.lambda_stack import LambdaStack
-from cdk_lambda_vpc.redis_stack_prod import RedisStack
+from cdk_lambda_vpc import subnet_planner, synth_report
 import config
 
-app = core.App()
 
-RedisStack(app, "redis",
-           env=config.env_dev)
+def uses_hcache_from_combined_vpc():
+    """
+    Whether functions in combined-vpc talk to hcache, over a peering (see LambdaStack.peer_with_hcache): with the
+    topology option on, or when the tiering / eviction workers run
+    """
+    return bool(config.HCACHE_AZ or config.HCACHE_TIERING_INTERVAL_MINUTES or config.HCACHE_EVICTION_INTERVAL_MINUTES)
+
+
+def redis(app, stacks):
+    from cdk_lambda_vpc.redis_stack_prod import RedisStack
+
+    return RedisStack(app, "redis",
+                      vpc_id=config.HCACHE_VPC_ID,
+                      az=config.HCACHE_AZ,
+                      client_cidrs=['10.2.0.0/16'] if uses_hcache_from_combined_vpc() else [],
+                      env=config.env_dev)
+
+
+def combined_vpc(app, stacks):
+    from cdk_lambda_vpc.combined_stack import CombinedStack
+    from cdk_lambda_vpc import efs_profile
+
+    # Property check the subnet planner before any stack uses it (~0.1s, offline)
+    subnet_planner.property_check(cases=200)
+
+    return CombinedStack(app, "combined-vpc",
+                         ec2_whitelist_ips=config.EC2_WHITELIST_IPS,
+                         ec2_key_name=config.EC2_KEY_NAME,
+                         eip_list=config.PREALLOCATED_EIP_LIST,
+                         n_subnets=config.N_SUBNETS,
+                         egress_azs=[config.HCACHE_AZ] if config.HCACHE_AZ else None,
+                         efs_settings=efs_profile.choose(config.EFS_WORKLOAD) if config.EFS_WORKLOAD else None,
+                         env=config.env_dev)
+
+
+def combined_vpc_no_eips(app, stacks):
+    from cdk_lambda_vpc.combined_stack import CombinedStack
 
-CombinedStack(app, "combined-vpc",
-              ec2_whitelist_ips=config.EC2_WHITELIST_IPS,
-              ec2_key_name=config.EC2_KEY_NAME,
-              eip_list=config.PREALLOCATED_EIP_LIST,
-              env=config.env_dev)
+    return CombinedStack(app, "combined-vpc-no-eips",
+                         ec2_whitelist_ips=config.EC2_WHITELIST_IPS,
+                         ec2_key_name=config.EC2_KEY_NAME,
+                         env=config.env_dev)
 
-CombinedStack(app, "combined-vpc-no-eips",
-              ec2_whitelist_ips=config.EC2_WHITELIST_IPS,
-              ec2_key_name=config.EC2_KEY_NAME,
-              env=config.env_dev)
 
-LambdaStack(app, 'lambda', env=config.env_dev)
+def lambda_(app, stacks):
+    from cdk_lambda_vpc.lambda_stack import LambdaStack
+
+    return LambdaStack(app, 'lambda', efs_access_point=stacks['combined-vpc'].lambda_ap,
+                       subnet_plan=stacks['combined-vpc'].subnet_plan,
+                       hcache_az=config.HCACHE_AZ, hcache_vpc_id=config.HCACHE_VPC_ID,
+                       request_metrics_sample_rate=config.REQUEST_METRICS_SAMPLE_RATE,
+                       tiering_interval_minutes=config.HCACHE_TIERING_INTERVAL_MINUTES,
+                       eviction_interval_minutes=config.HCACHE_EVICTION_INTERVAL_MINUTES, env=config.env_dev)
+
+
+# name -> (builder, names of the stacks it references), in build order
+STACKS = {
+    'redis': (redis, []),
+    'combined-vpc': (combined_vpc, []),
+    'combined-vpc-no-eips': (combined_vpc_no_eips, []),
+    'lambda': (lambda_, ['combined-vpc']),
+}
+
+
+def selected_stacks(selector):
+    if not selector:
+        return list(STACKS)
+
+    wanted = set()
+
+    def add(name):
+        if name not in wanted:
+            wanted.add(name)
+            for dependency in STACKS[name][1]:
+                add(dependency)
+
+    for pattern in selector.split(','):
+        matches = fnmatch.filter(STACKS, pattern.strip())
+        if not matches:
+            raise ValueError(f'No stack matches {pattern!r}, stacks are: {", ".join(STACKS)}')
+        for name in matches:
+            add(name)
+    return [name for name in STACKS if name in wanted]
+
+
+app = core.App()
 
-app.synth()
+stacks = {}
+for name in selected_stacks(app.node.try_get_context('stacks')):
+    build, _ = STACKS[name]
+    stacks[name] = build(app, stacks)
 
+synth_report.report(app.synth())
@@ -0,0 +1,130 @@
+"""
+Replay a memory usage series against the hcache autoscaler policy
+
+The cluster is modelled as used bytes spread over shards of node_gb each. The autoscaler is run every
+check_minutes (the schedule) using autoscaler.decide(), and a reshard takes reshard_minutes during which the group
+is 'modifying' and capacity doesn't change yet.
+
+Two runs are compared: reactive (5 minute checks on the current value, as before the 1 minute signals) and
+predictive (1 minute checks with autoscaler.forecast() over the 1 minute series the autoscaler reads).
+
+The series is a CSV of minute,used_gb (one row per minute), or a synthetic trading day with a spike if none is
+given. Reports the actions taken, peak memory and minutes spent over 90% (where Redis starts evicting), and
+shard-hours as the cost side.
+
+    python benchmarks/autoscaler_sim.py --csv memory.csv --shards 2 --max-shards 15
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdk_lambda_vpc', 'lambda'))
+
+from autoscaler import Policy, decide, forecast
+
+# maxmemory of a cache.r5.large
+NODE_GB = 13.07
+
+
+def synthetic_series(minutes=24 * 60, base_gb=8.0, spike_gb=24.0, spike_start=9 * 60, spike_minutes=90,
+                     ramp_minutes=45):
+    """
+    Slow growth over the day with a trading spike that ramps up over ramp_minutes
+    """
+    series = []
+    for minute in range(minutes):
+        used = base_gb * (1 + 0.5 * minute / minutes)
+        if spike_start <= minute < spike_start + spike_minutes:
+            ramp = min(1.0, (minute - spike_start) / ramp_minutes)
+            used += spike_gb * ramp
+        elif spike_start + spike_minutes <= minute < spike_start + spike_minutes + 60:
+            used += spike_gb * (1 - (minute - spike_start - spike_minutes) / 60)
+        series.append(used)
+    return series
+
+
+def load_series(path):
+    with open(path) as f:
+        return [float(row['used_gb']) for row in csv.DictReader(f)]
+
+
+def simulate(series, policy, shards, node_gb=NODE_GB, check_minutes=5, reshard_minutes=15, predictive=False):
+    actions = []
+    history = []
+    last_scaled_at = None
+    pending = None  # (completes at minute, target shards)
+    peak_pct = 0
+    minutes_over_90 = 0
+    shard_minutes = 0
+
+    for minute, used_gb in enumerate(series):
+        if pending is not None and minute >= pending[0]:
+            shards = pending[1]
+            pending = None
+
+        memory_pct = 100 * used_gb / (shards * node_gb)
+        history.append((minute * 60, memory_pct))
+        peak_pct = max(peak_pct, memory_pct)
+        minutes_over_90 += memory_pct > 90
+        shard_minutes += shards
+
+        if minute % check_minutes == 0:
+            status = 'modifying' if pending is not None else 'available'
+            forecast_pct = None
+            if predictive:
+                window = [(t, v) for t, v in history if t > minute * 60 - policy.forecast_window]
+                forecast_pct = forecast(window, policy.forecast_lead)
+            target, reason = decide(policy, shards, memory_pct, minute * 60, last_scaled_at, status, forecast_pct)
+            if target is not None:
+                actions.append({'minute': minute, 'from': shards, 'to': target, 'memory_pct': round(memory_pct, 1),
+                                'reason': reason})
+                last_scaled_at = minute * 60
+                pending = (minute + reshard_minutes, target)
+
+    return {
+        'actions': actions,
+        'peak_memory_pct': round(peak_pct, 1),
+        'minutes_over_90_pct': minutes_over_90,
+        'shard_hours': round(shard_minutes / 60, 1),
+        'final_shards': pending[1] if pending else shards,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--csv', help='minute,used_gb series, synthetic if not given')
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--node-gb', type=float, default=NODE_GB)
+    parser.add_argument('--min-shards', type=int, default=1)
+    parser.add_argument('--max-shards', type=int, default=15)
+    parser.add_argument('--scale-up-threshold', type=float, default=70)
+    parser.add_argument('--scale-down-threshold', type=float, default=10)
+    parser.add_argument('--target', type=float, default=50)
+    parser.add_argument('--cooldown-up-minutes', type=float, default=10)
+    parser.add_argument('--cooldown-down-minutes', type=float, default=60)
+    parser.add_argument('--forecast-window-minutes', type=float, default=10)
+    parser.add_argument('--forecast-lead-minutes', type=float, default=15)
+    parser.add_argument('--reshard-minutes', type=int, default=15)
+    args = parser.parse_args()
+
+    policy = Policy(min_shards=args.min_shards, max_shards=args.max_shards,
+                    scale_up_threshold=args.scale_up_threshold, scale_down_threshold=args.scale_down_threshold,
+                    target=args.target, cooldown_up=args.cooldown_up_minutes * 60,
+                    cooldown_down=args.cooldown_down_minutes * 60,
+                    forecast_window=args.forecast_window_minutes * 60, forecast_lead=args.forecast_lead_minutes * 60)
+    series = load_series(args.csv) if args.csv else synthetic_series()
+
+    print(json.dumps({
+        'reactive': simulate(series, policy, args.shards, node_gb=args.node_gb, check_minutes=5,
+                             reshard_minutes=args.reshard_minutes),
+        'predictive': simulate(series, policy, args.shards, node_gb=args.node_gb, check_minutes=1,
+                               reshard_minutes=args.reshard_minutes, predictive=True),
+        'fixed_shards_for_peak': math.ceil(max(series) / (args.node_gb * args.scale_up_threshold / 100)),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
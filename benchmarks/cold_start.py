@@ -0,0 +1,121 @@
+"""
+Measure cold start of the cdk_lambda_vpc/lambda asset locally
+
+Each run starts a fresh interpreter (a new "container"), imports the handler module, then invokes it twice against a
+local HTTP server, reporting import time, first (cold) and second (warm) invoke latency. The slowest imports
+(python -X importtime) and the asset size are reported alongside, as the things to chase when init time grows.
+
+    python benchmarks/cold_start.py --runs 10 --handler hello
+"""
+import argparse
+import http.server
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+
+ASSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdk_lambda_vpc', 'lambda')
+
+CONTAINER = '''
+import json, sys, time
+sys.path.insert(0, {asset_dir!r})
+t0 = time.perf_counter()
+import {handler} as module
+t1 = time.perf_counter()
+event = {{"urls": [{url!r}] * 5}}
+module.handler(event, None)
+t2 = time.perf_counter()
+module.handler(event, None)
+t3 = time.perf_counter()
+print("RESULT " + json.dumps({{"import_ms": (t1 - t0) * 1000, "first_invoke_ms": (t2 - t1) * 1000,
+                              "warm_invoke_ms": (t3 - t2) * 1000}}))
+'''
+
+
+class Target(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({'ip': '127.0.0.1'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def asset_size(path):
+    total, files = 0, 0
+    for root, _, names in os.walk(path):
+        if '__pycache__' in root:
+            continue
+        for name in names:
+            total += os.path.getsize(os.path.join(root, name))
+            files += 1
+    return total, files
+
+
+def run_container(handler, url):
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1', EGRESS_IP_URL=url)
+    code = CONTAINER.format(asset_dir=os.path.abspath(ASSET_DIR), handler=handler, url=url)
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env, check=True).stdout
+    return json.loads([line for line in out.splitlines() if line.startswith('RESULT ')][-1][len('RESULT '):])
+
+
+def slowest_imports(handler, top):
+    code = f'import sys; sys.path.insert(0, {os.path.abspath(ASSET_DIR)!r}); import {handler}'
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = [p.strip() for p in line[len('import time:'):].split('|')]
+        rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def summarise(values):
+    values = sorted(values)
+    return {
+        'min': round(values[0], 3),
+        'median': round(statistics.median(values), 3),
+        'max': round(values[-1], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--handler', default='hello')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imports to show')
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Target)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/json'
+
+    runs = [run_container(args.handler, url) for _ in range(args.runs)]
+    size, files = asset_size(ASSET_DIR)
+
+    print(json.dumps({
+        'handler': args.handler,
+        'runs': args.runs,
+        'asset_bytes': size,
+        'asset_files': files,
+        'import_ms': summarise([r['import_ms'] for r in runs]),
+        'first_invoke_ms': summarise([r['first_invoke_ms'] for r in runs]),
+        'warm_invoke_ms': summarise([r['warm_invoke_ms'] for r in runs]),
+        'slowest_imports_us': [{'module': name, 'cumulative_us': us} for us, name in slowest_imports(args.handler,
+                                                                                                    args.top)],
+    }, indent=2))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+I/O patterns of the EFS share, run against any directory: the mount on a box or in a Lambda, or a local directory
+
+    seq_read          one --file-mib file read front to back in --block-kib blocks
+    random_read       --random-reads blocks read at random offsets of the same file
+    small_files       --small-files files of --small-file-kib created, stat'ed, read back, listed and removed -
+                      metadata operations, where NFS round trips dominate
+    parallel_writers  --writers processes each writing and fsync'ing their own --file-mib file at once
+
+Reads go through the page cache unless it can be dropped: each file is written, fsync'ed and then evicted with
+posix_fadvise(DONTNEED), which on NFS/EFS drops the client's cached pages. Everything is created under a temporary
+directory in --path and removed afterwards. Compare runs on file systems in different modes (efs_profile) to pick
+the settings:
+
+    python benchmarks/efs_io.py --path /mnt/efs/bench --file-mib 256 --writers 8
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+MIB = 1024 * 1024
+
+
+def write_file(path, size, block):
+    data = os.urandom(block)
+    start = time.perf_counter()
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            f.write(data[:min(block, size - written)])
+            written += block
+        f.flush()
+        os.fsync(f.fileno())
+    return time.perf_counter() - start
+
+
+def evict(path):
+    """
+    Drop the file's cached pages, where the platform allows it
+    """
+    if hasattr(os, 'posix_fadvise'):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def latency_ms(values):
+    values = sorted(v * 1000 for v in values)
+    return {
+        'p50': round(statistics.median(values), 3),
+        'p99': round(values[min(len(values) - 1, int(len(values) * 0.99))], 3),
+        'max': round(values[-1], 3),
+    }
+
+
+def seq_read(path, block):
+    evict(path)
+    size = 0
+    start = time.perf_counter()
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            chunk = f.read(block)
+            if not chunk:
+                break
+            size += len(chunk)
+    elapsed = time.perf_counter() - start
+    return {'mib': round(size / MIB, 3), 'seconds': round(elapsed, 3), 'mib_per_second': round(size / MIB / elapsed, 3)}
+
+
+def random_read(path, block, reads, seed=0):
+    evict(path)
+    rng = random.Random(seed)
+    blocks = max(1, os.path.getsize(path) // block)
+    times = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        start = time.perf_counter()
+        for _ in range(reads):
+            offset = rng.randrange(blocks) * block
+            t = time.perf_counter()
+            os.pread(fd, block, offset)
+            times.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+    finally:
+        os.close(fd)
+    return {'reads': reads, 'block_kib': block // 1024, 'iops': round(reads / elapsed, 3),
+            'latency_ms': latency_ms(times)}
+
+
+def small_files(directory, count, size, per_directory=100):
+    data = os.urandom(size)
+    paths = [os.path.join(directory, f'd{n // per_directory:04d}', f'f{n:06d}') for n in range(count)]
+    phases = {}
+
+    def timed(name, fn):
+        times = []
+        start = time.perf_counter()
+        for path in paths:
+            t = time.perf_counter()
+            fn(path)
+            times.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - start
+        phases[name] = {'ops_per_second': round(len(paths) / elapsed, 3), 'latency_ms': latency_ms(times)}
+
+    def create(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read(path):
+        with open(path, 'rb') as f:
+            f.read()
+
+    timed('create', create)
+    timed('stat', os.stat)
+    timed('read', read)
+
+    start = time.perf_counter()
+    listed = sum(len(os.listdir(os.path.join(directory, d))) for d in os.listdir(directory))
+    phases['list'] = {'files': listed, 'ms': round((time.perf_counter() - start) * 1000, 3)}
+
+    timed('unlink', os.unlink)
+    return {'files': count, 'file_kib': size / 1024, 'phases': phases}
+
+
+def writer(args):
+    path, size, block = args
+    try:
+        return write_file(path, size, block)
+    finally:
+        os.unlink(path)
+
+
+def parallel_writers(directory, writers, size, block):
+    jobs = [(os.path.join(directory, f'writer-{n}'), size, block) for n in range(writers)]
+    with multiprocessing.Pool(writers) as pool:
+        start = time.perf_counter()
+        seconds = pool.map(writer, jobs)
+        elapsed = time.perf_counter() - start
+    return {
+        'writers': writers,
+        'mib_each': size / MIB,
+        'mib_per_second': round(writers * size / MIB / elapsed, 3),
+        'per_writer_mib_per_second': {'min': round(size / MIB / max(seconds), 3),
+                                      'max': round(size / MIB / min(seconds), 3)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default=tempfile.gettempdir(), help='directory to run in, e.g. the EFS mount')
+    parser.add_argument('--patterns', default='seq_read,random_read,small_files,parallel_writers')
+    parser.add_argument('--file-mib', type=int, default=64)
+    parser.add_argument('--block-kib', type=int, default=1024, help='block size of the sequential reads and writes')
+    parser.add_argument('--random-block-kib', type=int, default=4)
+    parser.add_argument('--random-reads', type=int, default=2000)
+    parser.add_argument('--small-files', type=int, default=1000)
+    parser.add_argument('--small-file-kib', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=4)
+    args = parser.parse_args()
+
+    patterns = args.patterns.split(',')
+    directory = tempfile.mkdtemp(prefix='efs-io-', dir=args.path)
+    results = {}
+    try:
+        data_file = os.path.join(directory, 'data')
+        if 'seq_read' in patterns or 'random_read' in patterns:
+            seconds = write_file(data_file, args.file_mib * MIB, args.block_kib * 1024)
+            results['seq_write'] = {'mib': args.file_mib, 'mib_per_second': round(args.file_mib / seconds, 3)}
+        if 'seq_read' in patterns:
+            results['seq_read'] = seq_read(data_file, args.block_kib * 1024)
+        if 'random_read' in patterns:
+            results['random_read'] = random_read(data_file, args.random_block_kib * 1024, args.random_reads)
+        if 'small_files' in patterns:
+            small = os.path.join(directory, 'small')
+            os.mkdir(small)
+            results['small_files'] = small_files(small, args.small_files, args.small_file_kib * 1024)
+        if 'parallel_writers' in patterns:
+            results['parallel_writers'] = parallel_writers(directory, args.writers, args.file_mib * MIB,
+                                                           args.block_kib * 1024)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(json.dumps({'path': args.path, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
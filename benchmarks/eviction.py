@@ -0,0 +1,231 @@
+"""
+Run the eviction worker (hcache.eviction) against the Redis stand-in, with its settings served by the SSM stub
+
+--minutes of data are written on a fake clock, the way the writers leave it without the worker:
+
+    trades     a key per trade written through BatchWriter without a TTL (half the symbols), and time buckets
+               (hcache.buckets) with the evict_trades_after_minutes in force when they were written (the others)
+    books      --books order books (hcache.orderbook) written with an hour's retention, one of which stops
+               getting updates half way through
+
+A worker per node runs every --interval-minutes, each run limited to --time-budget seconds of real time. At
+--change-at-minutes the SSM parameters are changed to --trades-minutes / --orderbooks-minutes, which the workers pick
+up through hcache.config once its cache expires, with nothing redeployed. After the last write the workers run
+until each has done a full pass with the clock stopped, then everything left is checked against the retention in
+force: no trade older than it (with a TTL no longer than what it has left), no book log entries before the
+snapshot they'd build on and the stopped book gone. Reported per run: the settings the workers used, bytes
+reclaimed, keys unlinked, entries trimmed, TTLs set, the commands and round trips it cost and the slowest shard's
+time; and memory used at the end against the same writes with no worker.
+
+    python benchmarks/eviction.py --nodes 3 --minutes 60 --change-at-minutes 40 --trades-minutes 10
+"""
+import argparse
+import json
+import random
+import time
+
+from redis_standin import StandinRedis, Stats
+from ssm_stub import PARAMETERS, SsmStub, stub_client
+
+from hcache.buckets import BUCKET_SECONDS, TradeBuckets, parse_bucket_key
+from hcache.codec import default_codec
+from hcache.config import ParameterCache
+from hcache.eviction import ORDERBOOKS_SETTING, TRADES_SETTING, EvictionWorker, key_kind
+from hcache.orderbook import OrderBookStore, log_key, snaps_key
+from hcache.writer import BatchWriter
+
+FEED = 'COINBASE'
+SYMBOLS = ['BTC-USD', 'ETH-USD', 'SOL-USD', 'ADA-USD', 'DOGE-USD', 'LTC-USD', 'XRP-USD', 'DOT-USD']
+START = 1622541600.0
+BOOK_RETENTION_SECONDS = 60 * 60
+
+
+class FakeClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Workload:
+    """
+    Writes one second of trades and book updates at a time
+    """
+
+    def __init__(self, redis, clock, trades_per_second, n_books, minutes, seed=1):
+        self.rng = random.Random(seed)
+        self.clock = clock
+        self.trades_per_second = trades_per_second
+        self.per_trade = SYMBOLS[:len(SYMBOLS) // 2]
+        self.bucketed = SYMBOLS[len(SYMBOLS) // 2:]
+        self.writer = BatchWriter(redis, clock=clock)
+        self.buckets = TradeBuckets(redis, clock=clock)
+        self.books = OrderBookStore(redis, retention=BOOK_RETENTION_SECONDS)
+        self.book_symbols = SYMBOLS[:n_books]
+        self.book_state = {symbol: {'bid': {}, 'ask': {}} for symbol in self.book_symbols}
+        # The last book stops updating half way through
+        self.stopped_at = START + minutes * 30
+        self.next_id = 0
+
+    def second(self, ts, trades_minutes):
+        rng = self.rng
+        self.buckets.retention = trades_minutes * 60
+        bucket_trades = []
+        for _ in range(self.trades_per_second):
+            symbol = rng.choice(SYMBOLS)
+            trade = {'id': self.next_id, 'feed': FEED, 'symbol': symbol, 'side': rng.choice(['buy', 'sell']),
+                     'amount': round(rng.expovariate(2), 8), 'price': round(30000 + rng.random() * 1000, 2),
+                     'timestamp': ts + rng.random()}
+            self.next_id += 1
+            if symbol in self.per_trade:
+                self.writer.write_trade(FEED, symbol, trade)
+            else:
+                bucket_trades.append((FEED, symbol, trade))
+        self.writer.flush()
+        self.buckets.write(bucket_trades)
+
+        for n, symbol in enumerate(self.book_symbols):
+            if n == len(self.book_symbols) - 1 and ts >= self.stopped_at:
+                continue
+            book = self.book_state[symbol]
+            for _ in range(5):
+                side = rng.choice(['bid', 'ask'])
+                price = round(30000 + rng.randrange(-50, 50) * 0.5, 2)
+                book[side][price] = 0 if rng.random() < 0.2 else round(rng.random() * 3, 4)
+                if not book[side][price]:
+                    del book[side][price]
+            self.books.update(FEED, symbol, book, ts + rng.random())
+
+
+def simulate(args, evict):
+    clock = FakeClock(START)
+    redis = StandinRedis(n_nodes=args.nodes, clock=clock)
+    stub = SsmStub(PARAMETERS).start()
+    settings = ParameterCache(client=stub_client(stub), clock=clock, background=False)
+    workers = [EvictionWorker(redis.node(n), shard=n, settings=settings, scan_count=args.scan_count, clock=clock)
+               for n in range(args.nodes)]
+    workload = Workload(redis, clock, args.trades_per_second, args.books, args.minutes)
+
+    def run_workers(minute):
+        redis.stats = Stats()
+        runs = []
+        for worker in workers:
+            began = time.perf_counter()
+            stats = worker.run(time_budget=args.time_budget)
+            stats['ms'] = (time.perf_counter() - began) * 1000
+            runs.append(stats)
+        return {
+            'minute': minute,
+            'trades_minutes': runs[0]['evict_trades_after_minutes'],
+            'orderbooks_minutes': runs[0]['evict_orderbooks_after_minutes'],
+            'bytes_reclaimed': sum(s['bytes_reclaimed'] for s in runs),
+            'unlinked': sum(s['unlinked'] for s in runs),
+            'trimmed': sum(s['trimmed'] for s in runs),
+            'expiry_set': sum(s['expiry_set'] for s in runs),
+            'scanned': sum(s['scanned'] for s in runs),
+            'passes_complete': sum(s['pass_complete'] for s in runs),
+            'commands': redis.stats.commands,
+            'round_trips': redis.stats.round_trips,
+            'max_shard_ms': round(max(s['ms'] for s in runs), 3),
+        }
+
+    runs = []
+    trades_minutes = int(PARAMETERS['/hcache/' + TRADES_SETTING])
+    for second in range(args.minutes * 60):
+        clock.now = START + second
+        if second == args.change_at_minutes * 60:
+            stub.parameters['/hcache/' + TRADES_SETTING] = str(args.trades_minutes)
+            stub.parameters['/hcache/' + ORDERBOOKS_SETTING] = str(args.orderbooks_minutes)
+            # The writers follow the setting from here on, as they would with a fresh container
+            trades_minutes = args.trades_minutes
+        workload.second(clock.now, trades_minutes)
+        if evict and second and second % (args.interval_minutes * 60) == 0:
+            runs.append(run_workers(second // 60))
+
+    clock.now = START + args.minutes * 60
+    if evict:
+        # Two passes, so each shard has done one from start to end since the last write
+        target = [worker.passes + 2 for worker in workers]
+        while any(worker.passes < t for worker, t in zip(workers, target)):
+            runs.append(run_workers(args.minutes))
+    stub.shutdown()
+    return redis, workload, runs
+
+
+def check(redis, workload, args):
+    """
+    Everything left against the retention in force at the end, returns what was found
+    """
+    now_ms = int(START * 1000) + args.minutes * 60000
+    trades_cutoff = now_ms - args.trades_minutes * 60000
+    books_cutoff = now_ms - args.orderbooks_minutes * 60000
+    found = {'trades': 0, 'buckets': 0, 'books': 0}
+    for key in list(redis.data):
+        kind = key_kind(key)
+        if kind == 'trade':
+            ts_ms = int(default_codec.decode(redis.data[key])['timestamp'] * 1000)
+            if ts_ms < trades_cutoff:
+                raise AssertionError(f'{key!r} is older than retention')
+            left = redis.pttl(key)
+            if left == -1 or left > ts_ms + args.trades_minutes * 60000 - now_ms:
+                raise AssertionError(f'{key!r} has a TTL past retention: {left}')
+            found['trades'] += 1
+        elif kind == 'bucket':
+            bucket = parse_bucket_key(key)[2]
+            if min(redis.data[key].values()) < trades_cutoff:
+                raise AssertionError(f'{key!r} holds trades older than retention')
+            if redis.pttl(key) > (bucket + BUCKET_SECONDS) * 1000 + args.trades_minutes * 60000 - now_ms:
+                raise AssertionError(f'{key!r} has a TTL past retention')
+            found['buckets'] += 1
+
+    for n, symbol in enumerate(workload.book_symbols):
+        log = redis.data.get(log_key(FEED, symbol).encode())
+        if n == len(workload.book_symbols) - 1:
+            if log is not None or redis.data.get(snaps_key(FEED, symbol).encode()) is not None:
+                raise AssertionError(f'{symbol} stopped updating and is still there')
+            continue
+        kept = redis.zrevrangebyscore(snaps_key(FEED, symbol), books_cutoff, '-inf', start=0, num=1)
+        if redis.zcount(snaps_key(FEED, symbol), '-inf', f'({books_cutoff}') != 1:
+            raise AssertionError(f'{symbol} keeps snapshots before the one at the cut off')
+        if log[0][0] < tuple(int(x) for x in kept[0].decode().split('-')):
+            raise AssertionError(f'{symbol} keeps log entries before the snapshot at the cut off')
+        if workload.books.book_at(FEED, symbol, books_cutoff / 1000) is None:
+            raise AssertionError(f'{symbol} can no longer be rebuilt at the cut off')
+        found['books'] += 1
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--minutes', type=int, default=60)
+    parser.add_argument('--trades-per-second', type=int, default=20)
+    parser.add_argument('--books', type=int, default=4)
+    parser.add_argument('--interval-minutes', type=int, default=1)
+    parser.add_argument('--scan-count', type=int, default=100)
+    parser.add_argument('--time-budget', type=float, default=0.05, help='seconds per shard per run')
+    parser.add_argument('--change-at-minutes', type=int, default=40)
+    parser.add_argument('--trades-minutes', type=int, default=10, help='evict_trades_after_minutes from then on')
+    parser.add_argument('--orderbooks-minutes', type=int, default=2,
+                        help='evict_orderbooks_after_minutes from then on')
+    args = parser.parse_args()
+
+    baseline, _, _ = simulate(args, evict=False)
+    redis, workload, runs = simulate(args, evict=True)
+    found = check(redis, workload, args)
+
+    print(json.dumps({
+        'trades': workload.next_id,
+        'memory_used': {'without_worker': baseline.memory_used(), 'with_worker': redis.memory_used()},
+        'bytes_reclaimed': sum(run['bytes_reclaimed'] for run in runs),
+        'max_commands_per_run': max(run['commands'] for run in runs),
+        'max_shard_ms': max(run['max_shard_ms'] for run in runs),
+        'left': found,
+        'runs': runs,
+    }, indent=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+What logging the event costs the hello handler per invocation, before and after structured_log
+
+The old handler printed the whole event with print(json.dumps(event)) on every call. The new one buffers
+log.info('request', ...) and writes it out with log.flush() at the end of the invocation, sampled and cut down to
+LOG_MAX_BYTES. Both are timed over dispatcher style batch events of growing size, written to /dev/null, and the bytes
+that would be ingested by CloudWatch Logs per invocation are reported alongside.
+
+    python benchmarks/handler_logging.py --batch-sizes 10,100,1000,10000 --sample-rates 1,0.1,0.01
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdk_lambda_vpc', 'lambda'))
+
+from structured_log import Logger, MAX_BYTES
+
+
+class CountingSink:
+    """
+    /dev/null that counts the bytes written to it
+    """
+
+    def __init__(self):
+        self.devnull = open(os.devnull, 'w')
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text)
+        return self.devnull.write(text)
+
+    def flush(self):
+        self.devnull.flush()
+
+
+def batch_event(size):
+    return {'requests': [{'url': f'https://api.example.com/v1/trades?symbol=SYM{n}&limit=1000', 'method': 'GET',
+                          'headers': {'Accept': 'application/json'}} for n in range(size)]}
+
+
+def print_event(event, sink):
+    # What hello.handle did before
+    print('request: {}'.format(json.dumps(event)), file=sink)
+
+
+def structured_event(logger):
+    def log_event(event, sink):
+        batch = event.get('requests') or event.get('urls')
+        logger.info('request', batch_size=len(batch) if batch else 0, event=event)
+        logger.flush()
+    return log_event
+
+
+def measure(log_event, event, invocations):
+    sink = CountingSink()
+    start = time.perf_counter()
+    for _ in range(invocations):
+        log_event(event, sink)
+    elapsed = time.perf_counter() - start
+    return {
+        'us_per_invocation': round(elapsed / invocations * 1e6, 3),
+        'bytes_per_invocation': round(sink.bytes / invocations, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-sizes', default='10,100,1000,10000')
+    parser.add_argument('--sample-rates', default='1,0.1,0.01')
+    parser.add_argument('--max-bytes', type=int, default=MAX_BYTES)
+    parser.add_argument('--invocations', type=int, default=200)
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in args.batch_sizes.split(',')]:
+        event = batch_event(size)
+        # Fewer rounds for the big events, the old way takes a while on those
+        invocations = max(10, args.invocations * 100 // max(size, 100))
+        row = {'batch_size': size, 'invocations': invocations, 'print': measure(print_event, event, invocations)}
+        for rate in [float(r) for r in args.sample_rates.split(',')]:
+            sink = CountingSink()
+            logger = Logger(sample_rate=rate, max_per_second=0, max_bytes=args.max_bytes, out=sink)
+            result = measure(structured_event(logger), event, invocations)
+            # The logger writes to its own sink
+            result['bytes_per_invocation'] = round(sink.bytes / invocations, 1)
+            row[f'structured_log@{rate:g}'] = result
+        results.append(row)
+
+    print(json.dumps({'max_bytes': args.max_bytes, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
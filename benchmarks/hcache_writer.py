@@ -0,0 +1,106 @@
+"""
+Compare hcache write strategies against the Redis stand-in
+
+    baseline    one SET per message, JSON encoded
+    msgpack     BatchWriter, msgpack only
+    msgpack+lz4 BatchWriter, msgpack with lz4 for larger records
+
+Reports round trips, commands, bytes on the wire and stored value bytes per record.
+
+    python benchmarks/hcache_writer.py --trades 20000 --books 2000
+"""
+import argparse
+import json
+import random
+import time
+
+from redis_standin import StandinRedis
+
+from hcache.codec import Codec
+from hcache.writer import BatchWriter, book_key, trade_key
+
+FEED = 'COINBASE'
+SYMBOLS = ['BTC-USD', 'ETH-USD', 'SOL-USD', 'ADA-USD', 'DOGE-USD', 'LTC-USD', 'XRP-USD', 'DOT-USD']
+
+
+def generate(n_trades, n_books, depth, seed=1):
+    rng = random.Random(seed)
+    messages = []
+    ts = 1600000000.0
+    for i in range(n_trades):
+        ts += rng.random() / 100
+        symbol = rng.choice(SYMBOLS)
+        messages.append(('trade', symbol, {
+            'id': i, 'feed': FEED, 'symbol': symbol, 'side': rng.choice(['buy', 'sell']),
+            'amount': round(rng.random() * 5, 8), 'price': round(30000 + rng.random() * 1000, 2), 'timestamp': ts
+        }))
+    for _ in range(n_books):
+        symbol = rng.choice(SYMBOLS)
+        mid = 30000 + rng.random() * 1000
+        messages.append(('book', symbol, {
+            'bid': [[round(mid - i * 0.5, 2), round(rng.random() * 3, 8)] for i in range(depth)],
+            'ask': [[round(mid + i * 0.5, 2), round(rng.random() * 3, 8)] for i in range(depth)],
+            'timestamp': ts
+        }))
+    rng.shuffle(messages)
+    return messages
+
+
+def run_baseline(messages, ttl_ms):
+    redis = StandinRedis()
+    start = time.perf_counter()
+    for kind, symbol, record in messages:
+        key = trade_key(FEED, symbol, record['id']) if kind == 'trade' else book_key(FEED, symbol)
+        redis.set(key, json.dumps(record), px=ttl_ms)
+    elapsed = time.perf_counter() - start
+    return redis, elapsed
+
+
+def run_writer(messages, ttl_ms, codec):
+    redis = StandinRedis()
+    writer = BatchWriter(redis, codec=codec, ttl_ms=ttl_ms)
+    start = time.perf_counter()
+    for kind, symbol, record in messages:
+        if kind == 'trade':
+            writer.write_trade(FEED, symbol, record)
+        else:
+            writer.write_book(FEED, symbol, record)
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    return redis, elapsed
+
+
+def report(name, redis, elapsed, n):
+    stats = redis.stats.as_dict()
+    return {
+        'strategy': name,
+        'round_trips': stats['round_trips'],
+        'commands': stats['commands'],
+        'wire_bytes_per_record': round(stats['bytes_sent'] / n, 1),
+        'stored_bytes': redis.memory_used(),
+        'client_us_per_record': round(elapsed / n * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trades', type=int, default=20000)
+    parser.add_argument('--books', type=int, default=2000)
+    parser.add_argument('--depth', type=int, default=50, help='price levels per side of each order book')
+    parser.add_argument('--ttl-minutes', type=int, default=30)
+    args = parser.parse_args()
+
+    messages = generate(args.trades, args.books, args.depth)
+    ttl_ms = args.ttl_minutes * 60 * 1000
+    n = len(messages)
+
+    rows = [
+        report('baseline', *run_baseline(messages, ttl_ms), n),
+        report('msgpack', *run_writer(messages, ttl_ms, Codec(compress=False)), n),
+        report('msgpack+lz4', *run_writer(messages, ttl_ms, Codec()), n),
+    ]
+    print(json.dumps(rows, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Trade key layouts on the Redis stand-in: a key per trade (hcache.writer) against time buckets (hcache.buckets)
+
+--minutes of trades at --trades-per-second across the symbols are written both ways, then read back with:
+
+    last_1m / last_5m / last_15m   one symbol's trades for the last N minutes
+    all_symbols_5m                 every symbol's trades for the last 5 minutes
+
+With a key per trade there is nothing to find a time range by, so a read SCANs every node for the symbol's keys
+(MATCH trades:{feed:symbol}:*), GETs them in a pipeline and filters on the timestamp. With buckets it is a
+ZRANGEBYSCORE per bucket in range, in one pipeline. Both have to return the same trades. Each read is run for every
+cluster size in --nodes, as shards are added the scan has more nodes to visit while a bucket read still only goes
+to the nodes holding its buckets. Reported per read: round trips (one per node a pipeline touches), commands,
+bytes sent and client time, and for the writes the same plus the memory held.
+
+    python benchmarks/key_layout.py --nodes 2,4,8 --trades-per-second 50 --minutes 30
+"""
+import argparse
+import json
+import random
+import time
+
+from redis_standin import StandinRedis, Stats
+
+from hcache.buckets import TradeBuckets
+from hcache.codec import default_codec
+from hcache.writer import BatchWriter
+
+FEED = 'COINBASE'
+SYMBOLS = ['BTC-USD', 'ETH-USD', 'SOL-USD', 'ADA-USD', 'DOGE-USD', 'LTC-USD', 'XRP-USD', 'DOT-USD']
+START = 1622541600.0
+SCAN_COUNT = 1000
+
+
+class FakeClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def generate(trades_per_second, minutes, seed=1):
+    rng = random.Random(seed)
+    trades = []
+    for second in range(minutes * 60):
+        for _ in range(trades_per_second):
+            trades.append({'id': len(trades), 'feed': FEED, 'symbol': rng.choice(SYMBOLS),
+                           'side': rng.choice(['buy', 'sell']), 'amount': round(rng.expovariate(2), 8),
+                           'price': round(30000 + rng.random() * 1000, 2), 'timestamp': START + second + rng.random()})
+    return trades
+
+
+def write_per_trade(redis, clock, trades, ttl_ms):
+    writer = BatchWriter(redis, ttl_ms=ttl_ms, clock=clock)
+    for trade in trades:
+        clock.now = trade['timestamp']
+        writer.write_trade(FEED, trade['symbol'], trade)
+        writer.flush_if_due()
+    writer.flush()
+
+
+def write_buckets(redis, clock, trades, ttl_ms):
+    buckets = TradeBuckets(redis, retention=ttl_ms / 1000, clock=clock)
+    second, batch = None, []
+    for trade in trades:
+        if int(trade['timestamp']) != second and batch:
+            buckets.write((FEED, t['symbol'], t) for t in batch)
+            batch = []
+        second = int(trade['timestamp'])
+        clock.now = trade['timestamp']
+        batch.append(trade)
+    buckets.write((FEED, t['symbol'], t) for t in batch)
+    return buckets
+
+
+def read_per_trade(redis, symbols, start, end):
+    """
+    {symbol: trades} the only way the per trade layout allows: SCAN for the keys, then GET them all
+    """
+    found = {}
+    for symbol in symbols:
+        keys = list(redis.scan_iter(match=f'trades:{{{FEED}:{symbol}}}:*', count=SCAN_COUNT))
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        trades = [default_codec.decode(v) for v in pipe.execute() if v is not None]
+        found[symbol] = sorted((t for t in trades if start <= t['timestamp'] < end), key=lambda t: t['timestamp'])
+    return found
+
+
+def read_buckets(buckets, symbols, start, end):
+    trades = buckets.ranges([(FEED, symbol) for symbol in symbols], start, end)
+    return {symbol: sorted(trades[(FEED, symbol)], key=lambda t: t['timestamp']) for symbol in symbols}
+
+
+def measure(redis, read):
+    redis.stats = Stats()
+    began = time.perf_counter()
+    result = read()
+    elapsed = time.perf_counter() - began
+    stats = redis.stats.as_dict()
+    stats['client_ms'] = round(elapsed * 1000, 3)
+    stats['trades'] = sum(len(t) for t in result.values())
+    return stats, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', default='2,4,8', help='cluster sizes (shards) to run on')
+    parser.add_argument('--trades-per-second', type=int, default=50)
+    parser.add_argument('--minutes', type=int, default=30)
+    parser.add_argument('--ttl-minutes', type=int, default=30)
+    args = parser.parse_args()
+
+    trades = generate(args.trades_per_second, args.minutes)
+    ttl_ms = args.ttl_minutes * 60 * 1000
+    now = START + args.minutes * 60
+    reads = {
+        'last_1m': ([SYMBOLS[0]], 60),
+        'last_5m': ([SYMBOLS[0]], 300),
+        'last_15m': ([SYMBOLS[0]], 900),
+        'all_symbols_5m': (SYMBOLS, 300),
+    }
+
+    results = []
+    for n_nodes in [int(n) for n in args.nodes.split(',')]:
+        row = {'nodes': n_nodes, 'write': {}, 'reads': {}}
+        layouts = {}
+        for layout, write in (('per_trade', write_per_trade), ('buckets', write_buckets)):
+            clock = FakeClock(START)
+            redis = StandinRedis(n_nodes=n_nodes, clock=clock)
+            began = time.perf_counter()
+            buckets = write(redis, clock, trades, ttl_ms)
+            elapsed = time.perf_counter() - began
+            clock.now = now
+            write_stats = redis.stats.as_dict()
+            write_stats['client_us_per_trade'] = round(elapsed / len(trades) * 1e6, 3)
+            write_stats['memory_used'] = redis.memory_used()
+            row['write'][layout] = write_stats
+            layouts[layout] = (redis, buckets)
+
+        for name, (symbols, seconds) in reads.items():
+            start, end = now - seconds, now
+            redis, _ = layouts['per_trade']
+            per_trade, expected = measure(redis, lambda: read_per_trade(redis, symbols, start, end))
+            redis, buckets = layouts['buckets']
+            bucketed, found = measure(redis, lambda: read_buckets(buckets, symbols, start, end))
+            if found != expected:
+                raise AssertionError(f'{name}: the layouts returned different trades on {n_nodes} nodes')
+            row['reads'][name] = {'per_trade': per_trade, 'buckets': bucketed}
+        results.append(row)
+
+    print(json.dumps({'trades': len(trades), 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Load test the hello handler locally, against a stand-in for the remote API
+
+The stand-in runs in its own process, answering every request after --latency-ms (+/- --jitter-ms) and with a 429
+(Retry-After: 1) once more than --rate-limit requests a second come in, like a remote API's per-IP limit. The
+handler is driven with batches of --batch-size urls:
+
+    inprocess   --invocations calls of the handler in this interpreter, one after the other
+    pool        --workers fresh interpreters at once, each making --invocations calls - Lambda containers
+
+The first invocation of each container is reported as cold (along with the import of the handler), the rest as
+warm. Reported: request and invocation latency p50/p95/p99, requests/s over the time the containers were invoking,
+and the status codes seen. --output / --baseline compare a run against an earlier one, so a handler change can be
+checked against a reproducible baseline:
+
+    python benchmarks/load_test.py --workers 8 --invocations 20 --batch-size 50 --latency-ms 20 --output base.json
+    python benchmarks/load_test.py --workers 8 --invocations 20 --batch-size 50 --latency-ms 20 --baseline base.json
+"""
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+ASSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdk_lambda_vpc', 'lambda')
+
+
+class TokenBucket:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    latency_ms = 0
+    jitter_ms = 0
+    limiter = None
+
+    def do_GET(self):
+        if self.limiter is not None and not self.limiter.take():
+            self.reply(429, {'error': 'rate limited'}, {'Retry-After': '1'})
+            return
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        self.reply(200, {'ip': '127.0.0.1', 'path': self.path})
+
+    def reply(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(latency_ms, jitter_ms, rate_limit):
+    StandIn.latency_ms = latency_ms
+    StandIn.jitter_ms = jitter_ms
+    StandIn.limiter = TokenBucket(rate_limit) if rate_limit else None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    server.daemon_threads = True
+    # Big enough for every worker's connections arriving at once
+    server.request_queue_size = 1024
+    print(f'PORT {server.server_port}', flush=True)
+    server.serve_forever()
+
+
+def start_stand_in(args):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve',
+                                '--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms),
+                                '--rate-limit', str(args.rate_limit)], stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline().split()[1])
+    return process, f'http://127.0.0.1:{port}'
+
+
+def run_container(url, invocations, batch_size, backend):
+    """
+    Import the handler and invoke it, the way one Lambda container would
+    """
+    os.environ['EGRESS_IP_URL'] = f'{url}/json'
+    sys.path.insert(0, ASSET_DIR)
+
+    start = time.perf_counter()
+    import http_client
+    if backend == 'requests':
+        http_client.httpx, http_client._backend_loaded = None, True
+    import hello
+    import_ms = (time.perf_counter() - start) * 1000
+
+    event = {'urls': [f'{url}/api/{n}' for n in range(batch_size)]}
+    invoke_ms, request_ms, statuses = [], [], {}
+    started_at = time.time()
+    # The handler logs to stdout, which is where this reports to
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(invocations):
+            start = time.perf_counter()
+            response = hello.handler(event, None)
+            invoke_ms.append((time.perf_counter() - start) * 1000)
+            for result in response['results']:
+                status = str(result.get('status', 'error'))
+                statuses[status] = statuses.get(status, 0) + 1
+                request_ms.append(result['latency_ms'])
+    finished_at = time.time()
+
+    return {
+        'import_ms': import_ms,
+        'invoke_ms': invoke_ms,
+        'request_ms': request_ms,
+        'statuses': statuses,
+        'started_at': started_at,
+        'finished_at': finished_at,
+    }
+
+
+def run_pool(url, workers, invocations, batch_size, backend):
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--url', url, '--invocations', str(invocations),
+               '--batch-size', str(batch_size), '--backend', backend]
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    processes = [subprocess.Popen(command, stdout=subprocess.PIPE, text=True, env=env) for _ in range(workers)]
+    containers = []
+    for process in processes:
+        out, _ = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f'Worker exited with {process.returncode}')
+        containers.append(json.loads([line for line in out.splitlines() if line.startswith('RESULT ')][-1][7:]))
+    return containers
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+
+    def rank(p):
+        return round(values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))], 3)
+
+    return {'count': len(values), 'p50': rank(50), 'p95': rank(95), 'p99': rank(99), 'max': round(values[-1], 3)}
+
+
+def summarise(mode, containers):
+    requests = sum(len(c['request_ms']) for c in containers)
+    invoking_s = max(c['finished_at'] for c in containers) - min(c['started_at'] for c in containers)
+    statuses = {}
+    for c in containers:
+        for status, n in c['statuses'].items():
+            statuses[status] = statuses.get(status, 0) + n
+    return {
+        'mode': mode,
+        'containers': len(containers),
+        'requests': requests,
+        'requests_per_second': round(requests / invoking_s, 3) if invoking_s > 0 else None,
+        'statuses': statuses,
+        'request_ms': percentiles([ms for c in containers for ms in c['request_ms']]),
+        'cold': {
+            'import_ms': percentiles([c['import_ms'] for c in containers]),
+            'invoke_ms': percentiles([c['invoke_ms'][0] for c in containers]),
+        },
+        'warm': {
+            'invoke_ms': percentiles([ms for c in containers for ms in c['invoke_ms'][1:]]),
+        },
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    [(mode, metric, baseline, now)] for metrics more than tolerance worse than the baseline
+    """
+    before = {r['mode']: r for r in baseline['results']}
+    metrics = [
+        ('requests_per_second', lambda r: r['requests_per_second'], False),
+        ('request_ms.p95', lambda r: r['request_ms']['p95'], True),
+        ('request_ms.p99', lambda r: r['request_ms']['p99'], True),
+        ('warm.invoke_ms.p95', lambda r: (r['warm']['invoke_ms'] or {}).get('p95'), True),
+        ('cold.invoke_ms.p50', lambda r: r['cold']['invoke_ms']['p50'], True),
+    ]
+    regressions = []
+    for result in results:
+        old = before.get(result['mode'])
+        if old is None:
+            continue
+        for name, get, higher_is_worse in metrics:
+            was, now = get(old), get(result)
+            if not was or not now:
+                continue
+            if (now > was * (1 + tolerance)) if higher_is_worse else (now < was * (1 - tolerance)):
+                regressions.append((result['mode'], name, was, now))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['inprocess', 'pool', 'both'], default='both')
+    parser.add_argument('--workers', type=int, default=4, help='containers in the pool')
+    parser.add_argument('--invocations', type=int, default=10, help='invocations per container')
+    parser.add_argument('--batch-size', type=int, default=20, help='urls per invocation')
+    parser.add_argument('--backend', choices=['httpx', 'requests'], default='httpx',
+                        help='http_client backend, httpx falls back to requests when it is not installed')
+    parser.add_argument('--latency-ms', type=float, default=10, help='stand-in response time')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='+/- on the stand-in response time')
+    parser.add_argument('--rate-limit', type=float, default=0, help='stand-in requests per second before 429s, 0 off')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='results from an earlier --output to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before flagging, 0.2 = 20%%')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.latency_ms, args.jitter_ms, args.rate_limit)
+        return
+    if args.child:
+        result = run_container(args.url, args.invocations, args.batch_size, args.backend)
+        print('RESULT ' + json.dumps(result))
+        return
+
+    stand_in, url = start_stand_in(args)
+    try:
+        results = []
+        if args.mode in ('pool', 'both'):
+            containers = run_pool(url, args.workers, args.invocations, args.batch_size, args.backend)
+            results.append(summarise('pool', containers))
+        if args.mode in ('inprocess', 'both'):
+            # Last, as it leaves the handler imported in this interpreter
+            results.append(summarise('inprocess', [run_container(url, args.invocations, args.batch_size,
+                                                                 args.backend)]))
+    finally:
+        stand_in.terminate()
+        stand_in.wait()
+
+    report = {
+        'config': {k: getattr(args, k) for k in ('workers', 'invocations', 'batch_size', 'backend', 'latency_ms',
+                                                 'jitter_ms', 'rate_limit')},
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for mode, metric, old, new in regressions:
+            print(f'{mode} {metric}: {old} -> {new}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Order book storage: a full snapshot per update vs hcache.orderbook snapshots + deltas
+
+Replays a synthetic order book (a few price levels changing per update) for the retention window into the Redis
+stand-in both ways, then compares memory held and the latency of rebuilding the book at random times, checking
+every rebuilt book against the real one. Rebuild latency here is client side decoding plus the stand-in's own
+lookups, with no network - on the cluster the snapshot+delta rebuild costs one extra round trip.
+
+    python benchmarks/orderbook_storage.py --updates-per-second 10 --minutes 5 --depth 50
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+from redis_standin import StandinRedis
+
+from hcache.codec import default_codec
+from hcache.orderbook import OrderBookStore, decode_book, encode_book
+
+FEED = 'COINBASE'
+SYMBOL = 'BTC-USD'
+
+
+def generate(updates, depth, changes_per_update, start, interval, seed=1):
+    rng = random.Random(seed)
+    mid = 30000.0
+    book = {
+        'bid': {round(mid - 0.5 * (i + 1), 2): round(rng.random() * 3, 8) for i in range(depth)},
+        'ask': {round(mid + 0.5 * (i + 1), 2): round(rng.random() * 3, 8) for i in range(depth)},
+    }
+    for n in range(updates):
+        for _ in range(changes_per_update):
+            side = rng.choice(['bid', 'ask'])
+            price = rng.choice(list(book[side]))
+            if rng.random() < 0.1 and len(book[side]) > 1:
+                del book[side][price]
+                offset = -0.5 if side == 'bid' else 0.5
+                book[side][round(min(book[side]) + offset if side == 'bid' else max(book[side]) + offset, 2)] = 1.0
+            else:
+                book[side][price] = round(rng.random() * 3, 8)
+        yield start + n * interval, {side: dict(levels) for side, levels in book.items()}
+
+
+class FullSnapshots:
+    """
+    What storing the whole book on every update costs: one stream entry per update
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def update(self, ts, book):
+        self.redis.xadd(f'book:{{{FEED}:{SYMBOL}}}:full', {'s': default_codec.encode(encode_book(book))},
+                        id='%d-0' % int(ts * 1000))
+
+    def book_at(self, ts):
+        entry = self.redis.xrevrange(f'book:{{{FEED}:{SYMBOL}}}:full', max='%d-0' % int(ts * 1000), count=1)
+        return decode_book(default_codec.decode(entry[0][1][b's'])) if entry else None
+
+
+def latency(fn, times):
+    samples = []
+    for ts in times:
+        start = time.perf_counter()
+        fn(ts)
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {'p50_us': round(statistics.median(samples), 1), 'p99_us': round(samples[int(len(samples) * 0.99)], 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates-per-second', type=float, default=10)
+    parser.add_argument('--minutes', type=float, default=5)
+    parser.add_argument('--depth', type=int, default=50)
+    parser.add_argument('--changes-per-update', type=int, default=3)
+    parser.add_argument('--snapshot-interval', type=float, default=10)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+
+    start = 1600000000.0
+    interval = 1 / args.updates_per_second
+    updates = int(args.minutes * 60 * args.updates_per_second)
+
+    full_redis, delta_redis = StandinRedis(), StandinRedis()
+    full = FullSnapshots(full_redis)
+    store = OrderBookStore(delta_redis, snapshot_interval=args.snapshot_interval, retention=args.minutes * 60)
+
+    history = []
+    for ts, book in generate(updates, args.depth, args.changes_per_update, start, interval):
+        full.update(ts, book)
+        store.update(FEED, SYMBOL, book, ts)
+        history.append((ts, book))
+
+    rng = random.Random(2)
+    samples = [rng.choice(history) for _ in range(args.queries)]
+    mismatches = sum(1 for ts, book in samples if store.book_at(FEED, SYMBOL, ts) != book)
+    times = [ts for ts, _ in samples]
+
+    print(json.dumps({
+        'updates': updates,
+        'full_snapshots': {'memory_bytes': full_redis.memory_used(), 'rebuild': latency(full.book_at, times)},
+        'snapshot_delta': {'memory_bytes': delta_redis.memory_used(),
+                           'rebuild': latency(lambda ts: store.book_at(FEED, SYMBOL, ts), times),
+                           'mismatches': mismatches},
+        'memory_ratio': round(delta_redis.memory_used() / full_redis.memory_used(), 3),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+"""
+In-process stand-in for the hcache Redis cluster, for running the hcache client code and benchmarks offline
+
+Implements the handful of commands the hcache modules use against a dict, split into nodes by slot range like a
+real cluster. Every command is accounted for: a pipeline costs one round trip per node it touches, a direct call
+costs one, and bytes_sent is the RESP encoded size of the commands. Keys set with PX expire against clock (pass a
+fake one to move time along); beyond that it doesn't model latency, eviction or anything server side. MSET and MGET
+in a pipeline raise RedisClusterException, as they do with the real cluster clients.
+"""
+import bisect
+import fnmatch
+import heapq
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdk_lambda_vpc', 'lambda'))
+
+from hcache.slots import N_SLOTS, key_slot
+
+
+def _b(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, float):
+        return repr(value).encode()
+    return str(value).encode()
+
+
+def resp_size(args):
+    """
+    Size of a command on the wire: *<n>\r\n then $<len>\r\n<arg>\r\n per argument
+    """
+    size = len(f'*{len(args)}\r\n')
+    for arg in args:
+        arg = _b(arg)
+        size += len(f'${len(arg)}\r\n') + len(arg) + 2
+    return size
+
+
+def _stream_id(value, default_seq):
+    """
+    '<ms>-<seq>', '<ms>' (seq defaults to default_seq), '-' or '+' -> (ms, seq)
+    """
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    if value in ('-', '+'):
+        return (0, 0) if value == '-' else (2 ** 64, 2 ** 64)
+    ms, _, seq = value.partition('-')
+    return int(ms), int(seq) if seq else default_seq
+
+
+def _score(value):
+    """
+    Score bound -> (score, inclusive)
+    """
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    if value in ('-inf', '+inf', 'inf'):
+        return float(value), True
+    if value.startswith('('):
+        return float(value[1:]), False
+    return float(value), True
+
+
+class RedisClusterException(Exception):
+    """
+    Stands in for redis.exceptions.RedisClusterException
+    """
+
+
+class Stream(list):
+    """
+    Entries as ((ms, seq), {field: value}), oldest first
+    """
+
+
+class SortedSet(dict):
+    """
+    member -> score
+    """
+
+
+class Stats:
+
+    def __init__(self):
+        self.round_trips = 0
+        self.commands = 0
+        self.bytes_sent = 0
+
+    def as_dict(self):
+        return {'round_trips': self.round_trips, 'commands': self.commands, 'bytes_sent': self.bytes_sent}
+
+
+class StandinRedis:
+    """
+    Looks like a redis-py cluster client: the same command methods, plus pipeline(transaction=False)
+    """
+
+    def __init__(self, n_nodes=2, clock=time.monotonic):
+        self.n_nodes = n_nodes
+        self.clock = clock
+        self.data = {}
+        # key -> clock() deadline, and the same as a heap of (deadline, key) which may hold deadlines since replaced
+        self.expiry = {}
+        self.deadlines = []
+        # key -> node, hashing the slot is most of the stand-in's own time otherwise
+        self.nodes = {}
+        # node -> its keys when the last SCAN from cursor 0 started
+        self.scans = {}
+        self.stats = Stats()
+
+    def node_for_key(self, key):
+        key = _b(key)
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = key_slot(key) * self.n_nodes // N_SLOTS
+        return node
+
+    def expire_keys(self):
+        """
+        Drop the keys past their deadline, run before each pipeline
+        """
+        now = self.clock()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, key = heapq.heappop(self.deadlines)
+            if self.expiry.get(key) == deadline:
+                del self.expiry[key]
+                self.data.pop(key, None)
+
+    def set_expiry(self, key, px):
+        if px is None:
+            self.expiry.pop(key, None)
+        else:
+            self.expiry[key] = self.clock() + px / 1000
+            heapq.heappush(self.deadlines, (self.expiry[key], key))
+
+    def pipeline(self, transaction=False):
+        return StandinPipeline(self)
+
+    # Direct calls are a round trip each
+    def __getattr__(self, name):
+        command = getattr(StandinPipeline, name, None)
+        if command is None or name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            pipe = StandinPipeline(self, direct=True)
+            getattr(pipe, name)(*args, **kwargs)
+            return pipe.execute()[0]
+        return call
+
+    def scan_iter(self, match=None, count=None):
+        """
+        Every key matching match, node by node, like a cluster client's scan_iter
+        """
+        for node in range(self.n_nodes):
+            cursor = 0
+            while True:
+                cursor, keys = self.scan(cursor, match=match, count=count, node=node)
+                yield from keys
+                if not cursor:
+                    break
+
+    def node(self, node):
+        """
+        A client for one node, as a plain redis-py client connected to one shard is
+        """
+        return StandinNode(self, node)
+
+    def memory_used(self):
+        """
+        Approximate memory used by keys and values, ignoring Redis' per key overhead
+        """
+        return sum(self.key_memory(key) for key in self.data)
+
+    def key_memory(self, key):
+        """
+        Approximate memory used by one key and its value, None if there is no such key
+        """
+        value = self.data.get(_b(key))
+        if value is None:
+            return None
+        total = len(_b(key))
+        if isinstance(value, bytes):
+            total += len(value)
+        elif isinstance(value, Stream):
+            # ids are stored as two 64 bit integers
+            total += sum(16 + sum(len(_b(f)) + len(_b(v)) for f, v in fields.items()) for _, fields in value)
+        elif isinstance(value, SortedSet):
+            # scores are doubles
+            total += sum(len(_b(m)) + 8 for m in value)
+        elif isinstance(value, dict):
+            total += sum(len(_b(k)) + len(_b(v)) for k, v in value.items())
+        return total
+
+
+class StandinNode:
+    """
+    The stand-in seen through a connection to one node: SCAN only returns that node's keys
+    """
+
+    def __init__(self, redis, node):
+        self.redis = redis
+        self.node = node
+
+    def pipeline(self, transaction=False):
+        return self.redis.pipeline(transaction)
+
+    def scan(self, cursor=0, match=None, count=None):
+        return self.redis.scan(cursor, match=match, count=count, node=self.node)
+
+    def __getattr__(self, name):
+        return getattr(self.redis, name)
+
+
+class StandinPipeline:
+
+    def __init__(self, redis, direct=False):
+        self.redis = redis
+        self.queue = []
+        # A direct call rather than a pipeline the caller built
+        self.direct = direct
+
+    def _not_pipelined(self, command):
+        # As redis.cluster's ClusterPipeline (redis-py-cluster's refuses them the same way)
+        if not self.direct:
+            raise RedisClusterException(f'Calling pipelined function {command} is blocked when running redis in '
+                                        f'cluster mode...')
+
+    def _queue(self, keys, args, fn):
+        self.queue.append(({self.redis.node_for_key(k) for k in keys}, args, fn))
+        return self
+
+    def execute(self):
+        stats = self.redis.stats
+        nodes = set()
+        for command_nodes, args, _ in self.queue:
+            nodes |= command_nodes
+            stats.commands += 1
+            stats.bytes_sent += resp_size(args)
+        stats.round_trips += len(nodes)
+
+        self.redis.expire_keys()
+        results = [fn() for _, _, fn in self.queue]
+        self.queue = []
+        return results
+
+    def set(self, key, value, px=None):
+        def run():
+            self.redis.data[_b(key)] = _b(value)
+            self.redis.set_expiry(_b(key), px)
+            return True
+        args = ['SET', key, value] + (['PX', px] if px is not None else [])
+        return self._queue([key], args, run)
+
+    def mset(self, mapping):
+        self._not_pipelined('mset')
+
+        def run():
+            for k, v in mapping.items():
+                self.redis.data[_b(k)] = _b(v)
+                self.redis.set_expiry(_b(k), None)
+            return True
+        args = ['MSET'] + [x for kv in mapping.items() for x in kv]
+        return self._queue(mapping.keys(), args, run)
+
+    def get(self, key):
+        return self._queue([key], ['GET', key], lambda: self.redis.data.get(_b(key)))
+
+    def mget(self, keys, *args):
+        self._not_pipelined('mget')
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        keys += args
+        return self._queue(keys, ['MGET'] + keys, lambda: [self.redis.data.get(_b(k)) for k in keys])
+
+    def _delete(self, command, keys):
+        def run():
+            for k in keys:
+                self.redis.expiry.pop(_b(k), None)
+            return sum(1 for k in keys if self.redis.data.pop(_b(k), None) is not None)
+        return self._queue(keys, [command] + list(keys), run)
+
+    def delete(self, *keys):
+        return self._delete('DEL', keys)
+
+    def unlink(self, *keys):
+        return self._delete('UNLINK', keys)
+
+    def pexpire(self, key, ms):
+        def run():
+            if _b(key) not in self.redis.data:
+                return False
+            self.redis.set_expiry(_b(key), ms)
+            return True
+        return self._queue([key], ['PEXPIRE', key, ms], run)
+
+    def memory_usage(self, key, samples=None):
+        return self._queue([key], ['MEMORY', 'USAGE', key], lambda: self.redis.key_memory(key))
+
+    def pttl(self, key):
+        def run():
+            if _b(key) not in self.redis.data:
+                return -2
+            deadline = self.redis.expiry.get(_b(key))
+            return -1 if deadline is None else max(0, int((deadline - self.redis.clock()) * 1000))
+        return self._queue([key], ['PTTL', key], run)
+
+    # Keyspace
+
+    def scan(self, cursor=0, match=None, count=None, node=0):
+        """
+        SCAN on one node, returns (next cursor, keys) with next cursor 0 at the end. The cursor is the next key in the
+        node's keys in sorted order, taken when the scan started: keys added since may be missed, keys removed since
+        are left out, as with Redis
+        """
+        def run():
+            if not cursor or node not in self.redis.scans:
+                self.redis.scans[node] = sorted(k for k in self.redis.data if self.redis.node_for_key(k) == node)
+            keys = self.redis.scans[node]
+            start = bisect.bisect_left(keys, _b(cursor)) if cursor else 0
+            end = start + (count or 10)
+            next_cursor = keys[end] if end < len(keys) else 0
+            batch = [k for k in keys[start:end] if k in self.redis.data]
+            if match is not None:
+                batch = [k for k in batch if fnmatch.fnmatchcase(k.decode(), match)]
+            return next_cursor, batch
+        self.queue.append(({node}, ['SCAN', cursor] + (['MATCH', match] if match else []) +
+                           (['COUNT', count] if count else []), run))
+        return self
+
+    # Streams
+
+    def _stream(self, key):
+        return self.redis.data.setdefault(_b(key), Stream())
+
+    def xadd(self, key, fields, id='*', maxlen=None, minid=None, approximate=True):
+        def run():
+            stream = self._stream(key)
+            if id == '*':
+                entry_id = (stream[-1][0][0], stream[-1][0][1] + 1) if stream else (0, 0)
+            else:
+                entry_id = _stream_id(id, 0)
+            if stream and entry_id <= stream[-1][0]:
+                raise ValueError('ERR The ID specified in XADD is equal or smaller than the target stream top item')
+            stream.append((entry_id, {_b(f): _b(v) for f, v in fields.items()}))
+            if minid is not None:
+                self._trim(stream, _stream_id(minid, 0))
+            return b'%d-%d' % entry_id
+        args = ['XADD', key] + (['MINID', minid] if minid is not None else []) + [id]
+        args += [x for kv in fields.items() for x in kv]
+        return self._queue([key], args, run)
+
+    def _trim(self, stream, min_id, limit=None):
+        ids = [entry_id for entry_id, _ in stream]
+        n = bisect.bisect_left(ids, min_id)
+        if limit:
+            n = min(n, limit)
+        del stream[:n]
+        return n
+
+    def xtrim(self, key, maxlen=None, approximate=True, minid=None, limit=None):
+        """
+        With limit, trims at most limit entries - Redis' approximate trim frees whole nodes of entries, up to limit
+        """
+        def run():
+            stream = self._stream(key)
+            if minid is not None:
+                return self._trim(stream, _stream_id(minid, 0), limit)
+            n = max(0, len(stream) - maxlen)
+            if limit:
+                n = min(n, limit)
+            del stream[:n]
+            return n
+        args = ['XTRIM', key] + (['MINID'] if minid is not None else ['MAXLEN']) + (['~'] if approximate else [])
+        args += [minid if minid is not None else maxlen] + (['LIMIT', limit] if limit else [])
+        return self._queue([key], args, run)
+
+    def xrange(self, key, min='-', max='+', count=None):
+        def run():
+            lo, hi = _stream_id(min, 0), _stream_id(max, 2 ** 64)
+            entries = [(b'%d-%d' % i, f) for i, f in self.redis.data.get(_b(key), Stream()) if lo <= i <= hi]
+            return entries[:count] if count else entries
+        return self._queue([key], ['XRANGE', key, min, max] + (['COUNT', count] if count else []), run)
+
+    def xrevrange(self, key, max='+', min='-', count=None):
+        def run():
+            lo, hi = _stream_id(min, 0), _stream_id(max, 2 ** 64)
+            entries = [(b'%d-%d' % i, f) for i, f in reversed(self.redis.data.get(_b(key), Stream()))
+                       if lo <= i <= hi]
+            return entries[:count] if count else entries
+        return self._queue([key], ['XREVRANGE', key, max, min] + (['COUNT', count] if count else []), run)
+
+    def xlen(self, key):
+        return self._queue([key], ['XLEN', key], lambda: len(self.redis.data.get(_b(key), Stream())))
+
+    # Sorted sets
+
+    def _zset(self, key):
+        return self.redis.data.setdefault(_b(key), SortedSet())
+
+    def _zrange_by_score(self, key, lo, hi):
+        (lo, lo_inc), (hi, hi_inc) = _score(lo), _score(hi)
+        items = sorted(((score, member) for member, score in self.redis.data.get(_b(key), SortedSet()).items()))
+        return [(m, s) for s, m in items
+                if (s > lo or (lo_inc and s == lo)) and (s < hi or (hi_inc and s == hi))]
+
+    def zadd(self, key, mapping):
+        def run():
+            zset = self._zset(key)
+            added = sum(1 for m in mapping if _b(m) not in zset)
+            zset.update({_b(m): float(s) for m, s in mapping.items()})
+            return added
+        return self._queue([key], ['ZADD', key] + [x for m, s in mapping.items() for x in (s, m)], run)
+
+    def zrangebyscore(self, key, min, max, start=None, num=None, withscores=False):
+        def run():
+            items = self._zrange_by_score(key, min, max)
+            if start is not None:
+                items = items[start:start + num]
+            return items if withscores else [m for m, _ in items]
+        return self._queue([key], ['ZRANGEBYSCORE', key, min, max], run)
+
+    def zrevrangebyscore(self, key, max, min, start=None, num=None, withscores=False):
+        def run():
+            items = list(reversed(self._zrange_by_score(key, min, max)))
+            if start is not None:
+                items = items[start:start + num]
+            return items if withscores else [m for m, _ in items]
+        return self._queue([key], ['ZREVRANGEBYSCORE', key, max, min], run)
+
+    def zremrangebyscore(self, key, min, max):
+        def run():
+            zset = self.redis.data.get(_b(key), SortedSet())
+            removed = [m for m, _ in self._zrange_by_score(key, min, max)]
+            for m in removed:
+                del zset[m]
+            if not zset:
+                # Redis drops a sorted set with its last member
+                self.redis.data.pop(_b(key), None)
+                self.redis.expiry.pop(_b(key), None)
+            return len(removed)
+        return self._queue([key], ['ZREMRANGEBYSCORE', key, min, max], run)
+
+    def zcount(self, key, min, max):
+        return self._queue([key], ['ZCOUNT', key, min, max], lambda: len(self._zrange_by_score(key, min, max)))
+
+    def zcard(self, key):
+        return self._queue([key], ['ZCARD', key], lambda: len(self.redis.data.get(_b(key), SortedSet())))
@@ -0,0 +1,178 @@
+"""
+Check the request phase metrics of the cdk_lambda_vpc/lambda asset offline, and what they cost
+
+Each run starts a fresh interpreter with REQUEST_METRICS_SAMPLE_RATE set, invokes the hello handler with batches of
+urls against a local HTTP(S) server, and captures its stdout. The EMF lines printed are checked against the
+CloudWatch Embedded Metric Format (namespace, dimensions, metric arrays of at most 100 values) and the sampled phases
+summarised. Warm batch latency at sample rate 0 and 1 is compared, for the overhead of timing every request, and
+the per-request cost when disabled (a sample() call at rate 0) is timed on its own.
+
+    python benchmarks/request_metrics.py --backend requests --tls --batches 20 --batch-size 50
+"""
+import argparse
+import http.server
+import json
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import timeit
+
+ASSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdk_lambda_vpc', 'lambda')
+sys.path.insert(0, ASSET_DIR)
+
+from request_metrics import RequestMetrics
+
+CONTAINER = '''
+import json, sys, time
+sys.path.insert(0, {asset_dir!r})
+import http_client
+if {backend!r} == 'requests':
+    http_client.httpx, http_client._backend_loaded = None, True
+import hello
+event = {{"urls": [{url!r}] * {batch_size}}}
+hello.handler(event, None)
+batch_ms = []
+for _ in range({batches}):
+    start = time.perf_counter()
+    hello.handler(event, None)
+    batch_ms.append((time.perf_counter() - start) * 1000)
+print("RESULT " + json.dumps({{"batch_ms": batch_ms}}))
+'''
+
+
+class Target(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = json.dumps({'ip': '127.0.0.1'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def self_signed_cert(directory):
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1', '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def validate_emf(record):
+    """
+    The problems with an EMF record, an empty list if it is valid
+    """
+    problems = []
+    aws = record.get('_aws', {})
+    if not isinstance(aws.get('Timestamp'), int):
+        problems.append('_aws.Timestamp missing or not an int')
+    directives = aws.get('CloudWatchMetrics') or []
+    if not directives:
+        problems.append('_aws.CloudWatchMetrics missing')
+    for directive in directives:
+        if not directive.get('Namespace'):
+            problems.append('Namespace missing')
+        for dimension_set in directive.get('Dimensions', []):
+            for dimension in dimension_set:
+                if not isinstance(record.get(dimension), str):
+                    problems.append(f'dimension {dimension} missing or not a string')
+        for metric in directive.get('Metrics', []):
+            values = record.get(metric['Name'])
+            if not isinstance(values, list) or not values or len(values) > 100:
+                problems.append(f'metric {metric["Name"]} should be 1-100 values, is {values!r}')
+            elif not all(isinstance(v, (int, float)) for v in values):
+                problems.append(f'metric {metric["Name"]} has non-numeric values')
+    return problems
+
+
+def run_container(backend, url, sample_rate, batches, batch_size, ca_file):
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1', EGRESS_IP_URL=url, REQUEST_METRICS_SAMPLE_RATE=str(sample_rate),
+               AWS_LAMBDA_FUNCTION_NAME='request-metrics-benchmark', EGRESS_SUBNET_ID='subnet-local')
+    if ca_file:
+        env.update(REQUESTS_CA_BUNDLE=ca_file, SSL_CERT_FILE=ca_file)
+    code = CONTAINER.format(asset_dir=os.path.abspath(ASSET_DIR), backend=backend, url=url, batches=batches,
+                            batch_size=batch_size)
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env, check=True).stdout
+
+    result, records = None, []
+    for line in out.splitlines():
+        if line.startswith('RESULT '):
+            result = json.loads(line[len('RESULT '):])
+        elif line.startswith('{') and '"_aws"' in line:
+            records.append(json.loads(line))
+    return result, records
+
+
+def summarise(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'median': round(statistics.median(values), 3),
+        'p99': round(values[min(len(values) - 1, int(len(values) * 0.99))], 3),
+        'max': round(values[-1], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=['httpx', 'requests'], default='requests')
+    parser.add_argument('--tls', action='store_true', help='serve over HTTPS with a self-signed certificate')
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Target)
+    with tempfile.TemporaryDirectory() as directory:
+        ca_file = None
+        if args.tls:
+            ca_file, key = self_signed_cert(directory)
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(ca_file, key)
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'{"https" if args.tls else "http"}://localhost:{server.server_port}/json'
+
+        off, off_records = run_container(args.backend, url, 0, args.batches, args.batch_size, ca_file)
+        on, on_records = run_container(args.backend, url, 1, args.batches, args.batch_size, ca_file)
+    server.shutdown()
+
+    problems = [p for record in on_records for p in validate_emf(record)]
+    phases = {}
+    for record in on_records:
+        for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            phases.setdefault(metric['Name'], []).extend(record[metric['Name']])
+    disabled = RequestMetrics(sample_rate=0)
+    disabled_sample_ns = min(timeit.repeat(disabled.sample, number=100000, repeat=5)) / 100000 * 1e9
+    off_median, on_median = statistics.median(off['batch_ms']), statistics.median(on['batch_ms'])
+
+    print(json.dumps({
+        'backend': args.backend,
+        'tls': args.tls,
+        'batch_size': args.batch_size,
+        'emf_records': len(on_records),
+        'emf_records_when_disabled': len(off_records),
+        'emf_problems': problems,
+        'dimensions': sorted({(r['Function'], r['Subnet'], r['EgressIp']) for r in on_records}),
+        'phases_ms': {name: summarise(values) for name, values in sorted(phases.items())},
+        'warm_batch_ms': {'disabled': summarise(off['batch_ms']), 'sampled': summarise(on['batch_ms'])},
+        'disabled_sample_ns': round(disabled_sample_ns, 1),
+        'overhead_per_request_us': round((on_median - off_median) * 1000 / args.batch_size, 3),
+    }, indent=2))
+    if problems or off_records or not on_records:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
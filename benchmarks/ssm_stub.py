@@ -0,0 +1,140 @@
+"""
+Local SSM endpoint stub, and a comparison of hcache.config against a GetParameter call per invocation
+
+The stub speaks enough of the SSM JSON protocol for GetParameter and GetParametersByPath (paginated 10 at a time,
+like SSM), with configurable latency and a switch to make every call fail. Point boto3 at it with
+SSM_ENDPOINT_URL / endpoint_url.
+
+    python benchmarks/ssm_stub.py --invocations 500 --latency-ms 20
+"""
+import argparse
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdk_lambda_vpc', 'lambda'))
+
+from hcache.config import ParameterCache
+
+PARAMETERS = {
+    '/hcache/connection_string': 'hcache.local:6379',
+    '/hcache/evict_trades_after_minutes': '30',
+    '/hcache/evict_orderbooks_after_minutes': '5',
+}
+PAGE_SIZE = 10
+
+
+class SsmStub(http.server.ThreadingHTTPServer):
+
+    def __init__(self, parameters=None, latency=0.0):
+        super().__init__(('127.0.0.1', 0), SsmHandler)
+        self.parameters = dict(parameters or PARAMETERS)
+        self.latency = latency
+        self.failing = False
+        self.calls = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class SsmHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        server.calls += 1
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+        action = self.headers.get('X-Amz-Target', '').split('.')[-1]
+        time.sleep(server.latency)
+
+        if server.failing:
+            return self.reply(400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'})
+
+        if action == 'GetParameter':
+            name = request['Name']
+            if name not in server.parameters:
+                return self.reply(400, {'__type': 'ParameterNotFound', 'message': name})
+            return self.reply(200, {'Parameter': self.parameter(name)})
+
+        if action == 'GetParametersByPath':
+            path = request['Path'].rstrip('/') + '/'
+            names = sorted(n for n in server.parameters if n.startswith(path))
+            start = int(request.get('NextToken') or 0)
+            body = {'Parameters': [self.parameter(n) for n in names[start:start + PAGE_SIZE]]}
+            if start + PAGE_SIZE < len(names):
+                body['NextToken'] = str(start + PAGE_SIZE)
+            return self.reply(200, body)
+
+        self.reply(400, {'__type': 'InvalidAction', 'message': action})
+
+    def parameter(self, name):
+        return {'Name': name, 'Type': 'String', 'Value': self.server.parameters[name], 'Version': 1}
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def stub_client(stub):
+    import boto3
+    return boto3.client('ssm', endpoint_url=stub.url, region_name='us-east-1',
+                        aws_access_key_id='stub', aws_secret_access_key='stub')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--invocations', type=int, default=500)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--ttl', type=float, default=60)
+    args = parser.parse_args()
+
+    stub = SsmStub(latency=args.latency_ms / 1000).start()
+    client = stub_client(stub)
+    names = ['connection_string', 'evict_trades_after_minutes', 'evict_orderbooks_after_minutes']
+
+    start = time.perf_counter()
+    for _ in range(args.invocations):
+        for name in names:
+            client.get_parameter(Name=f'/hcache/{name}')['Parameter']['Value']
+    per_call = {'ms_per_invocation': (time.perf_counter() - start) * 1000 / args.invocations, 'ssm_calls': stub.calls}
+
+    stub.calls = 0
+    settings = ParameterCache(client=client, ttl=args.ttl)
+    start = time.perf_counter()
+    for i in range(args.invocations):
+        for name in names:
+            settings.get(name)
+        if i == args.invocations // 2:
+            # SSM throttling half way through, stale values keep being served
+            stub.failing = True
+            settings.loaded_at -= args.ttl
+    elapsed = time.perf_counter() - start
+
+    # Let the failing background refresh run out of retries
+    while settings.refreshing:
+        time.sleep(0.01)
+    cached = {'ms_per_invocation': elapsed * 1000 / args.invocations, 'ssm_calls': stub.calls,
+              'cache': settings.stats()}
+
+    print(json.dumps({'get_parameter_per_invocation': per_call, 'parameter_cache': cached}, indent=2, default=str))
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Synth time of CombinedStack as the egress fleet grows
+
+Each size is synthesized in a fresh interpreter (and so a fresh jsii node process) with the context from cdk.json
+and the committed cdk.context.json, so nothing is looked up in AWS. For every size it reports:
+
+    - wall time split into importing aws_cdk, constructing the stack and app.synth()
+    - jsii calls, by kind (create, get, set, invoke, ...) - every one is a round trip to node
+    - peak RSS of the python and the node process
+    - per method: time and jsii calls spent in create_efs, create_mgmt_ec2 and create_lambda_access_route (all
+      calls summed), the rest of construction is the VPC and the subnet plan
+
+A size that fails to synthesize (e.g. a template over CloudFormation's 500 resources) is reported as a row with
+the error, and the other sizes still run. Save a run with --output and pass it back as --baseline later to see what
+regressed. Exits 1 past --tolerance or when any size failed.
+
+    python benchmarks/synth.py --sizes 1 10 50 200 --output synth.json
+    python benchmarks/synth.py --baseline synth.json
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+METHODS = ('create_efs', 'create_mgmt_ec2', 'create_lambda_access_route')
+
+
+class JsiiCounter:
+    """
+    Counts requests sent to the jsii node process by patching its send()
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def install(self):
+        from jsii._kernel.providers import process
+
+        send = process._NodeProcess.send
+        counter = self
+
+        def counted(node, request, response_type):
+            kind = type(request).__name__.replace('Request', '').lower()
+            counter.calls[kind] = counter.calls.get(kind, 0) + 1
+            return send(node, request, response_type)
+        process._NodeProcess.send = counted
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+def node_peak_rss_kb():
+    import jsii
+
+    pid = jsii.kernel.provider._process._process.pid
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def profile_methods(cls, counter):
+    """
+    Wrap cls's METHODS to sum the time and jsii calls spent in each
+    """
+    breakdown = {name: {'calls': 0, 'ms': 0.0, 'jsii_calls': 0} for name in METHODS}
+
+    def wrap(name, method):
+        def timed(self, *args, **kwargs):
+            entry = breakdown[name]
+            jsii_before, t0 = counter.total(), time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                entry['calls'] += 1
+                entry['ms'] += (time.perf_counter() - t0) * 1000
+                entry['jsii_calls'] += counter.total() - jsii_before
+        return timed
+
+    for name in METHODS:
+        setattr(cls, name, wrap(name, getattr(cls, name)))
+    return breakdown
+
+
+def context():
+    with open(os.path.join(REPO_DIR, 'cdk.json')) as f:
+        ctx = json.load(f).get('context', {})
+    with open(os.path.join(REPO_DIR, 'cdk.context.json')) as f:
+        ctx.update(json.load(f))
+    return ctx
+
+
+def synth_once(n_subnets, max_azs):
+    """
+    Runs in the child interpreter
+    """
+    os.environ.setdefault('JSII_SILENCE_WARNING_DEPRECATED_NODE_VERSION', '1')
+    sys.path.insert(0, REPO_DIR)
+
+    t0 = time.perf_counter()
+    counter = JsiiCounter()
+    counter.install()
+    from aws_cdk import core
+    import config
+    from cdk_lambda_vpc.combined_stack import CombinedStack
+    t1 = time.perf_counter()
+
+    breakdown = profile_methods(CombinedStack, counter)
+    jsii_before_construct = counter.total()
+    with tempfile.TemporaryDirectory() as outdir:
+        app = core.App(context=context(), outdir=outdir)
+        CombinedStack(app, 'combined-vpc', ec2_whitelist_ips=config.EC2_WHITELIST_IPS,
+                      ec2_key_name=config.EC2_KEY_NAME, n_subnets=n_subnets, max_azs=max_azs,
+                      nat_gateways_per_az=None, env=config.env_dev)
+        t2 = time.perf_counter()
+        jsii_construct = counter.total() - jsii_before_construct
+        assembly = app.synth()
+        t3 = time.perf_counter()
+        templates = len([name for name in os.listdir(assembly.directory) if name.endswith('.template.json')])
+
+    construct_ms = (t2 - t1) * 1000
+    breakdown['other'] = {
+        'calls': 1,
+        'ms': construct_ms - sum(m['ms'] for m in breakdown.values()),
+        'jsii_calls': jsii_construct - sum(m['jsii_calls'] for m in breakdown.values()),
+    }
+    return {
+        'n_subnets': n_subnets,
+        'templates': templates,
+        'wall_ms': (t3 - t0) * 1000,
+        'import_ms': (t1 - t0) * 1000,
+        'construct_ms': construct_ms,
+        'synth_ms': (t3 - t2) * 1000,
+        'jsii_calls': counter.total(),
+        'jsii_calls_by_kind': dict(sorted(counter.calls.items())),
+        'python_peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'node_peak_rss_kb': node_peak_rss_kb(),
+        'methods': breakdown,
+    }
+
+
+def run_child(n_subnets, max_azs):
+    """
+    One size's results, or {'n_subnets', 'error'} with the last line the child wrote to stderr if it failed
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', str(n_subnets), '--max-azs', str(max_azs)]
+    child = subprocess.run(cmd, capture_output=True, text=True, cwd=REPO_DIR)
+    results = [line for line in child.stdout.splitlines() if line.startswith('RESULT ')]
+    if child.returncode or not results:
+        errors = [line for line in child.stderr.splitlines() if line.strip()]
+        return {'n_subnets': n_subnets, 'error': errors[-1] if errors else f'exit status {child.returncode}'}
+    return json.loads(results[-1][len('RESULT '):])
+
+
+def run_size(n_subnets, max_azs, runs):
+    results = [run_child(n_subnets, max_azs) for _ in range(runs)]
+    failed = [r for r in results if 'error' in r]
+    return failed[0] if failed else median_of(results)
+
+
+def median_of(runs):
+    """
+    Field by field median of several runs' results
+    """
+    first = runs[0]
+    if isinstance(first, dict):
+        return {k: median_of([r[k] for r in runs]) for k in first}
+    if isinstance(first, (int, float)) and not isinstance(first, bool):
+        return round(statistics.median(runs), 3)
+    return first
+
+
+def compare(results, baseline, tolerance):
+    """
+    [(n_subnets, metric, baseline, now)] for metrics more than tolerance worse than the baseline
+    """
+    before = {r['n_subnets']: r for r in baseline}
+    regressions = []
+    for result in results:
+        old = before.get(result['n_subnets'])
+        if old is None:
+            continue
+        for metric in ('wall_ms', 'construct_ms', 'synth_ms', 'jsii_calls', 'node_peak_rss_kb'):
+            if old.get(metric) and result.get(metric) and result[metric] > old[metric] * (1 + tolerance):
+                regressions.append((result['n_subnets'], metric, old[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 50, 200], help='n_subnets to synthesize')
+    parser.add_argument('--runs', type=int, default=1, help='runs per size, the median of each field is reported')
+    parser.add_argument('--max-azs', type=int, default=6, help='AZs to spread the egress routes over')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='results from an earlier --output to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before flagging, 0.2 = 20%%')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print('RESULT ' + json.dumps(synth_once(args.child, args.max_azs)))
+        return
+
+    results = [run_size(n, args.max_azs, args.runs) for n in args.sizes]
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for n_subnets, metric, old, new in regressions:
+            print(f'n_subnets={n_subnets} {metric}: {old} -> {new}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+    if any('error' in r for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Run the tiering worker (hcache.tiering) against the Redis stand-in and a local directory
+
+Trades for --minutes are written through BatchWriter with the --ttl-minutes TTL, --trades-per-second across the
+symbols, on a fake clock that the stand-in expires keys by. The worker runs every --interval-minutes of that clock
+while they are written, then on until hcache is empty. Every segment is then read back and checked against the
+trades written: all of them archived, once, so none expired before the worker got to them. Sizes are compared with
+the same trades as stored in hcache (msgpack+lz4 per key) and as raw msgpack. --layout buckets writes the trades
+into time buckets (hcache.buckets) instead of a key each.
+
+    python benchmarks/tiering.py --trades-per-second 50 --minutes 120 --path /tmp/tiering
+"""
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import time
+
+import msgpack
+
+from redis_standin import StandinRedis, Stats
+from ssm_stub import PARAMETERS, SsmStub, stub_client
+
+from hcache.buckets import TradeBuckets
+from hcache.codec import default_codec
+from hcache.config import ParameterCache
+from hcache.segment import SegmentReader, segment_paths
+from hcache.eviction import TRADES_SETTING
+from hcache.tiering import TradeTiering
+from hcache.writer import BatchWriter
+
+FEED = 'COINBASE'
+SYMBOLS = ['BTC-USD', 'ETH-USD', 'SOL-USD', 'ADA-USD', 'DOGE-USD', 'LTC-USD', 'XRP-USD', 'DOT-USD']
+START = 1622541600.0
+
+
+class FakeClock:
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def generate(trades_per_second, minutes, seed=1):
+    """
+    [(second, trades)] for each second
+    """
+    rng = random.Random(seed)
+    prices = {symbol: 100.0 * (n + 1) for n, symbol in enumerate(SYMBOLS)}
+    n = 0
+    seconds = []
+    for second in range(minutes * 60):
+        trades = []
+        for _ in range(trades_per_second):
+            symbol = rng.choice(SYMBOLS)
+            prices[symbol] = round(prices[symbol] * (1 + rng.gauss(0, 0.0002)), 2)
+            trades.append({'id': n, 'feed': FEED, 'symbol': symbol, 'side': rng.choice(['buy', 'sell']),
+                           'amount': round(rng.expovariate(2), 8), 'price': prices[symbol],
+                           'timestamp': START + second + rng.random()})
+            n += 1
+        seconds.append((second, trades))
+    return seconds
+
+
+def check(root, trades):
+    archived = {}
+    for path in segment_paths(root):
+        with SegmentReader(path) as segment:
+            for row in segment.rows():
+                if row['id'] in archived:
+                    raise AssertionError(f'Trade {row["id"]} archived twice')
+                archived[row['id']] = row
+    missing = [t['id'] for t in trades if archived.get(t['id']) != t]
+    if missing:
+        raise AssertionError(f'{len(missing)} trades missing or different, e.g. {missing[:5]}')
+    return len(archived)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trades-per-second', type=int, default=20)
+    parser.add_argument('--minutes', type=int, default=60, help='minutes of trades written')
+    parser.add_argument('--ttl-minutes', type=int, default=30)
+    parser.add_argument('--horizon-minutes', type=float, default=15)
+    parser.add_argument('--interval-minutes', type=float, default=10, help='time between runs of the worker')
+    parser.add_argument('--segment-rows', type=int, default=200000)
+    parser.add_argument('--layout', choices=['per_trade', 'buckets'], default='per_trade')
+    parser.add_argument('--path', help='directory to write the segments to, a temporary one by default')
+    args = parser.parse_args()
+
+    # Trade time, which bucket TTLs are worked out from
+    clock = FakeClock(START)
+    redis = StandinRedis(clock=clock)
+    writer = BatchWriter(redis, ttl_ms=args.ttl_minutes * 60 * 1000, clock=clock)
+    buckets = TradeBuckets(redis, retention=args.ttl_minutes * 60, clock=clock)
+    root = args.path or tempfile.mkdtemp(prefix='tiering-')
+    # The worker caps its horizon at half the TTL it reads from here
+    stub = SsmStub(dict(PARAMETERS, **{f'/hcache/{TRADES_SETTING}': str(args.ttl_minutes)})).start()
+    settings = ParameterCache(client=stub_client(stub), background=False)
+    tiering = TradeTiering(redis, root, horizon=args.horizon_minutes * 60, settings=settings,
+                           segment_rows=args.segment_rows, clock=time.monotonic)
+    interval = int(args.interval_minutes * 60)
+
+    def run():
+        redis.stats = Stats()
+        stats = tiering.run(time_budget=float('inf'))
+        stats.update(redis.stats.as_dict())
+        runs.append(stats)
+
+    trades, runs = [], []
+    try:
+        for second, batch in generate(args.trades_per_second, args.minutes):
+            clock.now = START + second
+            if args.layout == 'buckets':
+                buckets.write((FEED, trade['symbol'], trade) for trade in batch)
+            else:
+                for trade in batch:
+                    writer.write_trade(FEED, trade['symbol'], trade)
+                writer.flush()
+            trades.extend(batch)
+            if second and second % interval == 0:
+                run()
+        # Then until everything left has been tiered
+        while redis.data:
+            clock.now = START + ((clock.now - START) // interval + 1) * interval
+            run()
+        archived = check(root, trades)
+        segment_bytes = sum(r['bytes'] for r in runs)
+    finally:
+        stub.shutdown()
+        if not args.path:
+            shutil.rmtree(root, ignore_errors=True)
+
+    raw_bytes = sum(len(msgpack.packb(t, use_bin_type=True)) for t in trades)
+    hcache_bytes = sum(len(default_codec.encode(t)) for t in trades)
+    busy = [r for r in runs if r['rows']]
+    print(json.dumps({
+        'layout': args.layout,
+        'trades': len(trades),
+        'archived': archived,
+        'runs': len(runs),
+        'segments': sum(r['segments'] for r in runs),
+        'bytes_per_trade': {
+            'msgpack': round(raw_bytes / len(trades), 1),
+            'hcache': round(hcache_bytes / len(trades), 1),
+            'segment': round(segment_bytes / len(trades), 1),
+        },
+        'compression_vs_msgpack': round(raw_bytes / segment_bytes, 2),
+        'run_seconds': {
+            'mean': round(sum(r['seconds'] for r in busy) / len(busy), 3),
+            'max': max(r['seconds'] for r in busy),
+        },
+        'per_run': busy[:3],
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
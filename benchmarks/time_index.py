@@ -0,0 +1,207 @@
+"""
+Range query latency over a trade archive: hcache.time_index against scanning whole segment files
+
+Builds an archive of segments under --path laid out as the tiering worker writes it (a segment per symbol per 10
+minutes, --trades-per-second per symbol) until it holds --gib, then times random --window-seconds queries for one
+symbol three ways:
+
+    index           time_index.query: hour partitions, segment names, then the mmap'ed index to the row groups
+    partition_scan  every segment of the hour partitions in range, read and decoded whole
+    full_scan       every segment of the symbol, read and decoded whole
+
+Every way has to return the same trades. With --cold the page cache is dropped for the archive before each query
+(posix_fadvise, as in efs_io.py), which is closer to reading over NFS. An existing archive in --path is reused, so
+the build is only paid once:
+
+    python benchmarks/time_index.py --path /tmp/archive --gib 4 --cold
+"""
+import argparse
+import bisect
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdk_lambda_vpc', 'lambda'))
+
+from hcache.segment import TIMESTAMP, SegmentReader, partition_dir, segment_paths, write_columns
+from hcache.time_index import HOUR, query, segments_in_range, write_index
+
+FEED = 'COINBASE'
+SYMBOLS = ['BTC-USD', 'ETH-USD', 'SOL-USD', 'ADA-USD', 'DOGE-USD', 'LTC-USD', 'XRP-USD', 'DOT-USD']
+START = 1622505600.0
+SEGMENT_SECONDS = 600
+GIB = 1024 ** 3
+
+
+def archive_bytes(root):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+
+
+def build(root, gib, trades_per_second, seed=1):
+    """
+    Write segments hour by hour until the archive holds gib, returns the hours written
+    """
+    rng = random.Random(seed)
+    n = trades_per_second * SEGMENT_SECONDS
+    # One pattern of trades per symbol, shifted along for each segment - generating every trade would take longer
+    # than the queries
+    patterns = {}
+    for s, symbol in enumerate(SYMBOLS):
+        price = 100.0 * (s + 1)
+        prices = array('d')
+        for _ in range(n):
+            price = round(price * (1 + rng.gauss(0, 0.0002)), 2)
+            prices.append(price)
+        patterns[symbol] = {
+            'offsets': array('d', sorted(rng.random() * SEGMENT_SECONDS for _ in range(n))),
+            'amount': array('d', (round(rng.expovariate(2), 8) for _ in range(n))),
+            'price': prices,
+            'side': [rng.choice(['buy', 'sell']) for _ in range(n)],
+        }
+
+    hours, next_id = 0, 0
+    while archive_bytes(root) < gib * GIB:
+        for start in range(0, HOUR, SEGMENT_SECONDS):
+            segment_start = START + hours * HOUR + start
+            for symbol in SYMBOLS:
+                pattern = patterns[symbol]
+                columns = {
+                    TIMESTAMP: array('d', (segment_start + offset for offset in pattern['offsets'])),
+                    'amount': pattern['amount'],
+                    'id': array('q', range(next_id, next_id + n)),
+                    'price': pattern['price'],
+                    'side': pattern['side'],
+                }
+                next_id += n
+                path = write_columns(partition_dir(root, FEED, symbol, segment_start), columns,
+                                     {'feed': FEED, 'symbol': symbol})
+                write_index(path)
+        hours += 1
+    return hours
+
+
+def archive_hours(root):
+    paths = segment_paths(root, FEED, SYMBOLS[0])
+    with SegmentReader(paths[-1]) as last:
+        end = last.row_groups[-1]['max_ts']
+    return int(math.ceil((end - START) / HOUR))
+
+
+def evict(root):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for directory, _, files in os.walk(root):
+        for name in files:
+            fd = os.open(os.path.join(directory, name), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def scan(paths, start, end, stats):
+    """
+    Trades in [start, end) from reading and decoding every one of paths in full
+    """
+    rows = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        stats['bytes_read'] += len(data)
+        with SegmentReader(path) as segment:
+            for n, group in enumerate(segment.row_groups):
+                values = segment.read_columns(n, data=data[group['offset']:group['offset'] + group['length']])
+                timestamps = values[TIMESTAMP]
+                lo, hi = bisect.bisect_left(timestamps, start), bisect.bisect_left(timestamps, end)
+                names = list(values)
+                for row in zip(*(values[k][lo:hi] for k in names)):
+                    record = dict(segment.partition)
+                    record.update(zip(names, row))
+                    rows.append(record)
+    rows.sort(key=lambda row: row[TIMESTAMP])
+    return rows
+
+
+def run_query(method, root, symbol, start, end):
+    stats = {'bytes_read': 0}
+    began = time.perf_counter()
+    if method == 'index':
+        rows = list(query(root, FEED, symbol, start, end, stats=stats))
+    elif method == 'partition_scan':
+        rows = scan(segments_in_range(root, FEED, symbol, start - SEGMENT_SECONDS, end + SEGMENT_SECONDS), start,
+                    end, stats)
+    else:
+        rows = scan(segment_paths(root, FEED, symbol), start, end, stats)
+    return time.perf_counter() - began, stats['bytes_read'], rows
+
+
+def summary(times, bytes_read, rows):
+    ms = sorted(t * 1000 for t in times)
+    return {
+        'queries': len(ms),
+        'latency_ms': {
+            'p50': round(statistics.median(ms), 3),
+            'p99': round(ms[min(len(ms) - 1, int(len(ms) * 0.99))], 3),
+            'max': round(ms[-1], 3),
+        },
+        'mib_read_per_query': round(sum(bytes_read) / len(bytes_read) / 1024 ** 2, 3),
+        'rows_per_query': round(sum(rows) / len(rows), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', default='/tmp/trade-archive', help='archive directory, reused if it has segments')
+    parser.add_argument('--gib', type=float, default=2, help='archive size to build')
+    parser.add_argument('--trades-per-second', type=int, default=200, help='per symbol, when building')
+    parser.add_argument('--window-seconds', type=float, default=300)
+    parser.add_argument('--queries', type=int, default=50, help='queries through the index')
+    parser.add_argument('--scan-queries', type=int, default=3, help='queries for each of the scans, which are slow')
+    parser.add_argument('--cold', action='store_true', help='drop the page cache before each query')
+    args = parser.parse_args()
+
+    began = time.perf_counter()
+    if segment_paths(args.path, FEED, SYMBOLS[0]):
+        hours = archive_hours(args.path)
+    else:
+        hours = build(args.path, args.gib, args.trades_per_second)
+    build_seconds = time.perf_counter() - began
+
+    rng = random.Random(2)
+    windows = [(rng.choice(SYMBOLS), START + rng.random() * (hours * HOUR - args.window_seconds))
+               for _ in range(args.queries)]
+    results, expected = {}, {}
+    for method, n in (('index', args.queries), ('partition_scan', args.scan_queries),
+                      ('full_scan', args.scan_queries)):
+        times, bytes_read, rows = [], [], []
+        for q, (symbol, start) in enumerate(windows[:n]):
+            if args.cold:
+                evict(args.path)
+            seconds, read, found = run_query(method, args.path, symbol, start, start + args.window_seconds)
+            if method == 'index':
+                expected[q] = found if q < args.scan_queries else None
+            elif found != expected[q]:
+                raise AssertionError(f'{method} and index disagree on query {q}')
+            times.append(seconds)
+            bytes_read.append(read)
+            rows.append(len(found))
+        results[method] = summary(times, bytes_read, rows)
+
+    print(json.dumps({
+        'archive_gib': round(archive_bytes(args.path) / GIB, 3),
+        'hours': hours,
+        'segments': len(segment_paths(args.path)),
+        'build_seconds': round(build_seconds, 1),
+        'window_seconds': args.window_seconds,
+        'cold': args.cold,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,36 @@
 from aws_cdk import core
 import aws_cdk.aws_ec2 as ec2
 from aws_cdk import aws_efs as efs
-from netaddr import IPNetwork
+from aws_cdk import aws_cloudwatch as cw
+from aws_cdk import aws_cloudwatch_actions as cw_actions
+from aws_cdk import aws_sns as sns
+
+from cdk_lambda_vpc import subnet_planner
+from cdk_lambda_vpc.efs_profile import EfsSettings
+from cdk_lambda_vpc.synth_report import MAX_RESOURCES
+from cdk_lambda_vpc.topology import subnets_in
+
+# Routes per nested stack, and the most combined-vpc keeps itself (see route_scope). A route is 8-9 resources, so 50
+# keep a nested template at ~450 of CloudFormation's 500. Routes up to this many are already deployed in
+# combined-vpc, so lowering it moves (and so replaces) deployed routes
+ROUTES_PER_NESTED_STACK = 50
+# EIP (unless preallocated), NAT gateway, subnet, route table, route, association and 3 NAT gateway alarms
+RESOURCES_PER_ROUTE = 9
+# Left free in combined-vpc for what comes after the routes: the dashboard and one resource per nested stack
+PARENT_RESERVED_RESOURCES = 10
+
+# Simultaneous connections a NAT gateway supports to each unique destination (IP, port, protocol). Egress traffic
+# mostly goes to one exchange endpoint, so all of a gateway's connections count against it
+NAT_CONNECTIONS_PER_DESTINATION = 55000
+# NAT gateways per dashboard graph, a graph holds at most 100 metrics and the headroom graph uses 2 per gateway
+NAT_GATEWAYS_PER_GRAPH = 50
 
 
 class CombinedStack(core.Stack):
 
     def __init__(self, scope: core.Construct, id: str, eip_list=[], ec2_whitelist_ips=[], ec2_key_name='',
-                 n_subnets=1, **kwargs) -> None:
+                 n_subnets=1, max_azs=2, nat_gateways_per_az=subnet_planner.NAT_GATEWAYS_PER_AZ,
+                 routes_per_stack=ROUTES_PER_NESTED_STACK, egress_azs=None, efs_settings=None, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
         self.vpc_cidr_start = '10.2.0.0'
@@ -17,10 +40,13 @@ class CombinedStack(core.Stack):
         self.ec2_whitelist_ips = ec2_whitelist_ips
         self.ec2_key_name = ec2_key_name
         self.n_subnets = n_subnets
+        self.routes_per_stack = routes_per_stack
+        # Performance / throughput modes of the EFS share, see efs_profile.choose()
+        self.efs_settings = efs_settings or EfsSettings()
 
         # create VPC
         self.vpc = ec2.Vpc(
-            self, 'cdk-vpc', cidr=self.vpc_cidr, nat_gateways=0, enable_dns_support=True, max_azs=2,
+            self, 'cdk-vpc', cidr=self.vpc_cidr, nat_gateways=0, enable_dns_support=True, max_azs=max_azs,
             subnet_configuration=[
                 ec2.SubnetConfiguration(
                     name='public-subnet',
@@ -35,20 +61,39 @@ class CombinedStack(core.Stack):
             ],
             enable_dns_hostnames=True)
 
-        # Get the starting IP after the 2x public and 2x isolated subnets created as part of the VPC cidr
-        self.next_cidr = str(IPNetwork(f'{self.vpc_cidr_start}/26').next(4)).split('/')[0]
+        # Egress subnets are packed after the public and isolated subnets the VPC creates in each AZ, one route
+        # per AZ in turn. The AZ list is rotated by one so route 0 stays in the second AZ, where the routes deployed
+        # before the planner put it. egress_azs narrows the routes down to some AZs, e.g. the hcache AZ
+        self.public_subnet_by_az = {s.availability_zone: s for s in self.vpc.public_subnets}
+        azs = self.vpc.availability_zones
+        for az in egress_azs or []:
+            subnets_in(self.vpc.public_subnets, az, 'public')
+        self.subnet_plan = subnet_planner.plan_egress_subnets(
+            self.vpc_cidr, egress_azs or azs[1:] + azs[:1], self.n_subnets,
+            reserved_tiers=[('public-subnet', 26), ('efs-subnet', 26)], egress_mask=26,
+            max_routes_per_az=nat_gateways_per_az, reserved_azs=azs
+        )
+        if len(self.pre_allocated_eips) not in (0, self.n_subnets):
+            raise ValueError(f'{self.n_subnets} egress routes but {len(self.pre_allocated_eips)} preallocated EIPs')
 
         self.subnet_id_to_subnet_map = {}
         self.route_table_id_to_route_table_map = {}
         self.security_group_id_to_group_map = {}
         self.instance_id_to_instance_map = {}
+        self.nat_gateway_id_to_nat_gateway_map = {}
+        self.route_stacks = []
+        self.parent_routes = None
 
         self.create_efs(self.vpc)
         self.create_mgmt_ec2()
 
+        self.egress_alarm_topic = sns.Topic(self, 'egress_alarm_topic', topic_name=f'{id}_egress_alarm_topic')
+
         for i in range(0, self.n_subnets):
             self.create_lambda_access_route(i)
 
+        self.create_nat_dashboard()
+
     def create_efs(self, vpc, id=1):
         # Create Security Group to connect to EFS
         self.efs_sg = ec2.SecurityGroup(
@@ -73,10 +118,10 @@ class CombinedStack(core.Stack):
             vpc=vpc,
             security_group=self.efs_sg,
             encrypted=False,
-            performance_mode=efs.PerformanceMode.GENERAL_PURPOSE,
-            throughput_mode=efs.ThroughputMode.BURSTING,
-            removal_policy=core.RemovalPolicy.DESTROY
+            removal_policy=core.RemovalPolicy.DESTROY,
+            **self.efs_settings.props()
         )
+        self.efs_settings.apply(self.efs_share)
 
         # Create EFS ACL
         efs_acl = efs.Acl(
@@ -100,6 +145,21 @@ class CombinedStack(core.Stack):
             posix_user=efs_user,
             create_acl=efs_acl
         )
+        # The root access point was what the lambda stack mounted, keep exporting it so that stack can be moved off
+        # it without combined-vpc removing an export still in use
+        self.export_value(self.efs_ap.access_point_id)
+
+        # What the Lambda functions mount. EFS creates /lambda with create_acl (owned by uid 1000) the first time
+        # it's mounted, so the functions can make their directories under it (cache, tiering) - / stays owned by
+        # root and needed them created by hand from the mgmt box
+        self.lambda_ap = efs.AccessPoint(
+            self,
+            "lambda-access-point",
+            path="/lambda",
+            file_system=self.efs_share,
+            posix_user=efs_user,
+            create_acl=efs_acl
+        )
 
     def create_mgmt_ec2(self):
         instance_name = "efs-mgmt-box"
@@ -142,42 +202,77 @@ class CombinedStack(core.Stack):
         mkdir efs/ && sudo mount -t efs fs-c590c371 efs/
         """
 
+    def count_parent_routes(self):
+        """
+        How many routes fit in this stack next to the resources it already has - the VPC's grow with its AZs -
+        keeping PARENT_RESERVED_RESOURCES free, at most routes_per_stack. It doesn't depend on n_subnets, so
+        growing the fleet doesn't change it
+        """
+        base = sum(1 for c in self.node.find_all() if isinstance(c, core.CfnResource) and core.Stack.of(c) is self)
+        per_route = RESOURCES_PER_ROUTE - (1 if self.pre_allocated_eips else 0)
+        fits = (MAX_RESOURCES - PARENT_RESERVED_RESOURCES - base) // per_route
+        return max(0, min(self.routes_per_stack, fits))
+
+    def route_scope(self, n):
+        """
+        The stack route n is created in. The first parent_routes routes (count_parent_routes) always stay in this
+        stack, and only the ones past them go in nested stacks of routes_per_stack routes each, which CloudFormation
+        creates and updates in parallel. Growing the fleet never moves a deployed route: a moved route is a new
+        resource with the same CIDR and EIP allocation as the old one, which CloudFormation creates first, so the
+        update would fail
+        """
+        if not self.routes_per_stack:
+            return self
+        if self.parent_routes is None:
+            self.parent_routes = self.count_parent_routes()
+        if n < self.parent_routes:
+            return self
+        shard = (n - self.parent_routes) // self.routes_per_stack
+        while len(self.route_stacks) <= shard:
+            first = self.parent_routes + len(self.route_stacks) * self.routes_per_stack
+            last = min(first + self.routes_per_stack, self.n_subnets) - 1
+            route_stack = core.NestedStack(self, f'egress-routes-{len(self.route_stacks)}')
+            route_stack.template_options.description = f'Egress routes {first}-{last}'
+            self.route_stacks.append(route_stack)
+        return self.route_stacks[shard]
+
     def create_lambda_access_route(self, n):
         """
         Create NAT gateway in public subnet using EIP from self.pre_allocated_eips[n]
         Create private subnet with route to NAT Gateway
 
         """
+        scope = self.route_scope(n)
 
-        cidr_mask_str = "/26"
-        # Round robin picking of public subnet (and AZ) by modulus on subnet n
-        target_subnet = self.vpc.select_subnets(subnet_type=ec2.SubnetType('PUBLIC')).subnets[n % 2 == 0]
+        # The NAT gateway goes in the public subnet in the route's own AZ
+        planned = self.subnet_plan.routes[n]
+        target_subnet = self.public_subnet_by_az[planned.az]
 
         # Create NAT Gateway
         nat_gateway_id = f'lambda_vpc_natgw_{n}'
         if len(self.pre_allocated_eips) > 0:
-            nat_gateway_instance = ec2.CfnNatGateway(self, id=nat_gateway_id,
+            nat_gateway_instance = ec2.CfnNatGateway(scope, id=nat_gateway_id,
                                                      subnet_id=target_subnet.subnet_id,
                                                      allocation_id=self.pre_allocated_eips[n])
         else:
-            eip = ec2.CfnEIP(self, id=f'lambda_vpc_eip_{n}')
-            nat_gateway_instance = ec2.CfnNatGateway(self, id=nat_gateway_id,
+            eip = ec2.CfnEIP(scope, id=f'lambda_vpc_eip_{n}')
+            nat_gateway_instance = ec2.CfnNatGateway(scope, id=nat_gateway_id,
                                                      subnet_id=target_subnet.subnet_id,
                                                      allocation_id=eip.attr_allocation_id)
+        self.nat_gateway_id_to_nat_gateway_map[nat_gateway_id] = nat_gateway_instance
 
         # Create private subnet
         subnet_id = f'lambda_vpc_private_{n}'
-        cidr = str(IPNetwork(f'{self.next_cidr}{cidr_mask_str}').next(n))
         self.subnet_id_to_subnet_map[subnet_id] = ec2.CfnSubnet(
-            self, subnet_id, vpc_id=self.vpc.vpc_id, cidr_block=cidr,
-            availability_zone=target_subnet.availability_zone, tags=[{'key': 'Name', 'value': subnet_id}],
+            scope, subnet_id, vpc_id=self.vpc.vpc_id, cidr_block=str(planned.cidr),
+            availability_zone=planned.az, tags=[{'key': 'Name', 'value': subnet_id}],
             map_public_ip_on_launch=False
         )
 
         # Create route table
         route_table_id = f'route_lambda_vpc_private_{n}'
         self.route_table_id_to_route_table_map[route_table_id] = ec2.CfnRouteTable(
-            self, route_table_id, vpc_id=self.vpc.vpc_id, tags=[{'key': 'Name', 'value': route_table_id}]
+            scope, route_table_id, vpc_id=self.vpc.vpc_id, tags=[{'key': 'Name', 'value': route_table_id}]
         )
 
         # Add route to table
@@ -186,10 +281,95 @@ class CombinedStack(core.Stack):
             'nat_gateway_id': nat_gateway_instance.ref,
             'route_table_id': self.route_table_id_to_route_table_map[route_table_id].ref,
         }
-        ec2.CfnRoute(self, f'{route_table_id}-route-{n}', **route_params)
+        ec2.CfnRoute(scope, f'{route_table_id}-route-{n}', **route_params)
 
         # Assign route to subnet
         ec2.CfnSubnetRouteTableAssociation(
-            self, f'{subnet_id}-{route_table_id}', subnet_id=self.subnet_id_to_subnet_map[subnet_id].ref,
+            scope, f'{subnet_id}-{route_table_id}', subnet_id=self.subnet_id_to_subnet_map[subnet_id].ref,
             route_table_id=self.route_table_id_to_route_table_map[route_table_id].ref
-        )
\ No newline at end of file
+        )
+
+        self.create_nat_alarms(scope, n, nat_gateway_instance)
+
+    def nat_metric(self, nat_gateway, metric_name, statistic='Sum', label=None):
+        return cw.Metric(
+            namespace="AWS/NATGateway",
+            metric_name=metric_name,
+            dimensions={
+                "NatGatewayId": nat_gateway.ref,
+            },
+            period=core.Duration.minutes(1),
+            statistic=statistic,
+            label=label
+        )
+
+    def nat_headroom(self, n, nat_gateway, label=None):
+        """
+        % of the gateway's connections to a single destination still free. When it runs low, new connections start
+        failing with ErrorPortAllocation - time to add egress routes
+        """
+        return cw.MathExpression(
+            # Ids are per gateway, several of these share the headroom graph
+            expression=f'100 * (1 - connections_{n} / {NAT_CONNECTIONS_PER_DESTINATION})',
+            using_metrics={f'connections_{n}': self.nat_metric(nat_gateway, 'ActiveConnectionCount', 'Maximum')},
+            label=label,
+            period=core.Duration.minutes(1)
+        )
+
+    def create_nat_alarms(self, scope, n, nat_gateway, min_headroom=20, max_dropped_packets=100):
+        """
+        Alarms on one NAT gateway, to egress_alarm_topic: any port allocation error, sustained packet drops, and
+        connection headroom under min_headroom %
+
+        """
+        def alarm(id, metric, threshold, comparison, datapoints=1, periods=1):
+            alarm = cw.Alarm(scope, id,
+                             alarm_name=f'{self.stack_name}-{id}',
+                             metric=metric,
+                             threshold=threshold,
+                             evaluation_periods=periods,
+                             datapoints_to_alarm=datapoints,
+                             comparison_operator=comparison,
+                             treat_missing_data=cw.TreatMissingData.NOT_BREACHING)
+            alarm.add_alarm_action(cw_actions.SnsAction(self.egress_alarm_topic))
+            return alarm
+
+        alarm(f'lambda_vpc_natgw_{n}_port_allocation_errors', self.nat_metric(nat_gateway, 'ErrorPortAllocation'), 0,
+              cw.ComparisonOperator.GREATER_THAN_THRESHOLD)
+        alarm(f'lambda_vpc_natgw_{n}_packets_dropped', self.nat_metric(nat_gateway, 'PacketsDropCount'),
+              max_dropped_packets, cw.ComparisonOperator.GREATER_THAN_THRESHOLD, datapoints=3, periods=5)
+        alarm(f'lambda_vpc_natgw_{n}_low_headroom', self.nat_headroom(n, nat_gateway), min_headroom,
+              cw.ComparisonOperator.LESS_THAN_THRESHOLD, datapoints=3, periods=5)
+
+    def create_nat_dashboard(self):
+        """
+        One graph per metric with a line per NAT gateway (split over several graphs for big fleets)
+
+        """
+        if not self.nat_gateway_id_to_nat_gateway_map:
+            return
+
+        dashboard = cw.Dashboard(self, 'egress-dashboard', dashboard_name=f'{self.stack_name}-egress')
+        gateways = [(n, id, nat) for n, (id, nat) in enumerate(self.nat_gateway_id_to_nat_gateway_map.items())]
+        for first in range(0, len(gateways), NAT_GATEWAYS_PER_GRAPH):
+            chunk = gateways[first:first + NAT_GATEWAYS_PER_GRAPH]
+            suffix = f' (routes {first}-{first + len(chunk) - 1})' if len(gateways) > NAT_GATEWAYS_PER_GRAPH else ''
+
+            def graph(title, metric_name, statistic='Sum'):
+                return cw.GraphWidget(
+                    title=title + suffix, width=8,
+                    left=[self.nat_metric(nat, metric_name, statistic, label=id) for _, id, nat in chunk]
+                )
+
+            dashboard.add_widgets(
+                cw.GraphWidget(title='Connection headroom %' + suffix, width=8,
+                               left=[self.nat_headroom(n, nat, label=id) for n, id, nat in chunk],
+                               left_y_axis=cw.YAxisProps(min=0, max=100)),
+                graph('Active connections', 'ActiveConnectionCount', 'Maximum'),
+                graph('Port allocation errors', 'ErrorPortAllocation'),
+            )
+            dashboard.add_widgets(
+                graph('Packets dropped', 'PacketsDropCount'),
+                graph('Bytes out to destination', 'BytesOutToDestination'),
+                graph('Bytes in from destination', 'BytesInFromDestination'),
+            )
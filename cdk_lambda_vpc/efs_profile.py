@@ -0,0 +1,139 @@
+"""
+EFS performance and throughput modes, chosen from the workload the file system is for
+
+Bursting throughput scales with the data stored: 50 MiB/s baseline per TiB, bursting to 100 MiB/s per TiB (at least
+100 MiB/s) while burst credits last. A small file system read by many Lambdas at once runs through its credits and is
+then held at the baseline - a few hundred KiB/s for a few GiB. So for a declared Workload, choose():
+
+    - stays bursting when the sustained read+write rate fits the baseline for its size
+    - goes elastic (pay per byte, scales with demand) when the load is spiky, peak well over the sustained rate
+    - goes provisioned for a steady rate over the baseline, with 20% headroom
+    - goes Max I/O for more clients / operations than General Purpose handles, as long as the workload isn't
+      latency sensitive (Max I/O has higher per-operation latency, and can't be elastic)
+
+Throughput mode can be changed on a deployed file system, performance mode can't - changing it replaces the file
+system, and everything stored on it with it.
+
+EfsSettings can also be set directly, when the choice is already made:
+
+    EfsSettings(throughput_mode='provisioned', provisioned_mibps=64)
+"""
+import math
+
+from aws_cdk import core
+from aws_cdk import aws_efs as efs
+
+PERFORMANCE_MODES = {
+    'general_purpose': efs.PerformanceMode.GENERAL_PURPOSE,
+    'max_io': efs.PerformanceMode.MAX_IO,
+}
+# CDK v1 has no ThroughputMode.ELASTIC, it is set on the CfnFileSystem instead (see EfsSettings.apply)
+THROUGHPUT_MODES = ('bursting', 'provisioned', 'elastic')
+
+BASELINE_MIBPS_PER_TIB = 50
+# Load counts as spiky when its peak is this many times its sustained rate
+SPIKY_PEAK_RATIO = 4
+PROVISIONED_HEADROOM = 1.2
+# Past these General Purpose becomes the limit (file operations per second across all clients, and clients)
+GENERAL_PURPOSE_MAX_OPS = 35000
+GENERAL_PURPOSE_MAX_CLIENTS = 1000
+
+
+class EfsSettingsError(ValueError):
+    pass
+
+
+class EfsSettings:
+
+    def __init__(self, performance_mode='general_purpose', throughput_mode='bursting', provisioned_mibps=None,
+                 reason=None):
+        if performance_mode not in PERFORMANCE_MODES:
+            raise EfsSettingsError(f'Unknown performance mode {performance_mode!r}, one of: '
+                                   f'{", ".join(PERFORMANCE_MODES)}')
+        if throughput_mode not in THROUGHPUT_MODES:
+            raise EfsSettingsError(f'Unknown throughput mode {throughput_mode!r}, one of: '
+                                   f'{", ".join(THROUGHPUT_MODES)}')
+        if (throughput_mode == 'provisioned') != (provisioned_mibps is not None):
+            raise EfsSettingsError('provisioned_mibps is set with, and only with, provisioned throughput')
+        if provisioned_mibps is not None and not 1 <= provisioned_mibps <= 3414:
+            raise EfsSettingsError(f'provisioned_mibps must be 1-3414, not {provisioned_mibps}')
+        if throughput_mode == 'elastic' and performance_mode == 'max_io':
+            raise EfsSettingsError('Elastic throughput is only available in general_purpose performance mode')
+
+        self.performance_mode = performance_mode
+        self.throughput_mode = throughput_mode
+        self.provisioned_mibps = provisioned_mibps
+        self.reason = reason
+
+    def props(self):
+        """
+        The efs.FileSystem keyword arguments for these settings
+        """
+        props = {'performance_mode': PERFORMANCE_MODES[self.performance_mode]}
+        if self.throughput_mode == 'provisioned':
+            props['throughput_mode'] = efs.ThroughputMode.PROVISIONED
+            props['provisioned_throughput_per_second'] = core.Size.mebibytes(self.provisioned_mibps)
+        else:
+            props['throughput_mode'] = efs.ThroughputMode.BURSTING
+        return props
+
+    def apply(self, file_system):
+        """
+        Settings the construct has no property for, on the file system created with props()
+        """
+        if self.throughput_mode == 'elastic':
+            file_system.node.default_child.throughput_mode = 'elastic'
+
+    def as_dict(self):
+        return {'performance_mode': self.performance_mode, 'throughput_mode': self.throughput_mode,
+                'provisioned_mibps': self.provisioned_mibps, 'reason': self.reason}
+
+
+class Workload:
+    """
+    What a file system is for: size_gib stored, the sustained and peak read+write MiB/s across all clients, how many
+    clients (Lambda containers, boxes) use it at once and their file operations per second all told
+    """
+
+    def __init__(self, size_gib, sustained_mibps, peak_mibps=None, clients=1, ops_per_second=0,
+                 latency_sensitive=True):
+        self.size_gib = size_gib
+        self.sustained_mibps = sustained_mibps
+        self.peak_mibps = peak_mibps if peak_mibps is not None else sustained_mibps
+        self.clients = clients
+        self.ops_per_second = ops_per_second
+        self.latency_sensitive = latency_sensitive
+
+    def baseline_mibps(self):
+        return self.size_gib / 1024 * BASELINE_MIBPS_PER_TIB
+
+
+def choose(workload):
+    """
+    EfsSettings for workload, see the module docstring
+    """
+    baseline = workload.baseline_mibps()
+    if workload.sustained_mibps <= baseline:
+        throughput_mode, provisioned_mibps = 'bursting', None
+        reason = f'{workload.sustained_mibps} MiB/s sustained fits the {baseline:.2f} MiB/s bursting baseline'
+    elif workload.peak_mibps >= workload.sustained_mibps * SPIKY_PEAK_RATIO:
+        throughput_mode, provisioned_mibps = 'elastic', None
+        reason = (f'{workload.peak_mibps} MiB/s peaks over {workload.sustained_mibps} MiB/s sustained, over the '
+                  f'{baseline:.2f} MiB/s bursting baseline')
+    else:
+        throughput_mode = 'provisioned'
+        provisioned_mibps = min(3414, math.ceil(workload.sustained_mibps * PROVISIONED_HEADROOM))
+        reason = f'{workload.sustained_mibps} MiB/s sustained, over the {baseline:.2f} MiB/s bursting baseline'
+
+    performance_mode = 'general_purpose'
+    too_busy = (workload.ops_per_second > GENERAL_PURPOSE_MAX_OPS or workload.clients > GENERAL_PURPOSE_MAX_CLIENTS)
+    if too_busy and not workload.latency_sensitive:
+        performance_mode = 'max_io'
+        reason += f', {workload.clients} clients / {workload.ops_per_second} ops/s need Max I/O'
+        if throughput_mode == 'elastic':
+            # Max I/O can't be elastic, provision for the peak instead
+            throughput_mode = 'provisioned'
+            provisioned_mibps = min(3414, math.ceil(workload.peak_mibps))
+            reason += ', provisioned for the peak as Max I/O can\'t be elastic'
+
+    return EfsSettings(performance_mode, throughput_mode, provisioned_mibps, reason)
@@ -2,6 +2,8 @@ from aws_cdk import core
 import aws_cdk.aws_ec2 as ec2
 from aws_cdk import aws_efs as efs
 
+from cdk_lambda_vpc.efs_profile import EfsSettings
+
 EC2_KEY_NAME = 'awspersonal'
 EC2_WHITELIST_IPS = [
     "82.24.204.83/32",
@@ -11,9 +13,12 @@ EC2_WHITELIST_IPS = [
 
 class EFSStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, efs_settings=None, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
+        # Performance / throughput modes of the EFS share, see efs_profile.choose()
+        self.efs_settings = efs_settings or EfsSettings()
+
         self.az = 'us-east-1b'
         self.vpc_cidr_start = '10.2.0.0'
         self.vpc_cidr = f'{self.vpc_cidr_start}/16'
@@ -73,10 +78,10 @@ class EFSStack(core.Stack):
             vpc=vpc,
             security_group=self.efs_sg,
             encrypted=False,
-            performance_mode=efs.PerformanceMode.GENERAL_PURPOSE,
-            throughput_mode=efs.ThroughputMode.BURSTING,
-            removal_policy=core.RemovalPolicy.DESTROY
+            removal_policy=core.RemovalPolicy.DESTROY,
+            **self.efs_settings.props()
         )
+        self.efs_settings.apply(self.efs_share)
 
         # Create EFS ACL
         efs_acl = efs.Acl(
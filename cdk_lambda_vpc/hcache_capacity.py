@@ -0,0 +1,86 @@
+"""
+The hcache capacity alarms and the autoscaler's role, shared by both RedisStacks (redis_stack and redis_stack_prod)
+so the two can't drift apart
+"""
+from aws_cdk import core
+from aws_cdk import aws_cloudwatch as cw
+from aws_cdk import aws_cloudwatch_actions as cw_actions
+from aws_cdk import aws_sns as sns
+from aws_cdk import aws_iam as iam
+
+
+def create_autoscaler_lambda_role(scope):
+    autoscaler_role = iam.Role(scope, 'autoscaler-role', role_name='autoscaler-role',
+                               assumed_by=iam.ServicePrincipal('lambda.amazonaws.com'))
+
+    elasticache_full_access_policy = iam.ManagedPolicy.from_aws_managed_policy_name('AmazonElastiCacheFullAccess')
+    lambda_policy = iam.ManagedPolicy.from_aws_managed_policy_name('service-role/AWSLambdaBasicExecutionRole')
+
+    autoscaler_role.add_managed_policy(elasticache_full_access_policy)
+    autoscaler_role.add_managed_policy(lambda_policy)
+
+    autoscaler_role.add_to_policy(iam.PolicyStatement(
+        actions=['cloudwatch:GetMetricStatistics'],
+        resources=['*']
+    ))
+    autoscaler_role.add_to_policy(iam.PolicyStatement(
+        actions=['ssm:GetParameter', 'ssm:PutParameter'],
+        resources=[core.Stack.of(scope).format_arn(service='ssm', resource='parameter',
+                                                   resource_name='hcache/autoscaler/last_scaled_at')]
+    ))
+
+    return autoscaler_role
+
+
+def create_autoscale_sns(scope):
+    """
+    https://axemind.medium.com/aws-cdk-python-lambda-cloudwatch-alarm-1dcc93bdbc8d
+
+    https://stackoverflow.com/a/63178997
+
+    """
+    capacity_topic = sns.Topic(scope, id='capacity_alarm_topic', topic_name='capacity_alarm_topic')
+
+    """
+    Percentage of the memory available for the cluster that is in use excluding memory used for overhead and COB.
+    This is calculated using used_memory-mem_not_counted_for_evict/maxmemory from Redis INFO.
+    """
+    alarm_scale_up = cw.Alarm(scope,
+                              'hcache_capacity_alarm_scale_up',
+                              alarm_name='hcache_capacity_alarm_scale_up',
+                              metric=cw.Metric(
+                                  namespace="AWS/ElastiCache",
+                                  metric_name="DatabaseMemoryUsageCountedForEvictPercentage",
+                                  dimensions={
+                                      "ReplicationGroupId": "hcache",
+                                  },
+                                  period=core.Duration.minutes(5),
+                                  statistic="Average"
+                              ),
+                              evaluation_periods=1,
+                              threshold=70,
+                              comparison_operator=cw.ComparisonOperator.GREATER_THAN_THRESHOLD
+                              )
+
+    alarm_scale_up.add_alarm_action(cw_actions.SnsAction(capacity_topic))
+
+    alarm_scale_down = cw.Alarm(scope,
+                                'hcache_capacity_alarm_scale_down',
+                                alarm_name='hcache_capacity_alarm_scale_down',
+                                metric=cw.Metric(
+                                    namespace="AWS/ElastiCache",
+                                    metric_name="DatabaseMemoryUsageCountedForEvictPercentage",
+                                    dimensions={
+                                        "ReplicationGroupId": "hcache",
+                                    },
+                                    period=core.Duration.minutes(5),
+                                    statistic="Average"
+                                ),
+                                evaluation_periods=1,
+                                threshold=10,
+                                comparison_operator=cw.ComparisonOperator.LESS_THAN_THRESHOLD
+                                )
+
+    alarm_scale_down.add_alarm_action(cw_actions.SnsAction(capacity_topic))
+
+    return capacity_topic
@@ -0,0 +1,203 @@
+"""
+Online resharding of the hcache replication group
+
+Invoked by the capacity alarms through capacity_alarm_topic, and every few minutes on a schedule - an alarm only
+notifies when it changes state, so a group that is still over the threshold after one scale out would otherwise
+never be looked at again.
+
+Each run reads the last few minutes of 1-minute memory usage and the group's shard count and status, and asks
+decide() what to do:
+
+    - nothing while the group is modifying, or within the cooldown of the last change
+    - scale out when memory is over scale_up_threshold, or forecast() says it will be by the time a reshard
+      started now would finish (forecast_lead), to enough shards to bring it to target (at least +1)
+    - scale in, one shard at a time, when memory is under scale_down_threshold and the group would still be at
+      or under target with a shard less - the gap between target and scale_up_threshold is the hysteresis
+    - always within [min_shards, max_shards]
+
+The time of the last change is kept in SSM (LAST_SCALED_PARAMETER), so cooldowns hold across containers.
+decide() is pure, benchmarks/autoscaler_sim.py replays recorded memory series through it.
+"""
+import json
+import math
+import os
+import time
+
+REPLICATION_GROUP_ID = os.environ.get('REPLICATION_GROUP_ID', 'hcache')
+LAST_SCALED_PARAMETER = os.environ.get('LAST_SCALED_PARAMETER', '/hcache/autoscaler/last_scaled_at')
+MEMORY_METRIC = 'DatabaseMemoryUsageCountedForEvictPercentage'
+
+
+class Policy:
+
+    def __init__(self, min_shards=1, max_shards=15, scale_up_threshold=70, scale_down_threshold=10, target=50,
+                 cooldown_up=10 * 60, cooldown_down=60 * 60, forecast_window=10 * 60, forecast_lead=15 * 60):
+        self.min_shards = min_shards
+        self.max_shards = max_shards
+        self.scale_up_threshold = scale_up_threshold
+        self.scale_down_threshold = scale_down_threshold
+        self.target = target
+        self.cooldown_up = cooldown_up
+        self.cooldown_down = cooldown_down
+        # Memory history the trend is fitted over, and how far ahead it's projected (about one reshard)
+        self.forecast_window = forecast_window
+        self.forecast_lead = forecast_lead
+
+        if not scale_down_threshold < target < scale_up_threshold:
+            raise ValueError('Need scale_down_threshold < target < scale_up_threshold')
+
+    @classmethod
+    def from_env(cls, env=os.environ):
+        return cls(
+            min_shards=int(env.get('MIN_SHARDS', 1)),
+            max_shards=int(env.get('MAX_SHARDS', 15)),
+            scale_up_threshold=float(env.get('SCALE_UP_THRESHOLD', 70)),
+            scale_down_threshold=float(env.get('SCALE_DOWN_THRESHOLD', 10)),
+            target=float(env.get('TARGET', 50)),
+            cooldown_up=float(env.get('COOLDOWN_UP_SECONDS', 10 * 60)),
+            cooldown_down=float(env.get('COOLDOWN_DOWN_SECONDS', 60 * 60)),
+            forecast_window=float(env.get('FORECAST_WINDOW_SECONDS', 10 * 60)),
+            forecast_lead=float(env.get('FORECAST_LEAD_SECONDS', 15 * 60)),
+        )
+
+
+def forecast(points, lead):
+    """
+    Least squares line through points [(time, memory %)], projected lead seconds past the last point.
+    None with fewer than 3 points or when memory isn't growing - a forecast is only used to scale out early
+    """
+    if len(points) < 3:
+        return None
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    var_t = sum((t - mean_t) ** 2 for t, _ in points)
+    if var_t == 0:
+        return None
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in points) / var_t
+    if slope <= 0:
+        return None
+    last_t = max(t for t, _ in points)
+    return mean_v + slope * (last_t + lead - mean_t)
+
+
+def decide(policy, shards, memory_pct, now, last_scaled_at=None, status='available', forecast_pct=None):
+    """
+    Returns (target shard count or None to do nothing, reason)
+    """
+    if status != 'available':
+        return None, f'group is {status}'
+    if memory_pct is None:
+        return None, 'no memory datapoint'
+
+    since_last = now - last_scaled_at if last_scaled_at is not None else math.inf
+
+    expected_pct = max(memory_pct, forecast_pct or 0)
+    if expected_pct > policy.scale_up_threshold or shards < policy.min_shards:
+        if since_last < policy.cooldown_up:
+            return None, f'scale out cooling down ({since_last:.0f}s since last change)'
+        target = max(shards + 1, math.ceil(shards * expected_pct / policy.target), policy.min_shards)
+        target = min(target, policy.max_shards)
+        if target <= shards:
+            return None, f'at max_shards ({policy.max_shards})'
+        if memory_pct > policy.scale_up_threshold:
+            return target, f'memory {memory_pct:.1f}% > {policy.scale_up_threshold}%'
+        return target, (f'memory {memory_pct:.1f}% forecast to reach {forecast_pct:.1f}% '
+                        f'> {policy.scale_up_threshold}%')
+
+    if memory_pct < policy.scale_down_threshold or shards > policy.max_shards:
+        if since_last < policy.cooldown_down:
+            return None, f'scale in cooling down ({since_last:.0f}s since last change)'
+        target = min(shards - 1, policy.max_shards)
+        if target < policy.min_shards:
+            return None, f'at min_shards ({policy.min_shards})'
+        projected = expected_pct * shards / target
+        if projected > policy.target:
+            return None, f'scale in would leave memory at {projected:.1f}% > target {policy.target}%'
+        return target, f'memory {memory_pct:.1f}% < {policy.scale_down_threshold}%'
+
+    return None, f'memory {memory_pct:.1f}% within thresholds'
+
+
+class ElastiCacheGroup:
+    """
+    The replication group as seen through the AWS APIs
+    """
+
+    def __init__(self, replication_group_id=REPLICATION_GROUP_ID, elasticache=None, cloudwatch=None, ssm=None):
+        import boto3
+
+        self.replication_group_id = replication_group_id
+        self.elasticache = elasticache or boto3.client('elasticache')
+        self.cloudwatch = cloudwatch or boto3.client('cloudwatch')
+        self.ssm = ssm or boto3.client('ssm')
+
+    def describe(self):
+        group = self.elasticache.describe_replication_groups(
+            ReplicationGroupId=self.replication_group_id)['ReplicationGroups'][0]
+        return group['Status'], [ng['NodeGroupId'] for ng in group['NodeGroups']]
+
+    def memory_series(self, now, lookback, period=60):
+        """
+        [(epoch seconds, max memory %)] at period resolution, oldest first
+        """
+        datapoints = self.cloudwatch.get_metric_statistics(
+            Namespace='AWS/ElastiCache',
+            MetricName=MEMORY_METRIC,
+            Dimensions=[{'Name': 'ReplicationGroupId', 'Value': self.replication_group_id}],
+            StartTime=now - lookback,
+            EndTime=now,
+            Period=period,
+            Statistics=['Maximum'],
+        )['Datapoints']
+        return sorted((d['Timestamp'].timestamp(), d['Maximum']) for d in datapoints)
+
+    def last_scaled_at(self):
+        try:
+            return float(self.ssm.get_parameter(Name=LAST_SCALED_PARAMETER)['Parameter']['Value'])
+        except self.ssm.exceptions.ParameterNotFound:
+            return None
+
+    def reshard(self, node_group_ids, target, now):
+        kwargs = {
+            'ReplicationGroupId': self.replication_group_id,
+            'NodeGroupCount': target,
+            'ApplyImmediately': True,
+        }
+        if target < len(node_group_ids):
+            kwargs['NodeGroupsToRetain'] = sorted(node_group_ids)[:target]
+        self.elasticache.modify_replication_group_shard_configuration(**kwargs)
+        self.ssm.put_parameter(Name=LAST_SCALED_PARAMETER, Value=str(now), Type='String', Overwrite=True)
+
+
+def run(group, policy, now=None):
+    now = now if now is not None else time.time()
+    status, node_group_ids = group.describe()
+    series = group.memory_series(now, lookback=policy.forecast_window)
+    memory_pct = series[-1][1] if series else None
+    forecast_pct = forecast(series, policy.forecast_lead)
+    target, reason = decide(policy, len(node_group_ids), memory_pct, now, group.last_scaled_at(), status,
+                            forecast_pct)
+
+    result = {
+        'replication_group_id': group.replication_group_id,
+        'status': status,
+        'shards': len(node_group_ids),
+        'memory_pct': memory_pct,
+        'forecast_pct': forecast_pct,
+        'target': target,
+        'reason': reason,
+    }
+    if target is not None:
+        group.reshard(node_group_ids, target, now)
+    print(json.dumps(result))
+    return result
+
+
+def handler(event, context):
+    # SNS alarm notifications and the schedule are handled the same way, the alarm only says "look now"
+    for record in event.get('Records', []):
+        alarm = json.loads(record['Sns']['Message'])
+        print(json.dumps({'alarm': alarm.get('AlarmName'), 'state': alarm.get('NewStateValue')}))
+
+    return run(ElastiCacheGroup(), Policy.from_env())
@@ -0,0 +1,45 @@
+"""
+Init vs invoke phase timing for a container
+
+Import this first in a handler module, call init_done() once the module has finished loading and wrap each
+invocation with invoked(). The first invocation of each container prints one JSON line with the init and first
+invoke timings, so cold starts can be filtered out of the logs with {$.cold_start = true}.
+
+Set COLD_START_BUDGET_MS to flag containers whose init + first invoke went over budget.
+"""
+import json
+import os
+import time
+
+BUDGET_MS = float(os.environ['COLD_START_BUDGET_MS']) if os.environ.get('COLD_START_BUDGET_MS') else None
+
+
+class ContainerTimer:
+
+    def __init__(self):
+        self.init_start = time.perf_counter()
+        self.init_ms = None
+        self.invocations = 0
+
+    def init_done(self):
+        self.init_ms = (time.perf_counter() - self.init_start) * 1000
+
+    def invoked(self, invoke_ms, function_name=None):
+        self.invocations += 1
+        if self.invocations > 1:
+            return None
+
+        report = {
+            'cold_start': True,
+            'function': function_name or os.environ.get('AWS_LAMBDA_FUNCTION_NAME'),
+            'init_ms': round(self.init_ms, 3) if self.init_ms is not None else None,
+            'first_invoke_ms': round(invoke_ms, 3),
+        }
+        if BUDGET_MS is not None:
+            report['budget_ms'] = BUDGET_MS
+            report['over_budget'] = (self.init_ms or 0) + invoke_ms > BUDGET_MS
+        print(json.dumps(report))
+        return report
+
+
+timer = ContainerTimer()
@@ -0,0 +1,85 @@
+"""
+Coordinator for the egress workers
+
+Each worker is pinned to one egress subnet, and so to one NAT gateway / EIP in the same AZ. A batch of outbound
+requests is split across every worker so per-IP rate limits on the remote end apply per worker rather than to the
+whole batch.
+
+Event:
+    {"requests": ["http://...", {"url": "http://...", "method": "POST", "headers": {...}, "body": "..."}]}
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ReadTimeoutError
+
+WORKER_FUNCTIONS = json.loads(os.environ.get('WORKER_FUNCTIONS', '[]'))
+# Set by LambdaStack, the workers' function timeout
+WORKER_TIMEOUT_SECONDS = int(os.environ.get('WORKER_TIMEOUT_SECONDS', 300))
+
+# A synchronous invoke holds the connection open for the worker's whole run, so the read timeout has to outlast it -
+# botocore's default 60s would give up on a slow batch and, with its automatic retries, invoke the worker again and
+# send the batch's requests twice. Nothing is retried, a failed invoke is reported instead
+lambda_client = boto3.client('lambda', config=Config(read_timeout=WORKER_TIMEOUT_SECONDS + 10,
+                                                     retries={'max_attempts': 0}))
+
+
+def shard(requests, n_shards):
+    """
+    Round robin requests over n_shards, returning (shard, [(index in batch, request)]) for each non-empty shard
+    """
+    shards = [[] for _ in range(n_shards)]
+    for i, request in enumerate(requests):
+        shards[i % n_shards].append((i, request))
+    return [(n, s) for n, s in enumerate(shards) if s]
+
+
+def invoke_worker(function_name, requests):
+    try:
+        response = lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps({'requests': requests}).encode()
+        )
+    except ReadTimeoutError:
+        # Not retried, the worker may well have sent some or all of the requests
+        raise TimeoutError(f'{function_name} did not answer within {WORKER_TIMEOUT_SECONDS + 10}s, '
+                           f'{len(requests)} requests may or may not have been sent')
+    payload = json.loads(response['Payload'].read())
+    if 'FunctionError' in response:
+        raise RuntimeError(f'{function_name} failed: {payload}')
+    return payload
+
+
+def dispatch(requests, workers):
+    """
+    Fan requests out over workers, returns results in the original request order plus per egress IP and per AZ
+    counts
+    """
+    if not workers:
+        raise ValueError('No egress workers configured')
+
+    shards = shard(requests, len(workers))
+    results = [None] * len(requests)
+    per_egress_ip = {}
+    per_az = {}
+
+    with ThreadPoolExecutor(max_workers=len(shards) or 1) as pool:
+        futures = [(s, pool.submit(invoke_worker, workers[n], [r for _, r in s])) for n, s in shards]
+        for s, future in futures:
+            payload = future.result()
+            egress_ip = payload['egress_ip']
+            per_egress_ip[egress_ip] = per_egress_ip.get(egress_ip, 0) + len(s)
+            az = payload.get('egress_az')
+            per_az[az] = per_az.get(az, 0) + len(s)
+            for (i, _), result in zip(s, payload['results']):
+                results[i] = dict(result, egress_ip=egress_ip)
+
+    return {'results': results, 'per_egress_ip': per_egress_ip, 'per_az': per_az}
+
+
+def handler(event, context):
+    return dispatch(event.get('requests', []), WORKER_FUNCTIONS)
@@ -0,0 +1,286 @@
+"""
+Read-through disk cache on the EFS share mounted at /mnt/efs
+
+Objects are stored under the sha256 of their key (objects/ab/abcdef...), written to a temp file and renamed into
+place so readers never see a partial object, and read back through mmap. Every hit bumps the object's mtime, which
+is what eviction orders by - atime isn't reliable over NFS - so the least recently used objects are removed first
+once the cache grows past max_bytes.
+
+Containers coordinate misses through O_EXCL lock files next to the object: only the container holding the lock
+fetches, the others wait for the object to appear. A lock older than lock_timeout is treated as abandoned.
+
+On Lambda /mnt/efs is CombinedStack's lambda access point, a directory owned by the functions' user, so root is
+created on first use.
+
+Nothing here is EFS specific, point root at any local directory to use it off Lambda:
+
+    cache = EfsCache('/tmp/cache', max_bytes=100 * 1024 * 1024)
+    with cache.get_or_fetch('http://example.com/ref.json', lambda key: requests.get(key).content) as data:
+        ...
+"""
+import contextlib
+import hashlib
+import mmap
+import os
+import time
+
+ROOT = os.environ.get('EFS_CACHE_ROOT', '/mnt/efs/cache')
+MAX_BYTES = int(os.environ.get('EFS_CACHE_MAX_BYTES', 1024 ** 3))
+LOCK_TIMEOUT_SECONDS = 60
+# How long the last directory scan is trusted for, other containers write to the same cache
+SCAN_INTERVAL_SECONDS = 60
+
+
+def content_key(data):
+    """
+    Key for content that is addressed by its own hash (reference data), rather than by where it came from
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class EfsCache:
+
+    def __init__(self, root=ROOT, max_bytes=MAX_BYTES, lock_timeout=LOCK_TIMEOUT_SECONDS,
+                 scan_interval=SCAN_INTERVAL_SECONDS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self.scan_interval = scan_interval
+        self.objects_dir = os.path.join(root, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self.total_bytes = None
+        self.last_scan = 0
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        digest = hashlib.sha256(key.encode() if isinstance(key, str) else key).hexdigest()
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    @contextlib.contextmanager
+    def open(self, key):
+        """
+        Yield a read-only mmap of the object for key (b'' for empty objects), raises KeyError on a miss
+        """
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+
+        with f:
+            self._touch(path)
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                yield b''
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                yield m
+
+    def get(self, key, read=bytes):
+        """
+        read(mmap of the object) for key, the object as bytes by default, or None on a miss. A read that decodes or
+        parses straight from the mmap saves copying the object first
+        """
+        data = self._read(key, read)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp = f'{path}.{os.getpid()}.{time.monotonic_ns()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        if self.total_bytes is not None:
+            self.total_bytes += len(data)
+        self._maybe_evict()
+        return path
+
+    @contextlib.contextmanager
+    def get_or_fetch(self, key, fetch, wait_timeout=None):
+        """
+        Read-through: yield the cached object for key, calling fetch(key) -> bytes on a miss.
+        Only one container fetches a given key at a time, the rest wait up to wait_timeout (lock_timeout by default)
+        """
+        deadline = time.monotonic() + (wait_timeout if wait_timeout is not None else self.lock_timeout)
+        with contextlib.ExitStack() as stack:
+            while True:
+                try:
+                    m = stack.enter_context(self.open(key))
+                    self.hits += 1
+                    break
+                except KeyError:
+                    pass
+
+                if self._acquire(key):
+                    try:
+                        # Another container may have put it and released the lock since the miss above
+                        if not self.contains(key):
+                            self.misses += 1
+                            self.put(key, fetch(key))
+                        else:
+                            self.hits += 1
+                    finally:
+                        self._release(key)
+                    m = stack.enter_context(self.open(key))
+                    break
+
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Timed out waiting for another container to fetch {key}')
+                time.sleep(0.05)
+
+            yield m
+
+    def get_or_fetch_many(self, keys, fetch_many, wait_timeout=None, read=bytes):
+        """
+        Batch read-through: returns {key: read(object)}, read as in get(). Misses this container holds the lock for
+        are passed to fetch_many(keys) -> {key: bytes} in one call, so they can be fetched concurrently. Keys another
+        container is already fetching are waited for, and fetched here if that container gives up. Keys fetch_many
+        leaves out are left out of the result.
+        """
+        results, owned, waiting = {}, [], []
+        for key in keys:
+            data = self._read(key, read)
+            if data is None and self._acquire(key):
+                # Another container may have put it and released the lock since the miss above
+                data = self._read(key, read)
+                if data is None:
+                    owned.append(key)
+                    continue
+                self._release(key)
+            if data is not None:
+                results[key] = data
+            else:
+                waiting.append(key)
+
+        fetched = {}
+        try:
+            fetched = fetch_many(owned) if owned else {}
+            for key, data in fetched.items():
+                self.put(key, data)
+                results[key] = read(data)
+        finally:
+            for key in owned:
+                self._release(key)
+
+        deadline = time.monotonic() + (wait_timeout if wait_timeout is not None else self.lock_timeout)
+        orphaned = []
+        for key in waiting:
+            while not self.contains(key) and self._locked(key) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            data = self._read(key, read)
+            if data is None:
+                orphaned.append(key)
+            else:
+                results[key] = data
+
+        self.hits += len(results) - len(fetched)
+        self.misses += len(owned) + len(orphaned)
+
+        if orphaned:
+            for key, data in fetch_many(orphaned).items():
+                self.put(key, data)
+                results[key] = read(data)
+
+        return results
+
+    def _read(self, key, read):
+        try:
+            with self.open(key) as m:
+                return read(m)
+        except KeyError:
+            return None
+
+    def evict(self):
+        """
+        Remove least recently used objects until the cache fits in max_bytes, returns bytes removed
+        """
+        entries = []
+        total = 0
+        now = time.time()
+        for shard in os.scandir(self.objects_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith('.tmp') or entry.name.endswith('.lock'):
+                    # Clean up after containers that died mid write
+                    if now - st.st_mtime > self.lock_timeout:
+                        self._unlink(entry.path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+
+        removed = 0
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total - removed <= self.max_bytes:
+                    break
+                if self._unlink(path):
+                    removed += size
+
+        self.total_bytes = total - removed
+        self.last_scan = time.monotonic()
+        return removed
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'total_bytes': self.total_bytes, 'max_bytes': self.max_bytes}
+
+    def _maybe_evict(self):
+        stale = time.monotonic() - self.last_scan > self.scan_interval
+        if self.total_bytes is None or stale or self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _lock_path(self, key):
+        return self.path(key) + '.lock'
+
+    def _acquire(self, key):
+        path = self._lock_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            if self._locked(key):
+                return False
+            # Abandoned lock, take it over
+            self._unlink(path)
+            return self._acquire(key)
+
+    def _locked(self, key):
+        try:
+            return time.time() - os.stat(self._lock_path(key)).st_mtime < self.lock_timeout
+        except FileNotFoundError:
+            return False
+
+    def _release(self, key):
+        self._unlink(self._lock_path(key))
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
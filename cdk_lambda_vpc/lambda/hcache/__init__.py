@@ -0,0 +1,3 @@
+"""
+Client code for the hcache Redis cluster (see RedisStack)
+"""
@@ -0,0 +1,145 @@
+"""
+Trades in time buckets: one sorted set per feed/symbol/bucket, so a time range read is a few keys on known shards
+
+The per-trade layout (trades:{feed:symbol}:id, hcache.writer) has no way to find a symbol's trades by time short of
+SCANning for its keys, which visits every shard, then GETting each one. Here a symbol's trades are kept in a sorted
+set per bucket_seconds of trade time, scored by the trade's timestamp in ms, with the bucket in the hash tag:
+
+    tbucket:{COINBASE:BTC-USD:1622541900}
+
+Everything in a bucket is in one slot, so a bucket is a single ZRANGEBYSCORE, and "the last 5 minutes" with 5
+minute buckets is at most two. Buckets of the same symbol hash to different slots and so spread over the shards as
+the cluster grows, rather than one hot symbol pinning one shard. Reads for several buckets or symbols go in one
+pipeline - one round trip per shard they touch.
+
+Members are the codec encoded trade, so writing the same trade twice stores it once. Each write sets the bucket's
+TTL to retention past the end of the bucket, so a bucket is dropped whole once its newest possible trade is older
+than retention (and hcache.tiering archives it whole just before).
+
+    buckets = TradeBuckets(redis, retention=30 * 60)
+    buckets.write([('COINBASE', 'BTC-USD', trade), ...])
+    trades = buckets.last('COINBASE', 'BTC-USD', 5 * 60)
+    by_symbol = buckets.ranges([('COINBASE', 'BTC-USD'), ('COINBASE', 'ETH-USD')], start, end)
+"""
+import math
+import time
+
+from hcache.codec import default_codec
+
+BUCKET_SECONDS = 300
+RETENTION_SECONDS = 30 * 60
+TIMESTAMP = 'timestamp'
+
+BUCKET_KEYS = 'tbucket:*'
+
+
+def bucket_key(feed, symbol, bucket):
+    """
+    Key of the bucket starting at bucket (seconds since the epoch)
+    """
+    return f'tbucket:{{{feed}:{symbol}:{bucket}}}'
+
+
+def parse_bucket_key(key):
+    """
+    (feed, symbol, bucket start) from a bucket key, None for anything else
+    """
+    if isinstance(key, bytes):
+        key = key.decode()
+    if not key.startswith('tbucket:{') or not key.endswith('}'):
+        return None
+    feed, _, rest = key[len('tbucket:{'):-1].partition(':')
+    symbol, _, bucket = rest.rpartition(':')
+    try:
+        return feed, symbol, int(bucket)
+    except ValueError:
+        return None
+
+
+class TradeBuckets:
+
+    def __init__(self, redis, bucket_seconds=BUCKET_SECONDS, retention=RETENTION_SECONDS, codec=default_codec,
+                 clock=time.time):
+        self.redis = redis
+        self.bucket_seconds = bucket_seconds
+        self.retention = retention
+        self.codec = codec
+        # Wall clock time, trade timestamps are compared with it
+        self.clock = clock
+
+    def bucket(self, ts):
+        return int(ts // self.bucket_seconds) * self.bucket_seconds
+
+    def keys(self, feed, symbol, start, end):
+        """
+        Keys of the buckets that hold [start, end), oldest first
+        """
+        first, last = self.bucket(start), self.bucket(end)
+        if last == end and end > first:
+            # end itself isn't in the range
+            last -= self.bucket_seconds
+        return [bucket_key(feed, symbol, b) for b in range(first, last + 1, self.bucket_seconds)]
+
+    def write(self, trades, pipe=None):
+        """
+        Add (feed, symbol, trade) records, each trade a dict with a TIMESTAMP in seconds. One ZADD and one PEXPIRE
+        per bucket, all in one pipeline unless pipe is passed in. Returns the number of buckets written to
+        """
+        buckets = {}
+        for feed, symbol, trade in trades:
+            ts = trade[TIMESTAMP]
+            bucket = self.bucket(ts)
+            members = buckets.setdefault((bucket_key(feed, symbol, bucket), bucket), {})
+            members[self.codec.encode(trade)] = int(ts * 1000)
+
+        now = self.clock()
+        target = pipe if pipe is not None else self.redis.pipeline(transaction=False)
+        for (key, bucket), members in buckets.items():
+            ttl_ms = int((bucket + self.bucket_seconds + self.retention - now) * 1000)
+            if ttl_ms <= 0:
+                # Already past retention
+                continue
+            target.zadd(key, members)
+            target.pexpire(key, ttl_ms)
+        if pipe is None:
+            target.execute()
+        return len(buckets)
+
+    def _queue_range(self, pipe, feed, symbol, start, end):
+        keys = self.keys(feed, symbol, start, end)
+        for key in keys:
+            pipe.zrangebyscore(key, int(math.floor(start * 1000)), f'({int(math.ceil(end * 1000))}')
+        return len(keys)
+
+    def _decode(self, results, start, end):
+        trades = []
+        for members in results:
+            trades.extend(self.codec.decode(m) for m in members)
+        # Scores are whole ms, the bounds are exact
+        return [t for t in trades if start <= t[TIMESTAMP] < end]
+
+    def range(self, feed, symbol, start, end):
+        """
+        feed/symbol trades with start <= timestamp < end (seconds), oldest first, in one pipeline
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        self._queue_range(pipe, feed, symbol, start, end)
+        return self._decode(pipe.execute(), start, end)
+
+    def ranges(self, symbols, start, end):
+        """
+        {(feed, symbol): trades} for each (feed, symbol) in symbols, all read in one pipeline
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        counts = [self._queue_range(pipe, feed, symbol, start, end) for feed, symbol in symbols]
+        results = pipe.execute()
+        trades, position = {}, 0
+        for (feed, symbol), count in zip(symbols, counts):
+            trades[(feed, symbol)] = self._decode(results[position:position + count], start, end)
+            position += count
+        return trades
+
+    def last(self, feed, symbol, seconds):
+        now = self.clock()
+        # A second over, for exchange clocks a little ahead of ours
+        return self.range(feed, symbol, now - seconds, now + 1)
@@ -0,0 +1,120 @@
+"""
+hcache cluster client for Lambda handlers, reused across warm invocations
+
+Building a cluster client runs CLUSTER SLOTS discovery and opens a connection per shard, so one client is kept per
+container (per connection string) and handed out on every call to get_cluster(). The slot map it discovered is
+kept with it: a MOVED patches the one slot (ASK is followed without touching the map), and the full map is only
+rediscovered after reinitialize_steps MOVED errors, i.e. when the cluster is actually being resharded.
+
+Connections are capped per node with a blocking pool: a burst of threads in one container waits up to
+POOL_TIMEOUT_SECONDS for a free connection instead of opening more, so connections to each shard stay bounded at
+max_connections x concurrent containers.
+
+redis-py's redis.cluster is used when it's available, otherwise redis-py-cluster (what the ingestion box has).
+
+    from hcache.client import get_cluster
+    redis = get_cluster()
+"""
+import functools
+import os
+import threading
+
+from hcache.config import settings
+
+MAX_CONNECTIONS_PER_NODE = int(os.environ.get('HCACHE_MAX_CONNECTIONS_PER_NODE', 8))
+POOL_TIMEOUT_SECONDS = 5
+SOCKET_TIMEOUT_SECONDS = 2
+# MOVED errors before the whole slot map is rediscovered rather than patched one slot at a time
+REINITIALIZE_STEPS = 25
+# Connections idle for longer than this (e.g. across a frozen container) are PINGed before reuse
+HEALTH_CHECK_INTERVAL_SECONDS = 30
+
+_clusters = {}
+_lock = threading.Lock()
+created = 0
+
+
+def parse_connection_string(connection_string):
+    host, _, port = connection_string.rpartition(':')
+    return host, int(port)
+
+
+def check_blocking_pool(pool, blocking_pool_class):
+    """
+    Raise if the client didn't take the blocking pool, the connection cap would then fail requests instead of making
+    them wait
+    """
+    if not isinstance(pool, blocking_pool_class):
+        raise TypeError(f'hcache client nodes got a {type(pool).__name__}, not a {blocking_pool_class.__name__}')
+
+
+def create_cluster(host, port, max_connections=MAX_CONNECTIONS_PER_NODE):
+    global created
+    created += 1
+
+    try:
+        from redis import BlockingConnectionPool
+        from redis.cluster import RedisCluster
+
+        # From a url: redis.cluster only builds the nodes' pools with connection_pool_class for a client made with
+        # from_url, given host/port it silently uses a plain ConnectionPool per node, which raises "Too many
+        # connections" rather than waiting for one
+        cluster = RedisCluster.from_url(
+            f'redis://{host}:{port}',
+            require_full_coverage=False,
+            reinitialize_steps=REINITIALIZE_STEPS,
+            connection_pool_class=functools.partial(BlockingConnectionPool, timeout=POOL_TIMEOUT_SECONDS),
+            max_connections=max_connections,
+            socket_timeout=SOCKET_TIMEOUT_SECONDS,
+            socket_connect_timeout=SOCKET_TIMEOUT_SECONDS,
+            socket_keepalive=True,
+            health_check_interval=HEALTH_CHECK_INTERVAL_SECONDS,
+        )
+        check_blocking_pool(cluster.get_default_node().redis_connection.connection_pool, BlockingConnectionPool)
+        return cluster
+    except ImportError:
+        from rediscluster import RedisCluster
+        from rediscluster.connection import ClusterBlockingConnectionPool
+
+        pool = ClusterBlockingConnectionPool(
+            startup_nodes=[{'host': host, 'port': port}],
+            skip_full_coverage_check=True,
+            max_connections=max_connections,
+            max_connections_per_node=True,
+            reinitialize_steps=REINITIALIZE_STEPS,
+            timeout=POOL_TIMEOUT_SECONDS,
+            socket_timeout=SOCKET_TIMEOUT_SECONDS,
+            socket_connect_timeout=SOCKET_TIMEOUT_SECONDS,
+            socket_keepalive=True,
+            health_check_interval=HEALTH_CHECK_INTERVAL_SECONDS,
+        )
+        return RedisCluster(connection_pool=pool)
+
+
+def get_cluster(connection_string=None, factory=create_cluster):
+    """
+    The container's client for connection_string (/hcache/connection_string from SSM by default)
+    """
+    connection_string = connection_string or settings.get('connection_string')
+    cluster = _clusters.get(connection_string)
+    if cluster is None:
+        with _lock:
+            cluster = _clusters.get(connection_string)
+            if cluster is None:
+                cluster = _clusters[connection_string] = factory(*parse_connection_string(connection_string))
+    return cluster
+
+
+def reset(connection_string=None):
+    """
+    Drop the cached client(s), e.g. after the cluster has been replaced. The next get_cluster() rediscovers
+    """
+    with _lock:
+        keys = [connection_string] if connection_string else list(_clusters)
+        for key in keys:
+            cluster = _clusters.pop(key, None)
+            if cluster is not None:
+                try:
+                    cluster.close()
+                except Exception:
+                    pass
@@ -0,0 +1,49 @@
+"""
+Compact record encoding for hcache values
+
+A record is msgpack encoded, then lz4 (block format) compressed when it is large enough for that to pay off.
+The first byte says which: RAW (msgpack) or LZ4 (msgpack, lz4 compressed). lz4 is optional - without it every
+record is written RAW, and reading an LZ4 record raises.
+"""
+import msgpack
+
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+RAW = b'\x00'
+LZ4 = b'\x01'
+
+# Below this msgpack is usually as small as it gets - lz4 adds a size header and the block overhead
+COMPRESS_MIN_BYTES = 256
+
+
+class Codec:
+
+    def __init__(self, compress=True, compress_min_bytes=COMPRESS_MIN_BYTES):
+        self.compress = compress and lz4_block is not None
+        self.compress_min_bytes = compress_min_bytes
+
+    def encode(self, record):
+        packed = msgpack.packb(record, use_bin_type=True)
+        if self.compress and len(packed) >= self.compress_min_bytes:
+            compressed = lz4_block.compress(packed, store_size=True)
+            if len(compressed) < len(packed):
+                return LZ4 + compressed
+        return RAW + packed
+
+    def decode(self, data):
+        if data is None:
+            return None
+        header, body = data[:1], data[1:]
+        if header == LZ4:
+            if lz4_block is None:
+                raise ValueError('Record is lz4 compressed but lz4 is not installed')
+            body = lz4_block.decompress(body)
+        elif header != RAW:
+            raise ValueError(f'Unknown record header {header!r}')
+        return msgpack.unpackb(body, raw=False)
+
+
+default_codec = Codec()
@@ -0,0 +1,139 @@
+"""
+/hcache/* settings from SSM, cached per container
+
+All parameters under the prefix are loaded with one paginated GetParametersByPath and kept in memory for ttl
+seconds. Only the very first load blocks; after that a stale read returns the cached value straight away and
+refreshes in a background thread (stale-while-revalidate). If a refresh fails the old values keep being served and
+the next attempt waits error_backoff seconds.
+
+    from hcache.config import settings
+    connection_string = settings.get('connection_string')
+    evict_after = settings.get_int('evict_trades_after_minutes', 30)
+
+Set SSM_ENDPOINT_URL to point the client at a local stub.
+"""
+import os
+import threading
+import time
+
+PREFIX = os.environ.get('HCACHE_SSM_PREFIX', '/hcache')
+TTL_SECONDS = float(os.environ.get('HCACHE_SSM_TTL_SECONDS', 60))
+ERROR_BACKOFF_SECONDS = 5
+
+
+def ssm_client():
+    import boto3
+    return boto3.client('ssm', endpoint_url=os.environ.get('SSM_ENDPOINT_URL') or None)
+
+
+class ParameterCache:
+
+    def __init__(self, prefix=PREFIX, ttl=TTL_SECONDS, error_backoff=ERROR_BACKOFF_SECONDS, client=None,
+                 clock=time.monotonic, background=True):
+        self.prefix = prefix.rstrip('/')
+        self.ttl = ttl
+        self.error_backoff = error_backoff
+        self.client = client
+        self.clock = clock
+        self.background = background
+
+        self.values = None
+        self.loaded_at = None
+        self.next_attempt_at = 0
+        self.last_error = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def load(self):
+        """
+        Fetch every parameter under the prefix, returns {name relative to the prefix: value}
+        """
+        if self.client is None:
+            self.client = ssm_client()
+
+        values = {}
+        paginator = self.client.get_paginator('get_parameters_by_path')
+        for page in paginator.paginate(Path=self.prefix, Recursive=True, WithDecryption=True):
+            for parameter in page['Parameters']:
+                values[parameter['Name'][len(self.prefix) + 1:]] = parameter['Value']
+        return values
+
+    def refresh(self):
+        """
+        Reload now, on failure keep serving the previous values. Returns True if the values were reloaded
+        """
+        try:
+            values = self.load()
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+                self.last_error = f'{type(e).__name__}: {e}'
+                self.next_attempt_at = self.clock() + self.error_backoff
+                self.refreshing = False
+            if self.values is None:
+                raise
+            return False
+
+        with self.lock:
+            self.values = values
+            self.loaded_at = self.clock()
+            self.refreshes += 1
+            self.last_error = None
+            self.refreshing = False
+        return True
+
+    def _values(self):
+        if self.values is None:
+            # Nothing to serve yet, block on the first load
+            self.misses += 1
+            self.refresh()
+            return self.values
+
+        now = self.clock()
+        if now - self.loaded_at < self.ttl:
+            self.hits += 1
+            return self.values
+
+        self.stale_hits += 1
+        start_refresh = False
+        with self.lock:
+            if not self.refreshing and now >= self.next_attempt_at:
+                self.refreshing = start_refresh = True
+
+        if start_refresh:
+            if self.background:
+                threading.Thread(target=self.refresh, daemon=True).start()
+            else:
+                self.refresh()
+        return self.values
+
+    def get(self, name, default=None):
+        return self._values().get(name, default)
+
+    def get_int(self, name, default=None):
+        value = self.get(name)
+        return int(value) if value is not None else default
+
+    def all(self):
+        return dict(self._values())
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'refreshes': self.refreshes,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'age_seconds': self.clock() - self.loaded_at if self.loaded_at is not None else None,
+        }
+
+
+# Shared by every invocation in this container
+settings = ParameterCache()
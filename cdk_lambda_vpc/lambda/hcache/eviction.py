@@ -0,0 +1,335 @@
+"""
+Eviction worker: enforces /hcache/evict_trades_after_minutes and /hcache/evict_orderbooks_after_minutes on what is
+already in hcache, a shard at a time, without KEYS or any long running command
+
+Writers only apply the settings to what they write from then on. Trades written without a TTL keep none, lowering a
+setting leaves everything written before with the old, longer TTL, and a book that stops getting updates is never
+trimmed again (hcache.orderbook trims on its own snapshots). Each run SCANs one shard, scan_count keys at a time,
+and per batch:
+
+    trades:{feed:symbol}:id, book:{feed:symbol}  PTTL; one without a TTL, or with more than retention left, is GET
+                                                 for its timestamp and UNLINKed if that is older than retention,
+                                                 otherwise PEXPIREd to when it will be
+    tbucket:{feed:symbol:bucket}                 ZREMRANGEBYSCORE of the trades older than retention (UNLINK if that
+                                                 is all of them), and the TTL brought down to retention past the end
+                                                 of the bucket if it is longer
+    book:{feed:symbol}:log, and its :snaps       XTRIM MINID up to the newest snapshot at or before the cut off, at
+                                                 most trim_limit entries a call, and ZREMRANGEBYSCORE of the older
+                                                 snapshots. A book with nothing since the cut off is UNLINKed
+
+That is at most three pipelines per batch (inspect, GET the keys that need a timestamp, apply), and no command is
+bigger than a bucket or trim_limit stream entries, so Redis is never busy with the worker for long. A run stops
+after time_budget seconds, or at the end of a pass over the shard, and the next run carries on from its SCAN cursor.
+
+The settings are read at the start of every run through hcache.config, so a changed parameter is enforced within
+its cache ttl, without a redeploy. Bytes reclaimed are MEMORY USAGE of each key before and after it is trimmed or
+unlinked, Redis' own estimate (sampled for big keys); a shortened TTL frees its memory when the key expires, and
+isn't counted. Trades past a lowered retention are evicted whether or not hcache.tiering has archived them, as the
+TTL would have - with a tiering horizon of at least a bucket, tiering gets to a bucket before its oldest trade is
+past retention.
+
+    worker = EvictionWorker(redis.Redis(host, port), shard='host:port')
+    stats = worker.run(time_budget=20)
+
+Run as a Lambda on a schedule with handler(), which runs a worker per primary of the cluster, in parallel. Each
+shard's worker, and so its cursor, is kept for the container; a cold start begins the shards' passes again.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hcache.buckets import BUCKET_SECONDS, parse_bucket_key
+from hcache.codec import default_codec
+from hcache.config import settings
+
+TRADES_SETTING = 'evict_trades_after_minutes'
+ORDERBOOKS_SETTING = 'evict_orderbooks_after_minutes'
+# What the settings default to in RedisStack
+TRADES_MINUTES = 30
+ORDERBOOKS_MINUTES = 5
+
+TIME_BUDGET_SECONDS = float(os.environ.get('EVICTION_TIME_BUDGET_SECONDS', 20))
+SCAN_COUNT = 100
+TRIM_LIMIT = 1000
+TIMESTAMP = 'timestamp'
+
+TRADE = 'trade'
+BOOK = 'book'
+BUCKET = 'bucket'
+BOOK_LOG = 'book_log'
+
+UNLINK = 'unlink'
+TRIM = 'trim'
+EXPIRE = 'expire'
+
+
+def key_kind(key):
+    """
+    TRADE, BOOK, BUCKET or BOOK_LOG, or None for a key the worker leaves alone (a book's :snaps is done with its log)
+    """
+    if isinstance(key, bytes):
+        key = key.decode(errors='replace')
+    if key.startswith('trades:{'):
+        return TRADE
+    if key.startswith('tbucket:{'):
+        return BUCKET if parse_bucket_key(key) else None
+    if key.startswith('book:{'):
+        if key.endswith('}'):
+            return BOOK
+        if key.endswith('}:log'):
+            return BOOK_LOG
+    return None
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _snaps_key(log_key):
+    return log_key[:-len(':log')] + (b':snaps' if isinstance(log_key, bytes) else ':snaps')
+
+
+def _entry_id(entry_id):
+    ms, _, seq = _text(entry_id).partition('-')
+    return int(ms), int(seq or 0)
+
+
+class EvictionWorker:
+
+    def __init__(self, redis, shard=None, settings=settings, codec=default_codec, scan_count=SCAN_COUNT,
+                 trim_limit=TRIM_LIMIT, bucket_seconds=BUCKET_SECONDS, clock=time.time, timer=time.monotonic):
+        # A client for the one shard, SCAN only sees its keys
+        self.redis = redis
+        self.shard = shard
+        self.settings = settings
+        self.codec = codec
+        self.scan_count = scan_count
+        self.trim_limit = trim_limit
+        self.bucket_seconds = bucket_seconds
+        # Wall clock time, trade and book timestamps are compared with it
+        self.clock = clock
+        self.timer = timer
+
+        self.cursor = 0
+        self.passes = 0
+
+    def retention(self):
+        """
+        (trades, order books) retention in ms, as the settings are now
+        """
+        return (self.settings.get_int(TRADES_SETTING, TRADES_MINUTES) * 60000,
+                self.settings.get_int(ORDERBOOKS_SETTING, ORDERBOOKS_MINUTES) * 60000)
+
+    def inspect(self, keys, now_ms, trades_ms, books_ms):
+        """
+        One pipeline for what the batch holds: [(key, kind, results)]
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        counts = []
+        for key, kind in keys:
+            if kind in (TRADE, BOOK):
+                pipe.pttl(key)
+                counts.append(1)
+            elif kind == BUCKET:
+                pipe.pttl(key)
+                pipe.zcard(key)
+                pipe.zcount(key, '-inf', f'({now_ms - trades_ms}')
+                counts.append(3)
+            else:
+                pipe.xrevrange(key, count=1)
+                pipe.xrange(key, count=1)
+                pipe.zrevrangebyscore(_snaps_key(key), now_ms - books_ms, '-inf', start=0, num=1)
+                counts.append(3)
+        results, position = pipe.execute(), 0
+        inspected = []
+        for (key, kind), count in zip(keys, counts):
+            inspected.append((key, kind, results[position:position + count]))
+            position += count
+        return inspected
+
+    def timestamps(self, keys):
+        """
+        {key: timestamp in ms, or None if it has none} for the string keys, in one pipeline of GETs
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+        found = {}
+        for key, value in zip(keys, pipe.execute()):
+            if value is None:
+                # Expired since it was inspected
+                continue
+            try:
+                found[key] = int(float(self.codec.decode(value)[TIMESTAMP]) * 1000)
+            except (ValueError, KeyError, TypeError):
+                found[key] = None
+        return found
+
+    def _unlink(self, pipe, ops, *keys):
+        for key in keys:
+            pipe.memory_usage(key)
+        pipe.unlink(*keys)
+        ops.append((UNLINK, len(keys), 1))
+
+    def _trim(self, pipe, ops, keys, commands):
+        for key in keys:
+            pipe.memory_usage(key)
+        for name, args, kwargs in commands:
+            getattr(pipe, name)(*args, **kwargs)
+        for key in keys:
+            pipe.memory_usage(key)
+        ops.append((TRIM, len(keys), len(commands)))
+
+    def _expire(self, pipe, ops, key, ttl_ms):
+        pipe.pexpire(key, ttl_ms)
+        ops.append((EXPIRE, 0, 1))
+
+    def evict(self, keys, trades_ms, books_ms, stats):
+        """
+        Enforce the retention (in ms) on one batch of keys from SCAN, adding what was done to stats
+        """
+        keys = [(key, key_kind(key)) for key in keys]
+        keys = [(key, kind) for key, kind in keys if kind is not None]
+        if not keys:
+            return
+        now_ms = int(self.clock() * 1000)
+
+        pipe = self.redis.pipeline(transaction=False)
+        ops = []
+        unchecked = {}
+        for key, kind, results in self.inspect(keys, now_ms, trades_ms, books_ms):
+            if kind in (TRADE, BOOK):
+                retention_ms = trades_ms if kind == TRADE else books_ms
+                pttl = results[0]
+                if pttl == -1 or pttl > retention_ms:
+                    unchecked[key] = (pttl, retention_ms)
+            elif kind == BUCKET:
+                pttl, card, older = results
+                ttl_ms = (parse_bucket_key(key)[2] + self.bucket_seconds) * 1000 + trades_ms - now_ms
+                if not card:
+                    continue
+                if older == card or ttl_ms <= 0:
+                    self._unlink(pipe, ops, key)
+                    continue
+                if older:
+                    self._trim(pipe, ops, [key], [('zremrangebyscore', (key, '-inf', f'({now_ms - trades_ms}'), {})])
+                if pttl == -1 or pttl > ttl_ms:
+                    self._expire(pipe, ops, key, ttl_ms)
+            else:
+                newest, oldest, snaps = results
+                if not newest:
+                    continue
+                snaps_key = _snaps_key(key)
+                if _entry_id(newest[0][0])[0] < now_ms - books_ms:
+                    # Nothing left in retention, a snapshot to build on included
+                    self._unlink(pipe, ops, key, snaps_key)
+                elif snaps and _entry_id(oldest[0][0]) < _entry_id(snaps[0]):
+                    snap_ms = _entry_id(snaps[0])[0]
+                    self._trim(pipe, ops, [key, snaps_key], [
+                        ('xtrim', (key,), {'minid': _text(snaps[0]), 'approximate': True, 'limit': self.trim_limit}),
+                        ('zremrangebyscore', (snaps_key, '-inf', f'({snap_ms}'), {}),
+                    ])
+
+        if unchecked:
+            for key, ts_ms in self.timestamps(list(unchecked)).items():
+                pttl, retention_ms = unchecked[key]
+                ttl_ms = retention_ms if ts_ms is None else ts_ms + retention_ms - now_ms
+                if ttl_ms <= 0:
+                    self._unlink(pipe, ops, key)
+                elif pttl == -1 or pttl > ttl_ms:
+                    self._expire(pipe, ops, key, ttl_ms)
+
+        if not ops:
+            return
+        results, position = pipe.execute(), 0
+        for op, n_keys, n_commands in ops:
+            if op == UNLINK:
+                stats['bytes_reclaimed'] += sum(r or 0 for r in results[position:position + n_keys])
+                stats['unlinked'] += results[position + n_keys]
+                position += n_keys + 1
+            elif op == TRIM:
+                before = sum(r or 0 for r in results[position:position + n_keys])
+                trimmed = results[position + n_keys:position + n_keys + n_commands]
+                after = sum(r or 0 for r in results[position + n_keys + n_commands:position + 2 * n_keys + n_commands])
+                stats['bytes_reclaimed'] += max(0, before - after)
+                stats['trimmed'] += sum(trimmed)
+                position += 2 * n_keys + n_commands
+            else:
+                stats['expiry_set'] += 1 if results[position] else 0
+                position += 1
+
+    def run(self, time_budget=TIME_BUDGET_SECONDS):
+        """
+        Carry on the pass over the shard until time_budget seconds are up or the pass is done. Returns the run's stats
+        """
+        started_at = self.timer()
+        trades_ms, books_ms = self.retention()
+        stats = {'shard': self.shard, 'evict_trades_after_minutes': trades_ms // 60000,
+                 'evict_orderbooks_after_minutes': books_ms // 60000, 'scanned': 0, 'batches': 0, 'trimmed': 0,
+                 'unlinked': 0, 'expiry_set': 0, 'bytes_reclaimed': 0, 'pass_complete': False}
+        while True:
+            cursor, keys = self.redis.scan(self.cursor, count=self.scan_count)
+            self.evict(keys, trades_ms, books_ms, stats)
+            # Only moved on once the batch is done, a batch that fails is retried on the next run
+            self.cursor = cursor
+            stats['scanned'] += len(keys)
+            stats['batches'] += 1
+            if not cursor:
+                stats['pass_complete'] = True
+                self.passes += 1
+                break
+            if self.timer() - started_at >= time_budget:
+                break
+        stats['seconds'] = round(self.timer() - started_at, 3)
+        return stats
+
+
+# shard name -> its EvictionWorker, kept across warm invocations for the SCAN cursors
+_workers = {}
+
+
+def shard_workers(cluster):
+    """
+    The container's worker for each primary of cluster, each with a client for just that shard
+    """
+    if hasattr(cluster, 'get_primaries'):
+        # redis-py's redis.cluster
+        nodes = [(node.name, lambda node=node: cluster.get_redis_connection(node)) for node in cluster.get_primaries()]
+    else:
+        # redis-py-cluster
+        from redis import Redis
+
+        from hcache.client import SOCKET_TIMEOUT_SECONDS
+
+        nodes = [(node['name'], lambda node=node: Redis(host=node['host'], port=node['port'],
+                                                        socket_timeout=SOCKET_TIMEOUT_SECONDS,
+                                                        socket_connect_timeout=SOCKET_TIMEOUT_SECONDS))
+                 for node in cluster.connection_pool.nodes.all_masters()]
+    for name, client in nodes:
+        if name not in _workers:
+            _workers[name] = EvictionWorker(client(), shard=name)
+    return [_workers[name] for name, _ in nodes]
+
+
+def handler(event, context):
+    from hcache.client import get_cluster
+    from structured_log import log
+
+    try:
+        workers = shard_workers(get_cluster())
+        with ThreadPoolExecutor(max_workers=max(1, len(workers))) as pool:
+            futures = [(worker, pool.submit(worker.run)) for worker in workers]
+        runs = []
+        for worker, future in futures:
+            try:
+                stats = future.result()
+            except Exception as e:
+                # The other shards carry on, this one retries its batch on the next run
+                log.error('eviction failed', shard=worker.shard, error=f'{type(e).__name__}: {e}')
+                continue
+            log.info('eviction', **stats)
+            runs.append(stats)
+        return {'shards': len(workers), 'failed': len(workers) - len(runs),
+                'bytes_reclaimed': sum(stats['bytes_reclaimed'] for stats in runs), 'runs': runs}
+    finally:
+        log.flush()
@@ -0,0 +1,205 @@
+"""
+Order book history as periodic snapshots plus price level deltas in a Redis stream
+
+Each book has a stream (book:{feed:symbol}:log) where every entry is either a full snapshot or the price levels
+that changed since the previous entry, and a sorted set (book:{feed:symbol}:snaps) of snapshot entry ids scored by
+timestamp. Both share the book's hash tag, so they sit on one shard. Entry ids are the book timestamp in ms, so
+XRANGE by time needs no extra index. A store picks up from the stream's last id the first time it writes a book, so
+a restarted writer's updates in (or before) the last entry's ms still get increasing ids.
+
+Rebuilding the book at time t is two round trips: the last snapshot at or before t from the sorted set, then
+XRANGE from that snapshot to t with the deltas applied on the client. With a snapshot every snapshot_interval
+seconds a rebuild replays at most that many seconds of deltas.
+
+Data older than retention is trimmed on every snapshot, keeping the snapshot the oldest retained delta builds on.
+XTRIM MINID needs Redis >= 6.2.
+
+    store = OrderBookStore(redis, retention=5 * 60)
+    store.update('COINBASE', 'BTC-USD', {'bid': {30000.0: 1.5}, 'ask': {30001.0: 0.2}}, timestamp)
+    book = store.book_at('COINBASE', 'BTC-USD', timestamp - 60)
+"""
+from hcache.codec import default_codec
+
+SNAPSHOT = b's'
+DELTA = b'd'
+SIDES = ('bid', 'ask')
+
+SNAPSHOT_INTERVAL_SECONDS = 10
+RETENTION_SECONDS = 5 * 60
+
+
+def log_key(feed, symbol):
+    return f'book:{{{feed}:{symbol}}}:log'
+
+
+def snaps_key(feed, symbol):
+    return f'book:{{{feed}:{symbol}}}:snaps'
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _id_ms(entry_id):
+    return int(_text(entry_id).split('-')[0])
+
+
+def diff(old, new):
+    """
+    Price levels that changed from book old to book new, as [side, price, size], size 0 for a removed level
+    """
+    changes = []
+    for side_n, side in enumerate(SIDES):
+        before, after = old.get(side, {}), new.get(side, {})
+        for price, size in after.items():
+            if before.get(price) != size:
+                changes.append([side_n, price, size])
+        for price in before:
+            if price not in after:
+                changes.append([side_n, price, 0])
+    return changes
+
+
+def apply(book, changes):
+    for side_n, price, size in changes:
+        levels = book[SIDES[side_n]]
+        if size:
+            levels[price] = size
+        else:
+            levels.pop(price, None)
+    return book
+
+
+def encode_book(book):
+    return {side: [[p, s] for p, s in book.get(side, {}).items()] for side in SIDES}
+
+
+def decode_book(data):
+    return {side: {p: s for p, s in data[side]} for side in SIDES}
+
+
+class BookState:
+
+    def __init__(self):
+        self.book = None
+        self.last_snapshot_ms = None
+        self.last_id = (0, 0)
+        # (timestamp ms, entry id) of the snapshots written by this store, oldest first
+        self.snapshots = []
+
+
+class OrderBookStore:
+
+    def __init__(self, redis, codec=default_codec, snapshot_interval=SNAPSHOT_INTERVAL_SECONDS,
+                 retention=RETENTION_SECONDS):
+        self.redis = redis
+        self.codec = codec
+        self.snapshot_interval_ms = int(snapshot_interval * 1000)
+        self.retention_ms = int(retention * 1000)
+        self.books = {}
+
+    def _state(self, feed, symbol):
+        state = self.books.get((feed, symbol))
+        if state is None:
+            state = self.books[(feed, symbol)] = BookState()
+            # Carry on from what a previous process wrote, XADD refuses an id at or below the stream's last one
+            last = self.redis.xrevrange(log_key(feed, symbol), count=1)
+            if last:
+                ms, seq = _text(last[0][0]).split('-')
+                state.last_id = (int(ms), int(seq))
+        return state
+
+    def _next_id(self, state, ts_ms):
+        # Ids must increase, updates in the same ms (or late ones) get the next sequence number
+        ms, seq = state.last_id
+        state.last_id = (ts_ms, 0) if ts_ms > ms else (ms, seq + 1)
+        return '%d-%d' % state.last_id
+
+    def update(self, feed, symbol, book, timestamp, pipe=None):
+        """
+        Record the full book as of timestamp (seconds), storing only what changed since the last update unless a
+        snapshot is due. Pass a pipeline to batch several updates, otherwise this is one round trip
+        """
+        state = self._state(feed, symbol)
+        ts_ms = int(timestamp * 1000)
+
+        if state.book is None or ts_ms - state.last_snapshot_ms >= self.snapshot_interval_ms:
+            self._snapshot(feed, symbol, state, book, ts_ms, pipe)
+        else:
+            changes = diff(state.book, book)
+            if changes:
+                self._write(feed, symbol, state, DELTA, changes, ts_ms, pipe)
+
+        state.book = {side: dict(book.get(side, {})) for side in SIDES}
+
+    def apply_delta(self, feed, symbol, changes, timestamp, pipe=None):
+        """
+        Record a delta ([side, price, size] with side 0 bid / 1 ask) from a feed that already sends them.
+        The book needs an initial update() to apply it to
+        """
+        state = self.books[(feed, symbol)]
+        ts_ms = int(timestamp * 1000)
+        apply(state.book, changes)
+        if ts_ms - state.last_snapshot_ms >= self.snapshot_interval_ms:
+            self._snapshot(feed, symbol, state, state.book, ts_ms, pipe)
+        else:
+            self._write(feed, symbol, state, DELTA, changes, ts_ms, pipe)
+
+    def _snapshot(self, feed, symbol, state, book, ts_ms, pipe):
+        entry_id = self._write(feed, symbol, state, SNAPSHOT, encode_book(book), ts_ms, pipe)
+        state.last_snapshot_ms = ts_ms
+        state.snapshots.append((ts_ms, entry_id))
+
+        # Keep the newest snapshot at or before the retention cut off, the deltas after it build on it
+        cutoff = ts_ms - self.retention_ms
+        keep_from = 0
+        for i, (snap_ms, _) in enumerate(state.snapshots):
+            if snap_ms <= cutoff:
+                keep_from = i
+        if keep_from:
+            min_ms, min_id = state.snapshots[keep_from]
+            del state.snapshots[:keep_from]
+            target = pipe if pipe is not None else self.redis.pipeline(transaction=False)
+            target.xtrim(log_key(feed, symbol), minid=min_id, approximate=False)
+            target.zremrangebyscore(snaps_key(feed, symbol), '-inf', f'({min_ms}')
+            if pipe is None:
+                target.execute()
+
+    def _write(self, feed, symbol, state, kind, payload, ts_ms, pipe):
+        entry_id = self._next_id(state, ts_ms)
+        target = pipe if pipe is not None else self.redis.pipeline(transaction=False)
+        target.xadd(log_key(feed, symbol), {kind: self.codec.encode(payload)}, id=entry_id)
+        if kind == SNAPSHOT:
+            target.zadd(snaps_key(feed, symbol), {entry_id: ts_ms})
+        if pipe is None:
+            target.execute()
+        return entry_id
+
+    def book_at(self, feed, symbol, timestamp):
+        """
+        The book as of timestamp (seconds), or None if there's no snapshot that old
+        """
+        ts_ms = int(timestamp * 1000)
+        snaps = self.redis.zrevrangebyscore(snaps_key(feed, symbol), ts_ms, '-inf', start=0, num=1)
+        if not snaps:
+            return None
+
+        entries = self.redis.xrange(log_key(feed, symbol), min=_text(snaps[0]), max=f'{ts_ms}-18446744073709551615')
+        book = None
+        for _, fields in entries:
+            fields = {k.encode() if isinstance(k, str) else k: v for k, v in fields.items()}
+            if SNAPSHOT in fields:
+                book = decode_book(self.codec.decode(fields[SNAPSHOT]))
+            elif book is not None:
+                apply(book, self.codec.decode(fields[DELTA]))
+        return book
+
+    def window(self, feed, symbol):
+        """
+        (oldest, newest) timestamp in seconds held for the book
+        """
+        first = self.redis.xrange(log_key(feed, symbol), count=1)
+        last = self.redis.xrevrange(log_key(feed, symbol), count=1)
+        if not first:
+            return None
+        return _id_ms(first[0][0]) / 1000, _id_ms(last[0][0]) / 1000
@@ -0,0 +1,292 @@
+"""
+Append-only columnar segment files for trades tiered out of hcache (see hcache.tiering)
+
+A segment holds the rows of one partition - one feed/symbol and one hour - sorted by timestamp and cut into row
+groups of up to row_group_rows. Like a Parquet file, each row group stores every column as its own chunk, and a
+footer at the end of the file describes the columns and where each row group and chunk is, so a reader fetches just
+the footer and then only the row groups and columns it wants:
+
+    MAGIC
+    row group 0: column chunk, column chunk, ...
+    row group 1: ...
+    footer (msgpack), footer length (uint32 LE), MAGIC
+
+A column's type is worked out from its values when the segment is written: i64 (all ints), f64 (ints and floats)
+or obj (anything else, msgpack). f64 chunks are stored byte stream split - the first byte of every value, then the
+second, and so on - as prices and timestamps that are close together then compress far better. Chunks are lz4
+compressed when that makes them smaller, with the same RAW/LZ4 header byte as hcache.codec. Partition columns
+(feed and symbol) are not stored, they are in the footer and the path and come back on every row.
+
+Segments are never modified: each one is written to a temporary file, fsync'ed and renamed into place, so readers
+never see a partial segment and a crashed writer leaves at most a .tmp file behind.
+
+    root/trades/feed=COINBASE/symbol=BTC-USD/date=2021-06-01/hour=10/<first ts ms>-<last ts ms>-<id>.seg
+
+pyarrow would do all of this, but it's far bigger than the rest of the Lambda package put together.
+"""
+import datetime
+import os
+import struct
+import uuid
+from array import array
+from urllib.parse import quote, unquote
+
+import msgpack
+
+from hcache.codec import LZ4, RAW, lz4_block
+
+MAGIC = b'HSEG1'
+FOOTER_LENGTH = struct.Struct('<I')
+VERSION = 1
+
+TIMESTAMP = 'timestamp'
+ROW_GROUP_ROWS = 16384
+SUFFIX = '.seg'
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def column_type(values):
+    if isinstance(values, array):
+        return 'f64' if values.typecode in 'fd' else 'i64'
+    types = {type(v) for v in values}
+    if types <= {int}:
+        if values and (min(values) < INT64_MIN or max(values) > INT64_MAX):
+            return 'obj'
+        return 'i64'
+    if types <= {int, float}:
+        return 'f64'
+    return 'obj'
+
+
+def _split(data, width):
+    return b''.join(data[i::width] for i in range(width))
+
+
+def _join(data, width):
+    n = len(data) // width
+    joined = bytearray(len(data))
+    for i in range(width):
+        joined[i::width] = data[i * n:(i + 1) * n]
+    return bytes(joined)
+
+
+def encode_column(kind, values, compress=True):
+    if kind == 'i64':
+        data = array('q', values).tobytes()
+    elif kind == 'f64':
+        data = _split(array('d', values).tobytes(), 8)
+    else:
+        data = msgpack.packb(values, use_bin_type=True)
+    if compress and lz4_block is not None:
+        compressed = lz4_block.compress(data, store_size=True)
+        if len(compressed) < len(data):
+            return LZ4 + compressed
+    return RAW + data
+
+
+def decode_column(kind, chunk):
+    header, data = chunk[:1], chunk[1:]
+    if header == LZ4:
+        if lz4_block is None:
+            raise ValueError('Column is lz4 compressed but lz4 is not installed')
+        data = lz4_block.decompress(data)
+    elif header != RAW:
+        raise ValueError(f'Unknown column header {header!r}')
+    if kind == 'i64':
+        return array('q', data).tolist()
+    if kind == 'f64':
+        return array('d', _join(data, 8)).tolist()
+    return msgpack.unpackb(data, raw=False)
+
+
+def partition_dir(root, feed, symbol, ts):
+    """
+    Directory of the segments for feed/symbol in the (UTC) hour holding ts, seconds since the epoch
+    """
+    hour = datetime.datetime.utcfromtimestamp(ts)
+    return os.path.join(root, 'trades', f'feed={quote(feed, safe="")}', f'symbol={quote(symbol, safe="")}',
+                        f'date={hour:%Y-%m-%d}', f'hour={hour:%H}')
+
+
+def parse_partition(path):
+    """
+    {'feed', 'symbol', 'date', 'hour'} from a segment's path
+    """
+    parts = {}
+    for part in os.path.dirname(os.path.abspath(path)).split(os.sep):
+        name, sep, value = part.partition('=')
+        if sep and name in ('feed', 'symbol', 'date', 'hour'):
+            parts[name] = unquote(value)
+    return parts
+
+
+def write_segment(directory, rows, partition, row_group_rows=ROW_GROUP_ROWS, compress=True):
+    """
+    Write rows (dicts, each with a numeric TIMESTAMP) as a new segment in directory, returns its path. partition is
+    {column: value} for the columns every row shares, which are left out of the file
+    """
+    rows = sorted(rows, key=lambda row: row[TIMESTAMP])
+    names = sorted({name for row in rows for name in row if name not in partition} - {TIMESTAMP})
+    columns = {TIMESTAMP: [row[TIMESTAMP] for row in rows]}
+    columns.update((name, [row.get(name) for row in rows]) for name in names)
+    return write_columns(directory, columns, partition, row_group_rows, compress)
+
+
+def write_columns(directory, columns, partition, row_group_rows=ROW_GROUP_ROWS, compress=True):
+    """
+    Write a new segment from {column: values}, the values lists or arrays of the same length, with TIMESTAMP first
+    and already in order. Returns its path
+    """
+    names = list(columns)
+    timestamps = columns[TIMESTAMP]
+    if names[0] != TIMESTAMP:
+        raise ValueError(f'{TIMESTAMP} has to be the first column')
+
+    os.makedirs(directory, exist_ok=True)
+    name = f'{int(timestamps[0] * 1000)}-{int(timestamps[-1] * 1000)}-{uuid.uuid4().hex[:12]}{SUFFIX}'
+    path = os.path.join(directory, name)
+    tmp_path = os.path.join(directory, f'.{name}.tmp')
+
+    kinds = [column_type(columns[column]) for column in names]
+    row_groups = []
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            offset = len(MAGIC)
+            for start in range(0, len(timestamps), row_group_rows):
+                end = min(start + row_group_rows, len(timestamps))
+                chunks = [encode_column(kind, columns[column][start:end], compress)
+                          for column, kind in zip(names, kinds)]
+                length = sum(len(chunk) for chunk in chunks)
+                row_groups.append({
+                    'offset': offset,
+                    'length': length,
+                    'rows': end - start,
+                    'min_ts': timestamps[start],
+                    'max_ts': timestamps[end - 1],
+                    'columns': [len(chunk) for chunk in chunks],
+                })
+                f.write(b''.join(chunks))
+                offset += length
+
+            footer = msgpack.packb({
+                'version': VERSION,
+                'columns': [[name, kind] for name, kind in zip(names, kinds)],
+                'partition': partition,
+                'rows': len(timestamps),
+                'row_groups': row_groups,
+            }, use_bin_type=True)
+            f.write(footer + FOOTER_LENGTH.pack(len(footer)) + MAGIC)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return path
+
+
+class SegmentReader:
+    """
+    Reads a segment's footer on open, then row groups on demand
+
+        with SegmentReader(path) as segment:
+            for row in segment.rows(columns=['timestamp', 'price']):
+                ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.footer = self.read_footer()
+        except BaseException:
+            self.file.close()
+            raise
+        self.columns = [name for name, _ in self.footer['columns']]
+        self.kinds = [kind for _, kind in self.footer['columns']]
+        self.partition = self.footer['partition']
+        self.row_groups = self.footer['row_groups']
+
+    def read_footer(self):
+        tail = len(MAGIC) + FOOTER_LENGTH.size
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        if size < len(MAGIC) + tail:
+            raise ValueError(f'{self.path} is too short to be a segment')
+        self.file.seek(size - tail)
+        end = self.file.read(tail)
+        if end[-len(MAGIC):] != MAGIC:
+            raise ValueError(f'{self.path} is not a segment')
+        length, = FOOTER_LENGTH.unpack(end[:FOOTER_LENGTH.size])
+        self.file.seek(size - tail - length)
+        footer = msgpack.unpackb(self.file.read(length), raw=False)
+        if footer['version'] != VERSION:
+            raise ValueError(f'{self.path} is segment version {footer["version"]}, not {VERSION}')
+        return footer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def rows_count(self):
+        return self.footer['rows']
+
+    def read_columns(self, n, columns=None, data=None):
+        """
+        {column: values} of row group n. data is the row group's bytes when the caller already has them
+        """
+        group = self.row_groups[n]
+        if data is None:
+            self.file.seek(group['offset'])
+            data = self.file.read(group['length'])
+        wanted = set(columns) if columns is not None else None
+        values = {}
+        position = 0
+        for name, kind, length in zip(self.columns, self.kinds, group['columns']):
+            if wanted is None or name in wanted:
+                values[name] = decode_column(kind, data[position:position + length])
+            position += length
+        return values
+
+    def row_group_rows(self, n, columns=None, data=None):
+        values = self.read_columns(n, columns, data)
+        names = list(values)
+        partition = {k: v for k, v in self.partition.items() if columns is None or k in columns}
+        for row in zip(*values.values()):
+            record = dict(partition)
+            record.update(zip(names, row))
+            yield record
+
+    def rows(self, columns=None):
+        """
+        Every row, in timestamp order, as a dict. columns limits the columns read
+        """
+        for n in range(len(self.row_groups)):
+            yield from self.row_group_rows(n, columns)
+
+
+def segment_paths(root, feed=None, symbol=None):
+    """
+    Every segment under root (for one feed and/or symbol), in path order
+    """
+    base = os.path.join(root, 'trades')
+    if feed is not None:
+        base = os.path.join(base, f'feed={quote(feed, safe="")}')
+        if symbol is not None:
+            base = os.path.join(base, f'symbol={quote(symbol, safe="")}')
+    paths = []
+    for directory, dirs, files in os.walk(base):
+        if feed is None and symbol is not None:
+            dirs[:] = [d for d in dirs if not d.startswith('symbol=') or d == f'symbol={quote(symbol, safe="")}']
+        dirs.sort()
+        paths.extend(os.path.join(directory, f) for f in sorted(files) if f.endswith(SUFFIX) and f[0] != '.')
+    return paths
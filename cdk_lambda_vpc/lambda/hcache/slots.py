@@ -0,0 +1,42 @@
+"""
+Redis Cluster key -> hash slot mapping (CRC16/XMODEM of the key, or of its {hash tag}, mod 16384)
+"""
+N_SLOTS = 16384
+
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[((crc >> 8) ^ b) & 0xFF]
+    return crc
+
+
+def hash_tag(key):
+    """
+    The part of the key that is hashed - the contents of the first non-empty {...}, otherwise the whole key
+    """
+    start = key.find(b'{')
+    if start != -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+def key_slot(key):
+    if isinstance(key, str):
+        key = key.encode()
+    return crc16(hash_tag(key)) % N_SLOTS
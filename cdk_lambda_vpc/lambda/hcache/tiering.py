@@ -0,0 +1,207 @@
+"""
+Tiering worker: copies trades out of hcache before they expire, into columnar segments on the EFS share
+
+Trades are written with a TTL of /hcache/evict_trades_after_minutes and are gone after that. Each run SCANs the
+trade keys (trades:{feed:symbol}:id, see hcache.writer) in batches of scan_count, asks for their PTTL in one
+pipeline, and GETs the ones due to expire within horizon seconds in another. Those trades are grouped by
+feed/symbol/hour and buffered until segment_rows are waiting, then written out as segments (hcache.segment), each
+with its time index (hcache.time_index), and the keys UNLINKed, so a trade is on disk before it leaves Redis and is
+only archived once. The horizon should cover the time between runs with room to spare - a key that expires before a
+run gets to it is lost - which takes at most that much off how long trades stay in hcache. It is capped at half of
+evict_trades_after_minutes, read at the start of every run, so trades always stay in hcache for at least half of
+it: a horizon as long as the TTL would archive and unlink every trade as soon as it is written. Every run writes a
+segment for each partition it found trades for, so the time between runs also sets the segment size: every 10
+minutes with a 15 minute horizon keeps them to a handful per symbol and hour, rather than the many small files EFS
+is slowest at.
+
+Trades in time buckets (tbucket:{feed:symbol:bucket}, hcache.buckets) are archived the same way, a whole bucket at
+a time: its TTL runs from the end of the bucket, so once it is within the horizon every trade in it is.
+
+A run stops starting new SCAN batches after time_budget seconds and writes out what it has, so the worker fits in a
+Lambda timeout; keys it didn't get to are picked up by the next run. A crash between writing a segment and
+unlinking its keys archives those trades a second time on the next run - readers should expect the odd duplicate
+trade id across segments.
+
+    tiering = TradeTiering(redis, '/mnt/efs/tiering', horizon=15 * 60)
+    stats = tiering.run(time_budget=50)
+
+Run as a Lambda on a schedule with handler(), which reads the connection string from SSM and writes under
+TIERING_ROOT.
+"""
+import itertools
+import os
+import time
+
+from hcache.buckets import BUCKET_KEYS, parse_bucket_key
+from hcache.codec import default_codec
+from hcache.config import settings
+from hcache.eviction import TRADES_MINUTES, TRADES_SETTING
+from hcache.segment import ROW_GROUP_ROWS, TIMESTAMP, partition_dir, write_segment
+from hcache.slots import key_slot
+from hcache.time_index import write_index
+
+ROOT = os.environ.get('TIERING_ROOT', '/mnt/efs/tiering')
+HORIZON_SECONDS = float(os.environ.get('TIERING_HORIZON_SECONDS', 15 * 60))
+TIME_BUDGET_SECONDS = float(os.environ.get('TIERING_TIME_BUDGET_SECONDS', 50))
+SCAN_COUNT = 1000
+SEGMENT_ROWS = 200000
+
+TRADE_KEYS = 'trades:*'
+
+
+def parse_trade_key(key):
+    """
+    (feed, symbol) from trades:{feed:symbol}:id or a bucket key, None for anything else
+    """
+    if isinstance(key, bytes):
+        key = key.decode()
+    if key.startswith('tbucket:'):
+        parsed = parse_bucket_key(key)
+        return parsed[:2] if parsed else None
+    start, end = key.find('{'), key.find('}')
+    if start == -1 or end < start:
+        return None
+    feed, sep, symbol = key[start + 1:end].partition(':')
+    return (feed, symbol) if sep else None
+
+
+class TradeTiering:
+
+    def __init__(self, redis, root=ROOT, horizon=HORIZON_SECONDS, settings=settings, codec=default_codec,
+                 scan_count=SCAN_COUNT, segment_rows=SEGMENT_ROWS, row_group_rows=ROW_GROUP_ROWS, clock=time.monotonic):
+        self.redis = redis
+        self.root = root
+        self.max_horizon_ms = int(horizon * 1000)
+        # Set for each run, see run_horizon()
+        self.horizon_ms = self.max_horizon_ms
+        self.settings = settings
+        self.codec = codec
+        self.scan_count = scan_count
+        self.segment_rows = segment_rows
+        self.row_group_rows = row_group_rows
+        self.clock = clock
+
+        # (feed, symbol, partition dir) -> [(key, trade)]
+        self.buffer = {}
+        self.buffered = 0
+
+    def run_horizon(self):
+        """
+        The horizon in ms, capped at half the trades' retention as the settings are now
+        """
+        retention_ms = self.settings.get_int(TRADES_SETTING, TRADES_MINUTES) * 60000
+        return min(self.max_horizon_ms, retention_ms // 2)
+
+    def due(self, keys):
+        """
+        The keys that expire within the horizon, with their encoded trades
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.pttl(key)
+        due = [key for key, pttl in zip(keys, pipe.execute()) if 0 <= pttl <= self.horizon_ms]
+        if not due:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for key in due:
+            if parse_bucket_key(key):
+                pipe.zrangebyscore(key, '-inf', '+inf')
+            else:
+                pipe.get(key)
+        # A key can expire between the two pipelines
+        return [(key, value if isinstance(value, list) else [value]) for key, value in zip(due, pipe.execute())
+                if value]
+
+    def add(self, keys, stats):
+        for key, values in self.due(keys):
+            feed_symbol = parse_trade_key(key)
+            if feed_symbol is None:
+                stats['skipped'] += len(values)
+                continue
+            feed, symbol = feed_symbol
+            for value in values:
+                try:
+                    trade = self.codec.decode(value)
+                    ts = float(trade[TIMESTAMP])
+                except (ValueError, KeyError, TypeError) as e:
+                    # Left to expire, it can't be partitioned
+                    stats['skipped'] += 1
+                    stats['last_error'] = f'{key!r}: {type(e).__name__}: {e}'
+                    continue
+                trade[TIMESTAMP] = ts
+                partition = (feed, symbol, partition_dir(self.root, feed, symbol, ts))
+                self.buffer.setdefault(partition, []).append((key, trade))
+                self.buffered += 1
+
+    def write(self, stats):
+        """
+        Write every buffered partition out as a segment, then unlink the keys that went into them
+        """
+        keys = set()
+        for (feed, symbol, directory), entries in sorted(self.buffer.items()):
+            path = write_segment(directory, [trade for _, trade in entries], {'feed': feed, 'symbol': symbol},
+                                 row_group_rows=self.row_group_rows)
+            stats['segments'] += 1
+            stats['rows'] += len(entries)
+            stats['bytes'] += os.path.getsize(path)
+            try:
+                write_index(path)
+            except OSError as e:
+                # The segment is safely written, queries read it through its footer instead
+                stats['unindexed'] += 1
+                stats['last_error'] = f'{path}: {type(e).__name__}: {e}'
+            keys.update(key for key, _ in entries)
+
+        # Only once every partition is written, as a bucket's trades can be in more than one. Keys of a slot go in
+        # the same UNLINK, a multi-key command can't span slots
+        by_slot = {}
+        for key in keys:
+            by_slot.setdefault(key_slot(key), []).append(key)
+        pipe = self.redis.pipeline(transaction=False)
+        for slot_keys in by_slot.values():
+            for start in range(0, len(slot_keys), self.scan_count):
+                pipe.unlink(*slot_keys[start:start + self.scan_count])
+        pipe.execute()
+        self.buffer = {}
+        self.buffered = 0
+
+    def run(self, time_budget=TIME_BUDGET_SECONDS):
+        """
+        One pass over the trade keys, or as much of it as fits in time_budget seconds. Returns the run's stats
+        """
+        started_at = self.clock()
+        self.horizon_ms = self.run_horizon()
+        stats = {'scanned': 0, 'skipped': 0, 'segments': 0, 'unindexed': 0, 'rows': 0, 'bytes': 0, 'complete': True,
+                 'horizon_seconds': self.horizon_ms / 1000, 'last_error': None}
+        batch = []
+        scans = (self.redis.scan_iter(match=match, count=self.scan_count) for match in (TRADE_KEYS, BUCKET_KEYS))
+        for key in itertools.chain.from_iterable(scans):
+            batch.append(key)
+            if len(batch) < self.scan_count:
+                continue
+            stats['scanned'] += len(batch)
+            self.add(batch, stats)
+            batch = []
+            if self.buffered >= self.segment_rows:
+                self.write(stats)
+            if self.clock() - started_at >= time_budget:
+                stats['complete'] = False
+                break
+        if batch:
+            stats['scanned'] += len(batch)
+            self.add(batch, stats)
+        self.write(stats)
+        stats['seconds'] = round(self.clock() - started_at, 3)
+        return stats
+
+
+def handler(event, context):
+    from hcache.client import get_cluster
+    from structured_log import log
+
+    try:
+        stats = TradeTiering(get_cluster()).run()
+        log.info('tiering', **stats)
+        return stats
+    finally:
+        log.flush()
@@ -0,0 +1,272 @@
+"""
+Time index over the trade segments on the EFS share, for range queries that read only the row groups they need
+
+Each segment (hcache.segment) gets an index file beside it, <segment>.idx: a short header with the segment's
+columns, then one fixed-width entry per row group in time order:
+
+    MAGIC, HEADER (schema length, entries, columns), schema (msgpack)
+    entry: min ts ms (int64), max ts ms (int64), offset (uint64), length (uint32), rows (uint32),
+           then each column chunk's length (uint32)
+
+The index is opened with mmap and binary searched on max ts, so finding the row groups of a time range touches a
+few pages of the index rather than the segment's footer, and every entry carries the byte range of each column
+chunk - a query reads only the row groups in range, and of those only the columns asked for, with one pread per
+contiguous run of chunks. Over NFS that is the difference between a few small reads and the whole file.
+
+query() goes from the time range to the hour partitions that can hold it, skips segments whose name (first and
+last ts) is out of range, and merges what is left in time order, as a generator:
+
+    for trade in query('/mnt/efs/tiering', 'COINBASE', 'BTC-USD', start, end, columns=['price', 'amount']):
+        ...
+
+A segment without an index (written before indexes were, or whose index write failed) is read through its footer
+instead.
+"""
+import bisect
+import heapq
+import math
+import mmap
+import os
+import struct
+
+import msgpack
+
+from hcache.segment import SUFFIX, TIMESTAMP, SegmentReader, decode_column, partition_dir
+
+MAGIC = b'HIDX1'
+HEADER = struct.Struct('<III')
+ENTRY = '<qqQII'
+INDEX_SUFFIX = '.idx'
+
+HOUR = 3600
+
+
+def index_path(segment_path):
+    return segment_path + INDEX_SUFFIX
+
+
+def entry_struct(n_columns):
+    return struct.Struct(ENTRY + 'I' * n_columns)
+
+
+def write_index(segment_path):
+    """
+    Write the index of a segment from its footer, returns the index path
+    """
+    with SegmentReader(segment_path) as segment:
+        schema = msgpack.packb({'columns': segment.footer['columns'], 'partition': segment.partition},
+                               use_bin_type=True)
+        entry = entry_struct(len(segment.columns))
+        entries = [entry.pack(math.floor(group['min_ts'] * 1000), math.ceil(group['max_ts'] * 1000),
+                              group['offset'], group['length'], group['rows'], *group['columns'])
+                   for group in segment.row_groups]
+
+    path = index_path(segment_path)
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, f'.{name}.tmp')
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC + HEADER.pack(len(schema), len(entries), len(segment.columns)) + schema + b''.join(entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return path
+
+
+class TimeIndex:
+    """
+    A segment's index, mapped into memory
+    """
+
+    def __init__(self, segment_path):
+        self.segment_path = segment_path
+        with open(index_path(segment_path), 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self.map[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'{index_path(segment_path)} is not a segment index')
+            schema_length, self.count, n_columns = HEADER.unpack_from(self.map, len(MAGIC))
+            start = len(MAGIC) + HEADER.size
+            schema = msgpack.unpackb(self.map[start:start + schema_length], raw=False)
+        except BaseException:
+            self.map.close()
+            raise
+        self.entries_at = start + schema_length
+        self.entry = entry_struct(n_columns)
+        self.columns = [name for name, _ in schema['columns']]
+        self.kinds = [kind for _, kind in schema['columns']]
+        self.partition = schema['partition']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, n):
+        """
+        (min ts ms, max ts ms, offset, length, rows, column lengths) of row group n
+        """
+        values = self.entry.unpack_from(self.map, self.entries_at + n * self.entry.size)
+        return values[:5] + (values[5:],)
+
+    def _max_ts(self, n):
+        return struct.unpack_from('<q', self.map, self.entries_at + n * self.entry.size + 8)[0]
+
+    def find(self, start_ms, end_ms):
+        """
+        Row groups that may hold rows in [start_ms, end_ms), in order: a binary search for the first whose max ts
+        reaches start_ms, then on until one starts at or after end_ms
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._max_ts(mid) < start_ms:
+                lo = mid + 1
+            else:
+                hi = mid
+        for n in range(lo, self.count):
+            entry = self[n]
+            if entry[0] >= end_ms:
+                break
+            yield entry
+
+
+def _ranges(offset, lengths, wanted):
+    """
+    [offset, length, [(column n, offset in the read, length)]] for each contiguous run of wanted column chunks
+    """
+    ranges = []
+    position = offset
+    for n, length in enumerate(lengths):
+        if n in wanted:
+            if ranges and ranges[-1][0] + ranges[-1][1] == position:
+                ranges[-1][1] += length
+            else:
+                ranges.append([position, length, []])
+            ranges[-1][2].append((n, position - ranges[-1][0], length))
+        position += length
+    return ranges
+
+
+class IndexedSegment:
+    """
+    Range reads of one segment through its TimeIndex
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = TimeIndex(path)
+        try:
+            self.fd = os.open(path, os.O_RDONLY)
+        except BaseException:
+            self.index.close()
+            raise
+        self.bytes_read = 0
+
+    def close(self):
+        os.close(self.fd)
+        self.index.close()
+
+    def rows(self, start, end, columns=None):
+        """
+        Rows with start <= timestamp < end (seconds), in time order. columns limits the columns read, the timestamp
+        is always read
+        """
+        index = self.index
+        names = index.columns
+        wanted = set(range(len(names))) if columns is None else {n for n, name in enumerate(names)
+                                                                 if name in columns or name == TIMESTAMP}
+        partition = {k: v for k, v in index.partition.items() if columns is None or k in columns}
+        for _, _, offset, _, _, lengths in index.find(math.floor(start * 1000), math.ceil(end * 1000)):
+            values = {}
+            for range_offset, length, chunks in _ranges(offset, lengths, wanted):
+                data = os.pread(self.fd, length, range_offset)
+                self.bytes_read += length
+                for n, at, chunk_length in chunks:
+                    values[names[n]] = decode_column(index.kinds[n], data[at:at + chunk_length])
+            timestamps = values[TIMESTAMP]
+            lo, hi = bisect.bisect_left(timestamps, start), bisect.bisect_left(timestamps, end)
+            keys = list(values)
+            for row in zip(*(values[k][lo:hi] for k in keys)):
+                record = dict(partition)
+                record.update(zip(keys, row))
+                yield record
+
+
+def _segment_rows(path, start, end, columns, stats):
+    """
+    Rows of one segment in range, through its index when it has one, otherwise its footer
+    """
+    try:
+        segment = IndexedSegment(path)
+    except FileNotFoundError:
+        segment = None
+    if segment is not None:
+        try:
+            yield from segment.rows(start, end, columns)
+        finally:
+            stats['bytes_read'] += segment.bytes_read
+            segment.close()
+        return
+
+    with SegmentReader(path) as reader:
+        stats['unindexed'] += 1
+        wanted = None if columns is None else set(columns) | {TIMESTAMP}
+        for n, group in enumerate(reader.row_groups):
+            if group['max_ts'] < start or group['min_ts'] >= end:
+                continue
+            stats['bytes_read'] += group['length']
+            for row in reader.row_group_rows(n, wanted):
+                if start <= row[TIMESTAMP] < end:
+                    yield row
+
+
+def _in_range(name, start_ms, end_ms):
+    try:
+        first, last = name[:-len(SUFFIX)].split('-')[:2]
+        return int(last) + 1 > start_ms and int(first) < end_ms
+    except ValueError:
+        # Not named by write_segment, it has to be opened to tell
+        return True
+
+
+def segments_in_range(root, feed, symbol, start, end):
+    """
+    Paths of the feed/symbol segments that may hold rows in [start, end), from their partition and name alone
+    """
+    start_ms, end_ms = math.floor(start * 1000), math.ceil(end * 1000)
+    paths = []
+    for hour in range(int(start // HOUR), int(math.ceil(end / HOUR))):
+        directory = partition_dir(root, feed, symbol, hour * HOUR)
+        try:
+            names = sorted(os.listdir(directory))
+        except FileNotFoundError:
+            continue
+        paths.extend(os.path.join(directory, name) for name in names
+                     if name.endswith(SUFFIX) and name[0] != '.' and _in_range(name, start_ms, end_ms))
+    return paths
+
+
+def query(root, feed, symbol, start, end, columns=None, stats=None):
+    """
+    feed/symbol trades with start <= timestamp < end (seconds), in time order, as a generator. Pass a dict as stats
+    to have it filled in with the segments opened and bytes read
+    """
+    stats = stats if stats is not None else {}
+    stats.update({'segments': 0, 'unindexed': 0, 'bytes_read': 0})
+    paths = segments_in_range(root, feed, symbol, start, end)
+    stats['segments'] = len(paths)
+    # Segments of a partition usually follow on from each other, but one run's can overlap the next
+    yield from heapq.merge(*(_segment_rows(path, start, end, columns, stats) for path in paths),
+                           key=lambda row: row[TIMESTAMP])
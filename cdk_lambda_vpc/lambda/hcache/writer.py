@@ -0,0 +1,127 @@
+"""
+Pipelined batch writer for trades and order books
+
+Records are encoded with hcache.codec and buffered per cluster slot. A flush sends everything buffered in one
+pipeline, a SET (with PX when there's a TTL) per key - the cluster clients refuse multi-key commands like MSET in
+a pipeline, and a pipeline already costs one round trip per shard. Flushes happen when max_records or max_bytes is
+buffered, or on the next write / flush_if_due() after max_delay seconds - there's no background thread, so callers
+that can go quiet should call flush_if_due() from their loop, and flush() before exiting.
+
+    writer = BatchWriter(redis_cluster, ttl_ms=30 * 60 * 1000)
+    writer.write_trade('COINBASE', 'BTC-USD', trade)
+    writer.flush()
+
+The client only needs pipeline(transaction=False) with SET - redis-py-cluster's RedisCluster,
+redis.cluster.RedisCluster or a plain redis.Redis all work.
+"""
+import time
+
+from hcache.codec import default_codec
+from hcache.slots import key_slot
+
+MAX_RECORDS = 1000
+MAX_BYTES = 1024 * 1024
+MAX_DELAY_SECONDS = 0.05
+
+
+def trade_key(feed, symbol, trade_id):
+    return f'trades:{{{feed}:{symbol}}}:{trade_id}'
+
+
+def book_key(feed, symbol):
+    return f'book:{{{feed}:{symbol}}}'
+
+
+class BatchWriter:
+
+    def __init__(self, redis, codec=default_codec, ttl_ms=None, max_records=MAX_RECORDS, max_bytes=MAX_BYTES,
+                 max_delay=MAX_DELAY_SECONDS, clock=time.monotonic):
+        self.redis = redis
+        self.codec = codec
+        self.ttl_ms = ttl_ms
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.clock = clock
+
+        # slot -> {key: (encoded value, ttl ms)}, a later write to the same key replaces the buffered one
+        self.buffer = {}
+        self.buffered_records = 0
+        self.buffered_bytes = 0
+        self.first_buffered_at = None
+
+        self.records_written = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.commands_sent = 0
+
+    def write(self, key, record, ttl_ms=None):
+        value = self.codec.encode(record)
+        ttl_ms = ttl_ms if ttl_ms is not None else self.ttl_ms
+
+        slot = self.buffer.setdefault(key_slot(key), {})
+        previous = slot.get(key)
+        if previous is not None:
+            self.buffered_records -= 1
+            self.buffered_bytes -= len(previous[0])
+        slot[key] = (value, ttl_ms)
+
+        self.buffered_records += 1
+        self.buffered_bytes += len(value)
+        if self.first_buffered_at is None:
+            self.first_buffered_at = self.clock()
+
+        if self.buffered_records >= self.max_records or self.buffered_bytes >= self.max_bytes:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def write_trade(self, feed, symbol, trade, ttl_ms=None):
+        """
+        trade is a dict with at least an 'id'
+        """
+        self.write(trade_key(feed, symbol, trade['id']), trade, ttl_ms)
+
+    def write_book(self, feed, symbol, book, ttl_ms=None):
+        self.write(book_key(feed, symbol), book, ttl_ms)
+
+    def flush_if_due(self):
+        if self.first_buffered_at is not None and self.clock() - self.first_buffered_at >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """
+        Send everything buffered in one pipeline, returns the number of records written
+        """
+        if not self.buffered_records:
+            return 0
+
+        pipe = self.redis.pipeline(transaction=False)
+        commands = 0
+        for slot in sorted(self.buffer):
+            for k, (v, ttl) in self.buffer[slot].items():
+                pipe.set(k, v, px=ttl)
+                commands += 1
+        pipe.execute()
+
+        written = self.buffered_records
+        self.records_written += written
+        self.bytes_written += self.buffered_bytes
+        self.flushes += 1
+        self.commands_sent += commands
+
+        self.buffer = {}
+        self.buffered_records = 0
+        self.buffered_bytes = 0
+        self.first_buffered_at = None
+        return written
+
+    def stats(self):
+        return {
+            'records_written': self.records_written,
+            'bytes_written': self.bytes_written,
+            'flushes': self.flushes,
+            'commands_sent': self.commands_sent,
+            'bytes_per_record': self.bytes_written / self.records_written if self.records_written else None,
+            'records_per_flush': self.records_written / self.flushes if self.flushes else None,
+        }
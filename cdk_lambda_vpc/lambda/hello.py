@@ -1,10 +1,132 @@
+from coldstart import timer
+
+import hashlib
 import json
-import requests
+import os
+import time
 
+from http_client import client
+from request_metrics import metrics
+from structured_log import log
 
-def handler(event, context):
-    print('request: {}'.format(json.dumps(event)))
-    print(requests.get('http://ifconfig.co/json').json())
+EGRESS_IP_URL = os.environ.get('EGRESS_IP_URL', 'http://ifconfig.co/json')
+# Set by LambdaStack, the subnet (and so NAT gateway) this worker is pinned to
+EGRESS_SUBNET_ID = os.environ.get('EGRESS_SUBNET_ID')
+EGRESS_AZ = os.environ.get('EGRESS_AZ')
+
+# Resolved once per container - the egress IP of a container never changes as it is pinned to one subnet
+egress_ip = None
+# A failed lookup isn't retried for this long, rather than on every invocation
+EGRESS_IP_RETRY_SECONDS = 60
+egress_ip_failed_at = None
+# Created on first use, only containers with the EFS share mounted serve cached requests
+efs_cache = None
+
+
+def get_egress_ip():
+    """
+    The container's egress IP, None while the lookup is failing. The lookup isn't traced, so it stays out of the
+    request metrics
+    """
+    global egress_ip, egress_ip_failed_at
+    if egress_ip is not None:
+        return egress_ip
+    if egress_ip_failed_at is not None and time.monotonic() - egress_ip_failed_at < EGRESS_IP_RETRY_SECONDS:
+        return None
+    results, _ = client.fetch_all([EGRESS_IP_URL], traced=False)
+    try:
+        egress_ip = json.loads(results[0]['body'])['ip']
+        egress_ip_failed_at = None
+    except (KeyError, TypeError, ValueError):
+        # A network error, or a rate limited / unexpected response
+        egress_ip_failed_at = time.monotonic()
+    return egress_ip
+
+
+def get_efs_cache():
+    global efs_cache
+    if efs_cache is None:
+        from efs_cache import EfsCache
+        efs_cache = EfsCache()
+    return efs_cache
+
+
+def cache_key(request):
+    """
+    What a cached request is stored under: the url of a GET without a body, otherwise the method, url and a hash of
+    the body, so requests that differ in either don't share an object
+    """
+    method = request.get('method', 'GET').upper()
+    body = request.get('body')
+    if method == 'GET' and not body:
+        return request['url']
+    if isinstance(body, str):
+        body = body.encode()
+    return f'{method} {request["url"]} {hashlib.sha256(body or b"").hexdigest()}'
+
+
+def fetch_batch(batch):
+    """
+    Fetch a batch of requests, requests flagged with "cache": true are read through the EFS cache by cache_key()
+    """
+    cached = [r for r in batch if isinstance(r, dict) and r.get('cache')]
+    if not cached:
+        return client.fetch_all(batch)
+
+    start = time.perf_counter()
+    # Sent as they came, with their method, headers and body
+    by_key = {cache_key(r): r for r in cached}
+
+    def fetch_many(keys):
+        results, _ = client.fetch_all([by_key[key] for key in keys])
+        return {key: r['body'].encode() for key, r in zip(keys, results) if r.get('status') == 200}
+
+    # Bodies are decoded straight from the cached objects' mmaps
+    bodies = get_efs_cache().get_or_fetch_many(list(by_key), fetch_many, read=lambda m: str(m, 'utf-8'))
+    uncached = [r for r in batch if not (isinstance(r, dict) and r.get('cache'))]
+    fetched, _ = client.fetch_all(uncached) if uncached else ([], None)
+
+    fetched = iter(fetched)
+    results = []
+    for r in batch:
+        if isinstance(r, dict) and r.get('cache'):
+            key = cache_key(r)
+            if key in bodies:
+                results.append({'url': r['url'], 'status': 200, 'body': bodies[key], 'cached': True})
+            else:
+                results.append({'url': r['url'], 'error': 'Fetch failed, not cached'})
+        else:
+            results.append(next(fetched))
+
+    elapsed = time.perf_counter() - start
+    return results, {
+        'count': len(results),
+        'errors': sum(1 for r in results if 'error' in r),
+        'elapsed_ms': round(elapsed * 1000, 3),
+        'urls_per_second': round(len(results) / elapsed, 3) if elapsed > 0 else None,
+        'cache': get_efs_cache().stats()
+    }
+
+
+def handle(event):
+    # Batch of outbound requests, either from the dispatcher or a list of urls
+    batch = event.get('requests') or event.get('urls')
+    # Serialized (and cut down to LOG_MAX_BYTES) at the end of the invocation, only if sampled
+    log.info('request', batch_size=len(batch) if batch else 0, event=event)
+
+    if batch:
+        results, stats = fetch_batch(batch)
+        # One EMF line for the batch's sampled requests, a no-op unless REQUEST_METRICS_SAMPLE_RATE is set
+        metrics.flush(os.environ.get('AWS_LAMBDA_FUNCTION_NAME'), EGRESS_SUBNET_ID, get_egress_ip())
+        return {
+            'egress_ip': get_egress_ip(),
+            'egress_az': EGRESS_AZ,
+            'egress_subnet_id': EGRESS_SUBNET_ID,
+            'results': results,
+            'stats': stats
+        }
+
+    log.info('egress_ip', body=client.fetch_all([EGRESS_IP_URL], traced=False)[0][0].get('body'))
 
     return {
         'statusCode': 200,
@@ -13,3 +135,15 @@ def handler(event, context):
         },
         'body': 'Hello, CDK! You have hit rock bottom\n'
     }
+
+
+def handler(event, context):
+    start = time.perf_counter()
+    try:
+        return handle(event)
+    finally:
+        timer.invoked((time.perf_counter() - start) * 1000, getattr(context, 'function_name', None))
+        log.flush()
+
+
+timer.init_done()
@@ -0,0 +1,158 @@
+"""
+Pooled async HTTP client shared across warm invocations
+
+The client and its event loop live at module level, so connections (DNS, TCP and TLS setup through the NAT) are
+reused by every invocation a container serves, not just within one batch.
+
+httpx is used when it is on the path (with HTTP/2 when h2 is available too), otherwise requests from the Klayers
+layer is driven from a thread pool over a single keep-alive Session. Both are imported on first use rather than at
+module load, to keep them out of the init phase - as is asyncio, the largest import left in the handler.
+
+Sampled requests are timed phase by phase into request_metrics.metrics, see request_metrics.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from request_metrics import metrics, run_traced, trace_pool_manager
+
+MAX_CONNECTIONS = 64
+TIMEOUT_SECONDS = 30
+
+httpx = None
+HTTP2 = False
+_backend_loaded = False
+
+
+def load_backend():
+    """
+    Import httpx / h2 if available, returns the httpx module or None to fall back to requests
+    """
+    global httpx, HTTP2, _backend_loaded
+    if not _backend_loaded:
+        try:
+            import httpx
+            try:
+                import h2
+                HTTP2 = True
+            except ImportError:
+                HTTP2 = False
+        except ImportError:
+            httpx = None
+        _backend_loaded = True
+    return httpx
+
+
+class AsyncHttpClient:
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT_SECONDS):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.loop = None
+        self.client = None
+        self.session = None
+        self.executor = None
+
+    def _client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=HTTP2,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections)
+            )
+        return self.client
+
+    def _session(self):
+        if self.session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.max_connections, pool_maxsize=self.max_connections)
+            if metrics.enabled:
+                trace_pool_manager(adapter.poolmanager)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.executor = ThreadPoolExecutor(max_workers=self.max_connections)
+        return self.session
+
+    async def _send(self, request, trace=None):
+        method = request.get('method', 'GET')
+        url = request['url']
+        headers = request.get('headers')
+        body = request.get('body')
+
+        if load_backend() is not None:
+            extensions = {'trace': trace.httpcore_event} if trace is not None else None
+            response = await self._client().request(method, url, headers=headers, content=body, extensions=extensions)
+            return response.status_code, response.text, response.http_version
+
+        session = self._session()
+
+        def send():
+            return session.request(method, url, headers=headers, data=body, timeout=self.timeout)
+
+        response = await self.loop.run_in_executor(
+            self.executor, send if trace is None else lambda: run_traced(trace, send)
+        )
+        return response.status_code, response.text, 'HTTP/1.1'
+
+    async def _fetch(self, request, traced=True):
+        if isinstance(request, str):
+            request = {'url': request}
+
+        trace = metrics.sample() if traced else None
+        start = time.perf_counter()
+        try:
+            status, body, http_version = await self._send(request, trace)
+            result = {'url': request['url'], 'status': status, 'body': body, 'http_version': http_version}
+        except Exception as e:
+            result = {'url': request['url'], 'error': f'{type(e).__name__}: {e}'}
+        latency_ms = (time.perf_counter() - start) * 1000
+        result['latency_ms'] = round(latency_ms, 3)
+        if trace is not None:
+            trace.total = latency_ms
+            metrics.record(trace)
+            result['phases_ms'] = trace.as_dict()
+        return result
+
+    async def _fetch_all(self, requests, traced=True):
+        import asyncio
+        return await asyncio.gather(*[self._fetch(r, traced) for r in requests])
+
+    def _loop(self):
+        if self.loop is None:
+            import asyncio
+            self.loop = asyncio.new_event_loop()
+        return self.loop
+
+    def fetch_all(self, requests, traced=True):
+        """
+        Fetch a batch of requests concurrently, a request is either a url or a dict of url/method/headers/body.
+        Requests the worker makes for itself pass traced=False, so they are never sampled into the batch's metrics.
+        Returns (results in request order, stats)
+        """
+        start = time.perf_counter()
+        results = self._loop().run_until_complete(self._fetch_all(requests, traced))
+        elapsed = time.perf_counter() - start
+
+        stats = {
+            'count': len(results),
+            'errors': sum(1 for r in results if 'error' in r),
+            'elapsed_ms': round(elapsed * 1000, 3),
+            'urls_per_second': round(len(results) / elapsed, 3) if elapsed > 0 else None,
+        }
+        return results, stats
+
+    def close(self):
+        if self.client is not None:
+            self._loop().run_until_complete(self.client.aclose())
+            self.client = None
+        if self.session is not None:
+            self.session.close()
+            self.executor.shutdown()
+            self.session = None
+
+
+# Shared by every invocation in this container
+client = AsyncHttpClient()
@@ -0,0 +1,231 @@
+"""
+Per-request phase timings for outbound requests, logged as CloudWatch Embedded Metric Format
+
+A sampled request is timed phase by phase, in ms:
+
+    dns       resolving the host (requests backend only - httpx folds it into connect)
+    connect   TCP connect
+    tls       TLS handshake
+    ttfb      request sent to response headers received
+    total     the whole request, as seen by the caller
+
+Phases a request didn't go through - a reused keep-alive connection has no dns/connect/tls - are left out rather
+than logged as 0, so the percentiles are of the real work. flush() prints one EMF line per invocation, each metric
+as an array of the sampled values (at most MAX_VALUES per line), with Function, Subnet and EgressIp dimensions, so
+a slow NAT gateway / EIP stands out from the rest of the fleet.
+
+REQUEST_METRICS_SAMPLE_RATE (0-1, default 0) is the fraction of requests timed. At 0 sample() returns None and
+nothing is patched, wrapped or printed: the cost is one comparison per request.
+"""
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+SAMPLE_RATE = float(os.environ.get('REQUEST_METRICS_SAMPLE_RATE', 0))
+NAMESPACE = os.environ.get('REQUEST_METRICS_NAMESPACE', 'EgressRequests')
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'total')
+# EMF takes up to 100 values per metric per line
+MAX_VALUES = 100
+
+# The trace of the request the current thread is making, for the requests backend's connection hooks
+_current = threading.local()
+
+
+class Trace:
+
+    __slots__ = PHASES + ('_marks',)
+
+    def __init__(self):
+        for phase in PHASES:
+            setattr(self, phase, None)
+        self._marks = {}
+
+    def add(self, phase, ms):
+        setattr(self, phase, (getattr(self, phase) or 0) + ms)
+
+    def as_dict(self):
+        return {phase: round(getattr(self, phase), 3) for phase in PHASES if getattr(self, phase) is not None}
+
+    async def httpcore_event(self, name, info):
+        """
+        httpx / httpcore trace extension callback
+        """
+        now = time.perf_counter()
+        if name.endswith('.started'):
+            self._marks[name[:-len('.started')]] = now
+            return
+        if not name.endswith('.complete'):
+            return
+        event = name[:-len('.complete')]
+        started = self._marks.get(event)
+        if started is None:
+            return
+        if event == 'connection.connect_tcp':
+            self.add('connect', (now - started) * 1000)
+        elif event == 'connection.start_tls':
+            self.add('tls', (now - started) * 1000)
+        elif event.endswith('.send_request_body'):
+            self._marks['sent'] = now
+        elif event.endswith('.receive_response_headers'):
+            self.add('ttfb', (now - self._marks.get('sent', started)) * 1000)
+
+
+def run_traced(trace, fn):
+    """
+    Call fn with trace as the thread's current trace, for the connection hooks below
+    """
+    _current.trace = trace
+    try:
+        return fn()
+    finally:
+        _current.trace = None
+
+
+def traced_getaddrinfo(getaddrinfo):
+    def timed(*args, **kwargs):
+        trace = getattr(_current, 'trace', None)
+        if trace is None:
+            return getaddrinfo(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return getaddrinfo(*args, **kwargs)
+        finally:
+            trace.add('dns', (time.perf_counter() - start) * 1000)
+    timed.traced = True
+    return timed
+
+
+def traced_connection(base, tls):
+    """
+    Subclass of a urllib3 connection class that times connect / TLS / time to first byte into the thread's trace
+    """
+    class Traced(base):
+        _new_conn_at = None
+        _sent_at = None
+
+        def _new_conn(self):
+            trace = getattr(_current, 'trace', None)
+            if trace is None:
+                return super()._new_conn()
+            start, dns_before = time.perf_counter(), trace.dns or 0
+            try:
+                return super()._new_conn()
+            finally:
+                # _new_conn resolves then connects, the resolving is already counted as dns
+                self._new_conn_at = time.perf_counter()
+                trace.add('connect', (self._new_conn_at - start) * 1000 - ((trace.dns or 0) - dns_before))
+
+        def connect(self):
+            super().connect()
+            trace = getattr(_current, 'trace', None)
+            if tls and trace is not None and self._new_conn_at is not None:
+                trace.add('tls', (time.perf_counter() - self._new_conn_at) * 1000)
+            self._new_conn_at = None
+
+        def request(self, *args, **kwargs):
+            result = super().request(*args, **kwargs)
+            self._sent_at = time.perf_counter()
+            return result
+
+        def getresponse(self, *args, **kwargs):
+            response = super().getresponse(*args, **kwargs)
+            trace = getattr(_current, 'trace', None)
+            if trace is not None and self._sent_at is not None:
+                trace.add('ttfb', (time.perf_counter() - self._sent_at) * 1000)
+            self._sent_at = None
+            return response
+
+    Traced.__name__ = f'Traced{base.__name__}'
+    return Traced
+
+
+def trace_pool_manager(pool_manager):
+    """
+    Make a urllib3 PoolManager (e.g. a requests HTTPAdapter's) create connections that report into the trace
+    """
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    if not getattr(socket.getaddrinfo, 'traced', False):
+        socket.getaddrinfo = traced_getaddrinfo(socket.getaddrinfo)
+
+    class TracedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = traced_connection(HTTPConnectionPool.ConnectionCls, tls=False)
+
+    class TracedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = traced_connection(HTTPSConnectionPool.ConnectionCls, tls=True)
+
+    pool_manager.pool_classes_by_scheme = {'http': TracedHTTPConnectionPool, 'https': TracedHTTPSConnectionPool}
+
+
+class RequestMetrics:
+
+    def __init__(self, sample_rate=SAMPLE_RATE, namespace=NAMESPACE, out=None):
+        self.sample_rate = sample_rate
+        self.namespace = namespace
+        self.out = out
+        self.traces = []
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def sample(self):
+        """
+        A Trace for the next request if it's sampled, otherwise None
+        """
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        return Trace()
+
+    def record(self, trace):
+        self.traces.append(trace)
+
+    def records(self, function, subnet, egress_ip):
+        """
+        The EMF records for the traces recorded so far, MAX_VALUES requests per record
+        """
+        records = []
+        for first in range(0, len(self.traces), MAX_VALUES):
+            chunk = self.traces[first:first + MAX_VALUES]
+            record = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [['Function', 'Subnet', 'EgressIp']],
+                        'Metrics': [],
+                    }],
+                },
+                'Function': function or 'unknown',
+                'Subnet': subnet or 'unknown',
+                'EgressIp': egress_ip or 'unknown',
+                'SampleRate': self.sample_rate,
+                'Requests': len(chunk),
+            }
+            for phase in PHASES:
+                values = [round(getattr(t, phase), 3) for t in chunk if getattr(t, phase) is not None]
+                if values:
+                    name = f'{phase.capitalize()}Ms' if phase != 'ttfb' else 'TtfbMs'
+                    record['_aws']['CloudWatchMetrics'][0]['Metrics'].append({'Name': name, 'Unit': 'Milliseconds'})
+                    record[name] = values
+            records.append(record)
+        return records
+
+    def flush(self, function=None, subnet=None, egress_ip=None):
+        """
+        Print the EMF records for the traces recorded since the last flush, returns them
+        """
+        if not self.traces:
+            return []
+        records = self.records(function, subnet, egress_ip)
+        self.traces = []
+        for record in records:
+            print(json.dumps(record, separators=(',', ':')), file=self.out)
+        return records
+
+
+# Shared by the http client and the handler
+metrics = RequestMetrics()
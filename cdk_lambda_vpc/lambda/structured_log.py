@@ -0,0 +1,238 @@
+"""
+Sampled, size-capped JSON logging for the handlers, written out once per invocation
+
+log.info('request', event=event) only keeps a reference: nothing is serialized until flush(), and then only for the
+records that made it through sampling. A field can also be a zero-argument callable, called at flush time, for values
+that are costly to build. flush() writes every buffered record (one JSON object per line) to stdout in a single
+write and is called once at the end of the invocation - there is nothing to gain from a background thread, as Lambda
+freezes the container as soon as the handler returns.
+
+    LOG_LEVEL            records below it are dropped at the call, default INFO
+    LOG_SAMPLE_RATE      fraction of INFO/DEBUG records kept, default 1
+    LOG_MAX_PER_SECOND   INFO/DEBUG records kept per second per container, 0 for no limit, default 50
+    LOG_MAX_BYTES        records are cut down to this size, the largest fields first, default 2048
+    LOG_MAX_BUFFERED     records buffered per invocation, default 1000
+
+WARNING and ERROR records are never sampled or rate limited. Anything dropped is counted, and the counts go out
+with the next records written (a "log_dropped" record), so a sampled log can still be scaled back up without an
+extra line per invocation.
+"""
+import json
+import os
+import random
+import sys
+import time
+
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+MAX_PER_SECOND = float(os.environ.get('LOG_MAX_PER_SECOND', 50))
+MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 2048))
+MAX_BUFFERED = int(os.environ.get('LOG_MAX_BUFFERED', 1000))
+
+# What a cut down field keeps at least, on top of the marker
+MIN_FIELD_BYTES = 16
+
+CONTAINERS = (dict, list, tuple)
+
+
+def estimate_items(value, depth=4):
+    """
+    Rough count of the dicts, lists and scalars in value, taking every item of a list to be like its first
+    """
+    if isinstance(value, dict):
+        if depth <= 0:
+            return len(value)
+        return len(value) + sum(estimate_items(v, depth - 1) for v in value.values() if isinstance(v, CONTAINERS))
+    if not value:
+        return 0
+    first = value[0]
+    return len(value) * (1 + (estimate_items(first, depth - 1) if depth > 0 and isinstance(first, CONTAINERS) else 0))
+
+
+def cut(text, max_chars):
+    """
+    text cut down to max_chars, marked with how many bytes were left out
+    """
+    if len(text) <= max_chars:
+        return text
+    kept = text[:max_chars]
+    return f'{kept}\u2026(+{len(text.encode()) - len(kept.encode())} bytes)'
+
+
+def prune(value, max_items, max_string=None):
+    """
+    Copy of value with its first max_items dicts, lists and scalars, depth first, strings longer than max_string
+    cut down (see cut), and whether it is all there. Only the items kept are looked at, however large value is
+    """
+    left = [max_items]
+    complete = [True]
+
+    def scalar(item):
+        if max_string is not None and isinstance(item, str) and len(item) > max_string:
+            complete[0] = False
+            return cut(item, max_string)
+        return item
+
+    def copy(value):
+        if isinstance(value, dict):
+            pruned = {}
+            for key, item in value.items():
+                left[0] -= 1
+                if left[0] < 0:
+                    break
+                pruned[key] = copy(item) if isinstance(item, CONTAINERS) else scalar(item)
+            return pruned
+        pruned = []
+        for item in value:
+            left[0] -= 1
+            if left[0] < 0:
+                break
+            pruned.append(copy(item) if isinstance(item, CONTAINERS) else scalar(item))
+        return pruned
+
+    pruned = copy(value)
+    return pruned, complete[0] and left[0] >= 0
+
+
+class Logger:
+
+    def __init__(self, level=LEVEL, sample_rate=SAMPLE_RATE, max_per_second=MAX_PER_SECOND, max_bytes=MAX_BYTES,
+                 max_buffered=MAX_BUFFERED, out=None):
+        self.level = LEVELS[level]
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+        self.max_bytes = max_bytes
+        self.max_buffered = max_buffered
+        self.out = out
+        self.buffer = []
+        self.dropped = {}
+        # Token bucket for max_per_second, full to start with
+        self.tokens = max_per_second
+        self.refilled_at = time.monotonic()
+
+    def _drop(self, reason):
+        self.dropped[reason] = self.dropped.get(reason, 0) + 1
+
+    def _allowed(self):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self._drop('sampled')
+            return False
+        if self.max_per_second > 0:
+            now = time.monotonic()
+            self.tokens = min(self.max_per_second, self.tokens + (now - self.refilled_at) * self.max_per_second)
+            self.refilled_at = now
+            if self.tokens < 1:
+                self._drop('rate_limited')
+                return False
+            self.tokens -= 1
+        return True
+
+    def log(self, level, msg, **fields):
+        value = LEVELS[level]
+        if value < self.level:
+            return
+        if value < LEVELS['WARNING'] and not self._allowed():
+            return
+        if len(self.buffer) >= self.max_buffered:
+            self._drop('buffer_full')
+            return
+        self.buffer.append((time.time(), level, msg, fields))
+
+    def debug(self, msg, **fields):
+        self.log('DEBUG', msg, **fields)
+
+    def info(self, msg, **fields):
+        self.log('INFO', msg, **fields)
+
+    def warning(self, msg, **fields):
+        self.log('WARNING', msg, **fields)
+
+    def error(self, msg, **fields):
+        self.log('ERROR', msg, **fields)
+
+    def encode(self, value):
+        """
+        value as JSON, returns (json, complete). A large dict or list first has its long strings cut down, keeping
+        every key and the shape, and only then its later items left out, until it is under max_bytes - without
+        walking the rest of it, so a huge event costs no more than a small one
+        """
+        # Keys and values run to ~24 bytes each in an event, it's only a starting point
+        max_items = self.max_bytes // 24
+        if not isinstance(value, CONTAINERS) or estimate_items(value) <= max_items:
+            text = json.dumps(value, default=str, separators=(',', ':'))
+            if len(text) <= self.max_bytes or not isinstance(value, CONTAINERS):
+                return text, True
+        max_string = self.max_bytes // 2
+        while True:
+            pruned, complete = prune(value, max_items, max_string)
+            text = json.dumps(pruned, default=str, separators=(',', ':'))
+            if len(text) <= self.max_bytes or (max_items <= 1 and max_string <= MIN_FIELD_BYTES):
+                return text, complete
+            # Scaled by how far over it was, so it is rarely more than a few times
+            shrink = self.max_bytes / len(text) * 0.9
+            if max_string > MIN_FIELD_BYTES:
+                max_string = max(MIN_FIELD_BYTES, int(max_string * shrink))
+            else:
+                max_items = max(1, int(max_items * shrink))
+
+    def serialize(self, ts, level, msg, fields):
+        """
+        One record as a JSON line of at most max_bytes. Large dicts and lists keep their keys with long strings cut
+        down, then their first items, then the largest fields are cut down to the start of their JSON, as a string.
+        The fields cut are listed in "truncated" with their original size in bytes, null when it wasn't worked out
+        """
+        head = f'{{"ts":{round(ts, 3)},"level":"{level}","msg":{json.dumps(msg)}'
+        parts, truncated = {}, {}
+        for key, value in fields.items():
+            parts[key], complete = self.encode(value() if callable(value) else value)
+            if not complete:
+                truncated[key] = None
+
+        def assemble():
+            if truncated:
+                parts['truncated'] = json.dumps(truncated, separators=(',', ':'))
+            return ''.join([head] + [f',{json.dumps(k)}:{v}' for k, v in parts.items()] + ['}'])
+
+        line = assemble()
+        # A cut down field is ascii escaped JSON, so len() is bytes, escaped again as a string - it is cut until the
+        # line fits rather than just once
+        for key in sorted(fields, key=lambda k: len(parts[k]), reverse=True):
+            if len(line) <= self.max_bytes:
+                break
+            text = parts[key]
+            keep = len(text)
+            truncated.setdefault(key, keep)
+            while len(line) > self.max_bytes and keep > MIN_FIELD_BYTES:
+                # Escaping makes each character kept take up more than one
+                escaped = len(json.dumps(text[:keep])) / keep
+                keep = max(MIN_FIELD_BYTES, int(keep - (len(line) - self.max_bytes) / escaped) - 8)
+                parts[key] = json.dumps(text[:keep] + '...')
+                line = assemble()
+        if len(line) > self.max_bytes:
+            # Too many fields to cut down, just say how many there were
+            line = f'{head},"truncated":{{"fields":{len(fields)}}}}}'
+        return line
+
+    def flush(self):
+        """
+        Write out the records buffered since the last flush in one write, returns the number of records written
+        """
+        if not self.buffer:
+            return 0
+        lines = [self.serialize(*entry) for entry in self.buffer]
+        self.buffer = []
+        if self.dropped:
+            lines.append(json.dumps({'ts': round(time.time(), 3), 'level': 'INFO', 'msg': 'log_dropped',
+                                     'dropped': self.dropped, 'sample_rate': self.sample_rate},
+                                    separators=(',', ':')))
+            self.dropped = {}
+        out = self.out or sys.stdout
+        out.write('\n'.join(lines) + '\n')
+        out.flush()
+        return len(lines)
+
+
+# Shared by the handler modules, flushed at the end of each invocation
+log = Logger()
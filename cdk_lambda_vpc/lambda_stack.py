@@ -1,40 +1,309 @@
+import json
+import subprocess
+import sys
+
+import jsii
 from aws_cdk import (
     core,
     aws_lambda as _lambda,
 )
 import aws_cdk.aws_ec2 as ec2
 from aws_cdk import aws_efs as efs
+from aws_cdk import aws_events as events
+from aws_cdk import aws_events_targets as targets
+from aws_cdk import aws_iam as iam
+from netaddr import IPNetwork
+
+from cdk_lambda_vpc.topology import VpcPeering, check_in_az, looked_up, subnets_in
+
+HCACHE_LAYER_DIR = 'cdk_lambda_vpc/layers/hcache'
+EGRESS_WORKER_TIMEOUT = core.Duration.minutes(5)
+# What /hcache/evict_trades_after_minutes defaults to in RedisStack
+TRADE_RETENTION_MINUTES = 30
+# Wheels for the functions' runtime, whatever the machine running the synth
+PIP_INSTALL = ['install', '--no-deps', '-r', 'requirements.txt', '--only-binary=:all:',
+               '--platform', 'manylinux2014_x86_64', '--implementation', 'cp', '--python-version', '3.8']
+
+
+@jsii.implements(core.ILocalBundling)
+class LocalPipInstall:
+    """
+    Build a layer with the local pip, so synth doesn't need Docker - when it fails the bundling image is used
+    """
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+
+    def try_bundle(self, output_dir, *, image, **kwargs):
+        try:
+            subprocess.run([sys.executable, '-m', 'pip'] + PIP_INSTALL + ['-t', f'{output_dir}/python'],
+                           cwd=self.source_dir, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        return True
 
 
 class LambdaStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, efs_access_point=None, subnet_plan=None, hcache_az=None,
+                 hcache_vpc_id=None, request_metrics_sample_rate=0, tiering_interval_minutes=None,
+                 eviction_interval_minutes=None, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
         vpc = ec2.Vpc.from_lookup(self, "VPC", vpc_name='combined-vpc/efs-vpc')
 
 
         # https://github.com/mthenw/awesome-layers
-        layer = _lambda.LayerVersion.from_layer_version_arn(
+        self.layer = _lambda.LayerVersion.from_layer_version_arn(
             self,
             "requests",
             "arn:aws:lambda:us-east-1:770693421928:layer:Klayers-python38-requests:20"
         )
 
-        # TODO: fix this
-        #ap = efs.AccessPoint.from_access_point_id(self, 'ap_id', access_point_id='runtimes-access-point')
-        #fs = _lambda.FileSystem.from_efs_access_point(ap, '/mnt/efs')
+        # Shared by every function, byte-code caches and local tooling are left out to keep the package small
+        self.code = _lambda.Code.from_asset('cdk_lambda_vpc/lambda', exclude=['__pycache__', '*.pyc', '.*'])
+
+        # redis, msgpack and lz4 for the hcache functions, built on first use (see hcache_layer)
+        self._hcache_layer = None
+
+        # Fraction of the workers' outbound requests timed phase by phase into EMF (see lambda/request_metrics.py)
+        self.request_metrics_sample_rate = request_metrics_sample_rate
 
-        # Defines an AWS Lambda resource
-        my_lambda = _lambda.Function(
-            self, 'HelloHandler',
+        # An access point imported by id alone has no file system attached, so it's passed in from the stack that
+        # created it (CombinedStack.create_efs) and re-imported here. Importing the security group as immutable
+        # stops the functions adding ingress rules to it, which would make combined-vpc depend on this stack -
+        # the EFS security group already allows 2049 from the whole VPC
+        self.filesystem = None
+        if efs_access_point is not None:
+            file_system = efs.FileSystem.from_file_system_attributes(
+                self, 'efs',
+                file_system_id=efs_access_point.file_system.file_system_id,
+                security_group=ec2.SecurityGroup.from_security_group_id(
+                    self, 'efs-sg',
+                    efs_access_point.file_system.connections.security_groups[0].security_group_id,
+                    mutable=False
+                )
+            )
+            access_point = efs.AccessPoint.from_access_point_attributes(
+                self, 'efs-ap', access_point_id=efs_access_point.access_point_id, file_system=file_system
+            )
+            self.filesystem = _lambda.FileSystem.from_efs_access_point(access_point, '/mnt/efs')
+
+        # One worker per egress subnet - each routes through its own NAT gateway / EIP, in the subnet's own AZ.
+        # Egress subnets are packed in route order (see subnet_planner), so sorting by address numbers the workers
+        # the same as the routes and a growing fleet only ever adds workers
+        self.egress_subnets = sorted(vpc.private_subnets, key=lambda s: IPNetwork(s.ipv4_cidr_block).first)
+        if subnet_plan is not None:
+            self.check_egress_subnets(subnet_plan)
+        if hcache_az:
+            self.colocate_with_hcache(vpc, hcache_az)
+        # The tiering and eviction workers run in an egress subnet and talk to hcache, so it has to be reachable
+        # from there whether or not the topology option is on
+        hcache_workers = (tiering_interval_minutes and self.filesystem is not None) or eviction_interval_minutes
+        if hcache_az or hcache_workers:
+            self.peer_with_hcache(vpc, hcache_vpc_id, hcache_az)
+        self.workers = [self.create_egress_worker(vpc, n, subnet) for n, subnet in enumerate(self.egress_subnets)]
+        self.create_dispatcher(self.workers)
+        self.tiering = None
+        if tiering_interval_minutes and self.filesystem is not None:
+            self.tiering = self.create_tiering_worker(vpc, tiering_interval_minutes)
+        self.eviction = None
+        if eviction_interval_minutes:
+            self.eviction = self.create_eviction_worker(vpc, eviction_interval_minutes)
+
+    def check_egress_subnets(self, subnet_plan):
+        """
+        Compare the looked-up egress subnets with the routes CombinedStack plans. A subnet in a different AZ from
+        its route would send every request across AZs to its NAT gateway, so that fails the synth. Planned routes
+        missing from the lookup mean cdk.context.json is stale (cdk context --reset, then synth again)
+        """
+        planned = {str(route.cidr): route for route in subnet_plan.routes}
+        looked_up = {subnet.ipv4_cidr_block: subnet for subnet in self.egress_subnets}
+        for cidr, subnet in looked_up.items():
+            route = planned.get(cidr)
+            if route is not None and route.az != subnet.availability_zone:
+                raise ValueError(f'Egress subnet {cidr} is in {subnet.availability_zone} but its NAT gateway '
+                                 f'(route {route.n}) is planned in {route.az}')
+        missing = [cidr for cidr in planned if cidr not in looked_up]
+        if missing:
+            core.Annotations.of(self).add_warning(
+                f'Egress routes {", ".join(missing)} are planned but not in the looked-up VPC, they get no worker '
+                f'until the VPC lookup is refreshed')
+
+    def colocate_with_hcache(self, vpc, az):
+        """
+        Every worker has to be in the hcache AZ (see topology.py). Not checked until the lookup is resolved
+        """
+        if looked_up(vpc):
+            check_in_az(self.egress_subnets, az, 'Egress')
+
+    def peer_with_hcache(self, vpc, hcache_vpc_id, az=None):
+        """
+        Reach hcache from the egress subnets over a peering when it lives in another VPC. Routes go in the workers'
+        route tables, and in the hcache VPC's route tables for its isolated subnets - only those in az when it's set.
+        Nothing is peered until both lookups are resolved. RedisStack has to let combined-vpc's CIDR in as well, see
+        client_cidrs in app.py
+        """
+        if not hcache_vpc_id:
+            raise ValueError('hcache is used from combined-vpc (HCACHE_AZ or an hcache worker is on) but its VPC '
+                             'isn\'t known, set HCACHE_VPC_ID')
+        if hcache_vpc_id == vpc.vpc_id:
+            return
+        hcache_vpc = ec2.Vpc.from_lookup(self, 'hcache-vpc', vpc_id=hcache_vpc_id)
+        if not (looked_up(vpc) and looked_up(hcache_vpc)):
+            return
+        peer_subnets = hcache_vpc.isolated_subnets
+        if az:
+            peer_subnets = subnets_in(peer_subnets, az, 'hcache isolated')
+        VpcPeering(self, 'hcache-peering', vpc, hcache_vpc, subnets=self.egress_subnets, peer_subnets=peer_subnets)
+
+    def create_egress_worker(self, vpc, n, subnet):
+        """
+        Create a HelloHandler pinned to a single private subnet, so all of its outbound traffic
+        leaves through that subnet's NAT gateway (and therefore a single egress IP)
+        """
+        return _lambda.Function(
+            self, 'HelloHandler' if n == 0 else f'HelloHandler{n}',
             runtime=_lambda.Runtime.PYTHON_3_8,
-            code=_lambda.Code.asset('cdk_lambda_vpc/lambda'),
+            code=self.code,
             handler='hello.handler',
             vpc=vpc,
-            vpc_subnets=ec2.SubnetSelection(subnets=[vpc.private_subnets[0], vpc.private_subnets[1]]),
+            vpc_subnets=ec2.SubnetSelection(subnets=[subnet]),
             layers=[
-                layer
+                self.layer
             ],
-            timeout=core.Duration.minutes(5)
+            filesystem=self.filesystem,
+            environment=dict({
+                'EGRESS_SUBNET_ID': subnet.subnet_id,
+                'EGRESS_AZ': subnet.availability_zone,
+            }, **({'EFS_CACHE_ROOT': '/mnt/efs/cache'} if self.filesystem else {}),
+               **({'REQUEST_METRICS_SAMPLE_RATE': str(self.request_metrics_sample_rate)}
+                  if self.request_metrics_sample_rate else {})),
+            timeout=EGRESS_WORKER_TIMEOUT
+        )
+
+    def create_dispatcher(self, workers):
+        """
+        Create the coordinator that splits a batch of outbound requests across the egress workers.
+        It only talks to the Lambda API, so it doesn't need to live in the VPC
+        """
+        dispatcher = _lambda.Function(
+            self, 'EgressDispatcher',
+            runtime=_lambda.Runtime.PYTHON_3_8,
+            code=self.code,
+            handler='dispatcher.handler',
+            environment={
+                'WORKER_FUNCTIONS': json.dumps([w.function_name for w in workers]),
+                'WORKER_TIMEOUT_SECONDS': str(EGRESS_WORKER_TIMEOUT.to_seconds()),
+            },
+            # Outlives the slowest worker, so a worker timing out is reported rather than cutting the batch off
+            timeout=EGRESS_WORKER_TIMEOUT.plus(core.Duration.minutes(1))
+        )
+
+        for worker in workers:
+            worker.grant_invoke(dispatcher)
+
+        return dispatcher
+
+    def hcache_layer(self):
+        """
+        The layer with lambda/hcache's third-party packages, pinned in layers/hcache/requirements.txt. Only built
+        when a function needs it, so the default synth doesn't install anything
+        """
+        if self._hcache_layer is None:
+            self._hcache_layer = _lambda.LayerVersion(
+                self, 'hcache-deps',
+                code=_lambda.Code.from_asset(HCACHE_LAYER_DIR, bundling=core.BundlingOptions(
+                    image=_lambda.Runtime.PYTHON_3_8.bundling_image,
+                    command=['bash', '-c', ' '.join(['pip'] + PIP_INSTALL + ['-t', '/asset-output/python'])],
+                    local=LocalPipInstall(HCACHE_LAYER_DIR)
+                )),
+                compatible_runtimes=[_lambda.Runtime.PYTHON_3_8],
+                description='redis, msgpack and lz4 for lambda/hcache'
+            )
+        return self._hcache_layer
+
+    def create_tiering_worker(self, vpc, interval_minutes):
+        """
+        Copy trades about to expire out of hcache onto the EFS share every interval_minutes (see
+        lambda/hcache/tiering.py). It runs in an egress subnet as those are peered with hcache, and the
+        horizon covers one missed run. tiering.py caps the horizon at half the trade retention, or every trade would
+        be archived and unlinked as soon as it's written; an interval past that cap would lose the trades that expire
+        between runs, so it fails synth against the retention RedisStack sets.
+
+        Segments go on combined-vpc's share (under the lambda access point) rather than EFSStack's
+        high-performance-storage: a function can only mount a file system with a mount target its VPC reaches, and
+        EFSStack's VPC has the same 10.2.0.0/16 CIDR as combined-vpc so the two can't be peered - nor is EFSStack
+        deployed by app.py. efs_profile / config.EFS_WORKLOAD size the share for both uses
+        """
+        max_horizon_minutes = TRADE_RETENTION_MINUTES // 2
+        if interval_minutes > max_horizon_minutes:
+            raise ValueError(f'Tiering every {interval_minutes} minutes would lose trades: the horizon is capped '
+                             f'at {max_horizon_minutes} minutes, half the {TRADE_RETENTION_MINUTES} minute trade '
+                             f'retention')
+        # Lambda's limit
+        timeout_minutes = min(interval_minutes, 15)
+        tiering = _lambda.Function(
+            self, 'HcacheTiering',
+            runtime=_lambda.Runtime.PYTHON_3_8,
+            code=self.code,
+            handler='hcache.tiering.handler',
+            layers=[self.hcache_layer()],
+            vpc=vpc,
+            vpc_subnets=ec2.SubnetSelection(subnets=self.egress_subnets[:1]),
+            filesystem=self.filesystem,
+            environment={
+                'TIERING_ROOT': '/mnt/efs/tiering',
+                'TIERING_HORIZON_SECONDS': str(min(interval_minutes * 2, max_horizon_minutes) * 60),
+                'TIERING_TIME_BUDGET_SECONDS': str(timeout_minutes * 60 // 2),
+            },
+            memory_size=1024,
+            # Only ever one run, two at once would archive the same trades
+            reserved_concurrent_executions=1,
+            timeout=core.Duration.minutes(timeout_minutes)
+        )
+        tiering.add_to_role_policy(iam.PolicyStatement(
+            actions=['ssm:GetParametersByPath'],
+            resources=[self.format_arn(service='ssm', resource='parameter', resource_name='hcache')]
+        ))
+
+        events.Rule(
+            self, 'HcacheTieringSchedule',
+            schedule=events.Schedule.rate(core.Duration.minutes(interval_minutes)),
+            targets=[targets.LambdaFunction(tiering)]
+        )
+        return tiering
+
+    def create_eviction_worker(self, vpc, interval_minutes):
+        """
+        Enforce the /hcache eviction settings on what is already in hcache every interval_minutes (see
+        lambda/hcache/eviction.py), a few small batches per shard and run. In an egress subnet, like the tiering
+        worker, to reach hcache
+        """
+        timeout_minutes = min(interval_minutes, 15)
+        eviction = _lambda.Function(
+            self, 'HcacheEviction',
+            runtime=_lambda.Runtime.PYTHON_3_8,
+            code=self.code,
+            handler='hcache.eviction.handler',
+            layers=[self.hcache_layer()],
+            vpc=vpc,
+            vpc_subnets=ec2.SubnetSelection(subnets=self.egress_subnets[:1]),
+            environment={
+                'EVICTION_TIME_BUDGET_SECONDS': str(timeout_minutes * 60 // 3),
+            },
+            # One container, so the shards' SCAN cursors carry over from run to run
+            reserved_concurrent_executions=1,
+            timeout=core.Duration.minutes(timeout_minutes)
+        )
+        eviction.add_to_role_policy(iam.PolicyStatement(
+            actions=['ssm:GetParametersByPath'],
+            resources=[self.format_arn(service='ssm', resource='parameter', resource_name='hcache')]
+        ))
+
+        events.Rule(
+            self, 'HcacheEvictionSchedule',
+            schedule=events.Schedule.rate(core.Duration.minutes(interval_minutes)),
+            targets=[targets.LambdaFunction(eviction)]
         )
+        return eviction
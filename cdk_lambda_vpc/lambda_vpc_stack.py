@@ -16,9 +16,10 @@ from aws_cdk import core
 from aws_cdk.aws_ec2 import Vpc, CfnRouteTable, RouterType, CfnRoute, CfnInternetGateway, CfnVPCGatewayAttachment, \
     CfnSubnet, CfnSubnetRouteTableAssociation, CfnSecurityGroup, CfnInstance
 
-from netaddr import IPNetwork
 from aws_cdk.aws_ec2 import RouterType, CfnSecurityGroup, CfnNatGateway, CfnEIP
 
+from cdk_lambda_vpc import subnet_planner
+
 
 PREALLOCATED_EIP_LIST = [
             'eipalloc-0af1e42ea007b7c4b',
@@ -33,10 +34,11 @@ N_SUBNETS = 5
 
 class LambdaVpcStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, az=None, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
-        self.az = 'us-east-1b'
+        # There's a single public subnet, so everything goes in one AZ - the second one, as before
+        self.az = az or self.availability_zones[1 % len(self.availability_zones)]
         self.vpc_cidr_start = '10.1.0.0'
         self.vpc_cidr = f'{self.vpc_cidr_start}/16'
 
@@ -55,7 +57,9 @@ class LambdaVpcStack(core.Stack):
 
         self.pre_allocated_eips = PREALLOCATED_EIP_LIST
 
-        self.private_start_cidr = None
+        self.subnet_plan = subnet_planner.plan_egress_subnets(
+            self.vpc_cidr, [self.az], N_SUBNETS, reserved_tiers=[('lambda_vpc_public', 24)], egress_mask=26
+        )
         self.public_subnet_id = self.create_public_subnet()
         for i in range(0, N_SUBNETS):
             self.create_lambda_access_route(i)
@@ -66,10 +70,7 @@ class LambdaVpcStack(core.Stack):
         """
         # Create public subnet
         subnet_id = f'lambda_vpc_public'
-        cidr = f'{self.vpc_cidr_start}/24'
-
-        # Set starting cidr range for private subnets
-        self.private_start_cidr = str(IPNetwork(cidr).next()).replace('/24', '/26')
+        cidr = str(self.subnet_plan.reserved[0].cidr)
 
         self.subnet_id_to_subnet_map[subnet_id] = CfnSubnet(
             self, subnet_id, vpc_id=self.vpc.vpc_id, cidr_block=cidr,
@@ -112,7 +113,7 @@ class LambdaVpcStack(core.Stack):
 
         # Create private subnet
         subnet_id = f'lambda_vpc_private_{n}'
-        cidr = str(IPNetwork(self.private_start_cidr).next(n))
+        cidr = str(self.subnet_plan.routes[n].cidr)
         self.subnet_id_to_subnet_map[subnet_id] = CfnSubnet(
             self, subnet_id, vpc_id=self.vpc.vpc_id, cidr_block=cidr,
             availability_zone=self.az, tags=[{'key': 'Name', 'value': subnet_id}],
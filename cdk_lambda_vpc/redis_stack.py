@@ -8,6 +8,8 @@ from aws_cdk import aws_iam as iam
 from aws_cdk import aws_ssm
 from aws_cdk import aws_autoscaling, aws_autoscalingplans, aws_applicationautoscaling, aws_cloudwatch
 
+from cdk_lambda_vpc import hcache_capacity
+
 EC2_KEY_NAME = 'awspersonal'
 EC2_WHITELIST_IPS = [
     "82.24.204.83/32",
@@ -52,70 +54,15 @@ class RedisStack(core.Stack):
         self.create_redis()
 
     def create_autoscaler_lambda_role(self):
-        autoscaler_role = iam.Role(self, 'autoscaler-role', role_name='autoscaler-role',
-                 assumed_by=iam.ServicePrincipal('lambda.amazonaws.com'))
-
-        elasticache_full_access_policy = iam.ManagedPolicy.from_aws_managed_policy_name('AmazonElastiCacheFullAccess')
-        lambda_policy = iam.ManagedPolicy.from_aws_managed_policy_name('AWSLambdaBasicExecutionRole')
-
-        autoscaler_role.add_managed_policy(elasticache_full_access_policy)
-        autoscaler_role.add_managed_policy(lambda_policy)
+        return hcache_capacity.create_autoscaler_lambda_role(self)
 
     def create_autoscale_sns(self):
-        """
-        https://axemind.medium.com/aws-cdk-python-lambda-cloudwatch-alarm-1dcc93bdbc8d
-
-        https://stackoverflow.com/a/63178997
-
-        """
-        self.capacity_topic = sns.Topic(self, id='capacity_alarm_topic', topic_name='capacity_alarm_topic')
-
-        """
-        Percentage of the memory available for the cluster that is in use excluding memory used for overhead and COB. 
-        This is calculated using used_memory-mem_not_counted_for_evict/maxmemory from Redis INFO.
-        """
-        alarm_scale_up = cw.Alarm(self,
-                                 'hcache_capacity_alarm_scale_up',
-                                 alarm_name='hcache_capacity_alarm_scale_up',
-                                 metric=cw.Metric(
-                                    namespace="AWS/ElastiCache",
-                                     metric_name="DatabaseMemoryUsageCountedForEvictPercentage",
-                                     dimensions={
-                                         "ReplicationGroupId": "hcache",
-                                     },
-                                     period=core.Duration.minutes(5),
-                                     statistic="Average"
-                                 ),
-                                 evaluation_periods=1,
-                                 threshold=70,
-                                 comparison_operator=cw.ComparisonOperator.GREATER_THAN_THRESHOLD
-        )
-
-        alarm_scale_up.add_alarm_action(cw_actions.SnsAction(self.capacity_topic))
-
-        alarm_scale_down = cw.Alarm(self,
-                                  'hcache_capacity_alarm_scale_down',
-                                  alarm_name='hcache_capacity_alarm_scale_down',
-                                  metric=cw.Metric(
-                                      namespace="AWS/ElastiCache",
-                                      metric_name="DatabaseMemoryUsageCountedForEvictPercentage",
-                                      dimensions={
-                                          "ReplicationGroupId": "hcache",
-                                      },
-                                      period=core.Duration.minutes(5),
-                                      statistic="Average"
-                                  ),
-                                  evaluation_periods=1,
-                                  threshold=10,
-                                  comparison_operator=cw.ComparisonOperator.LESS_THAN_THRESHOLD
-                                  )
-
-        alarm_scale_down.add_alarm_action(cw_actions.SnsAction(self.capacity_topic))
+        self.capacity_topic = hcache_capacity.create_autoscale_sns(self)
 
     def create_redis(self):
         private_subnets_ids = [ps.subnet_id for ps in self.vpc.isolated_subnets]
         # Forcing these into the same subnet so we stay in the same AZ
-        redis_stack.py = [private_subnets_ids[0]]
+        private_subnets_ids = [private_subnets_ids[0]]
 
         # create a new security group
         sec_group = ec2.SecurityGroup(
@@ -134,7 +81,7 @@ class RedisStack(core.Stack):
         cache_subnet_group = CfnSubnetGroup(
             scope=self,
             id=f"redis_cache_subnet_group",
-            subnet_ids=private_subnets_ids,  # TODO: add list of subnet ids here
+            subnet_ids=private_subnets_ids,
             description="subnet group for redis",
         )
 
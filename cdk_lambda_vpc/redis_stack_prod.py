@@ -7,6 +7,13 @@ from aws_cdk import aws_sns as sns
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_ssm
 from aws_cdk import aws_autoscaling, aws_autoscalingplans, aws_applicationautoscaling, aws_cloudwatch
+from aws_cdk import aws_lambda as _lambda
+from aws_cdk import aws_sns_subscriptions as sns_subscriptions
+from aws_cdk import aws_events as events
+from aws_cdk import aws_events_targets as targets
+
+from cdk_lambda_vpc import hcache_capacity
+from cdk_lambda_vpc.topology import looked_up, subnets_in
 
 EC2_KEY_NAME = 'awspersonal'
 EC2_WHITELIST_IPS = [
@@ -17,16 +24,27 @@ EC2_WHITELIST_IPS = [
 
 class RedisStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, vpc_id='vpc-0981d256693b6ff86', az=None, client_cidrs=[],
+                 **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
-        self.vpc = ec2.Vpc.from_lookup(self, "VPC", vpc_id='vpc-0981d256693b6ff86')
+        self.vpc = ec2.Vpc.from_lookup(self, "VPC", vpc_id=vpc_id)
+
+        # With az set the primaries, and the subnets any new shard can use, are kept in that AZ (see topology.py)
+        self.az = az
+        self.client_cidrs = client_cidrs
 
         self.create_redis()
         self.create_mgmt_ec2()
+        self.create_autoscale_sns()
+        self.create_capacity_signals()
+        self.create_autoscaler()
 
-    def create_redis(self):
-        private_subnets_ids = [ps.subnet_id for ps in self.vpc.isolated_subnets]
+    def create_redis(self, num_node_groups=2):
+        subnets = self.vpc.isolated_subnets
+        if self.az and looked_up(self.vpc):
+            subnets = subnets_in(subnets, self.az, 'isolated')
+        private_subnets_ids = [ps.subnet_id for ps in subnets]
 
         # create a new security group
         sec_group = ec2.SecurityGroup(
@@ -42,6 +60,14 @@ class RedisStack(core.Stack):
             connection=ec2.Port.tcp(6379)
         )
 
+        # Clients in other VPCs, peered with this one
+        for cidr in self.client_cidrs:
+            sec_group.add_ingress_rule(
+                peer=ec2.Peer.ipv4(cidr),
+                description="Allow Redis inbound from peered VPC",
+                connection=ec2.Port.tcp(6379)
+            )
+
         cache_subnet_group = CfnSubnetGroup(
             scope=self,
             id=f"redis_cache_subnet_group",
@@ -59,7 +85,12 @@ class RedisStack(core.Stack):
             engine='redis',
             replicas_per_node_group=0,
             cache_node_type='cache.r5.large',
-            num_node_groups=2,
+            num_node_groups=num_node_groups,
+            node_group_configuration=[
+                CfnReplicationGroup.NodeGroupConfigurationProperty(
+                    node_group_id=f'{n + 1:04d}', primary_availability_zone=self.az
+                ) for n in range(num_node_groups)
+            ] if self.az else None,
             cache_subnet_group_name=cache_subnet_group.ref,
             security_group_ids=[sec_group.security_group_id],
             notification_topic_arn=self.maintenance_topic.topic_arn
@@ -88,7 +119,101 @@ class RedisStack(core.Stack):
         )
 
         # aws application-autoscaling register-scalable-target --service-namespace elasticache --resource-id replication-group/hcache --scalable-dimension elasticache:replication-group:NodeGroups --min-capacity 1 --max-capacity 20
+        # Resharding is done by the autoscaler lambda instead, see create_autoscaler
+
+    def create_autoscaler_lambda_role(self):
+        return hcache_capacity.create_autoscaler_lambda_role(self)
+
+    def create_autoscale_sns(self):
+        self.capacity_topic = hcache_capacity.create_autoscale_sns(self)
+
+    def hcache_metric(self, metric_name, statistic='Maximum'):
+        return cw.Metric(
+            namespace="AWS/ElastiCache",
+            metric_name=metric_name,
+            dimensions={
+                "ReplicationGroupId": "hcache",
+            },
+            period=core.Duration.minutes(1),
+            statistic=statistic
+        )
+
+    def create_capacity_signals(self, max_connections=5000, max_network_bytes_per_minute=4 * 1024 ** 3):
+        """
+        1 minute alarms on memory, engine CPU, connections and network, combined into one composite alarm that
+        prompts the autoscaler straight away instead of after a 5 minute average
+
+        """
+        def alarm(id, metric, threshold, datapoints=2, periods=3):
+            return cw.Alarm(self, id,
+                            alarm_name=id,
+                            metric=metric,
+                            threshold=threshold,
+                            evaluation_periods=periods,
+                            datapoints_to_alarm=datapoints,
+                            comparison_operator=cw.ComparisonOperator.GREATER_THAN_THRESHOLD,
+                            treat_missing_data=cw.TreatMissingData.NOT_BREACHING)
+
+        memory_high = alarm('hcache_memory_high_1m',
+                            self.hcache_metric("DatabaseMemoryUsageCountedForEvictPercentage"), 70)
+        cpu_high = alarm('hcache_engine_cpu_high_1m', self.hcache_metric("EngineCPUUtilization"), 80, datapoints=3)
+        connections_high = alarm('hcache_connections_high_1m', self.hcache_metric("CurrentConnections"),
+                                 max_connections, datapoints=3)
+        network_in_high = alarm('hcache_network_in_high_1m', self.hcache_metric("NetworkBytesIn", 'Sum'),
+                                max_network_bytes_per_minute, datapoints=3)
+        network_out_high = alarm('hcache_network_out_high_1m', self.hcache_metric("NetworkBytesOut", 'Sum'),
+                                 max_network_bytes_per_minute, datapoints=3)
+
+        # CPU alone is often a hot key rather than a capacity problem, so only count it alongside heavy traffic
+        capacity_pressure = cw.CompositeAlarm(
+            self, 'hcache_capacity_pressure',
+            composite_alarm_name='hcache_capacity_pressure',
+            alarm_rule=cw.AlarmRule.any_of(
+                memory_high,
+                connections_high,
+                cw.AlarmRule.all_of(cpu_high, cw.AlarmRule.any_of(network_in_high, network_out_high))
+            )
+        )
+        capacity_pressure.add_alarm_action(cw_actions.SnsAction(self.capacity_topic))
+
+    def create_autoscaler(self, min_shards=1, max_shards=15):
+        """
+        Reshard hcache online from the capacity alarms - see lambda/autoscaler.py for the policy
+
+        """
+        autoscaler = _lambda.Function(
+            self, 'hcache-autoscaler',
+            runtime=_lambda.Runtime.PYTHON_3_8,
+            code=_lambda.Code.from_asset('cdk_lambda_vpc/lambda', exclude=['__pycache__', '*.pyc', '.*']),
+            handler='autoscaler.handler',
+            role=self.create_autoscaler_lambda_role(),
+            environment={
+                'REPLICATION_GROUP_ID': self.redis.replication_group_id,
+                'MIN_SHARDS': str(min_shards),
+                'MAX_SHARDS': str(max_shards),
+                'SCALE_UP_THRESHOLD': '70',
+                'SCALE_DOWN_THRESHOLD': '10',
+                'TARGET': '50',
+                # Scale out when the last 10 minutes' trend reaches 70% within about one reshard
+                'FORECAST_WINDOW_SECONDS': '600',
+                'FORECAST_LEAD_SECONDS': '900',
+            },
+            # Only ever one decision in flight
+            reserved_concurrent_executions=1,
+            timeout=core.Duration.minutes(1)
+        )
+
+        self.capacity_topic.add_subscription(sns_subscriptions.LambdaSubscription(autoscaler))
+
+        # Alarms only notify on a state change, so re-check while a group stays in ALARM after scaling.
+        # Every minute, so the memory forecast gets a look at every new datapoint
+        events.Rule(
+            self, 'hcache-autoscaler-schedule',
+            schedule=events.Schedule.rate(core.Duration.minutes(1)),
+            targets=[targets.LambdaFunction(autoscaler)]
+        )
 
+        return autoscaler
 
     def create_mgmt_ec2(self):
         instance_name = "efs-mgmt-box"
@@ -121,6 +246,8 @@ class RedisStack(core.Stack):
             vpc=self.vpc,
             security_group=sec_group,
             key_name=EC2_KEY_NAME,
-            vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType('PUBLIC'))
+            vpc_subnets=ec2.SubnetSelection(
+                subnets=subnets_in(self.vpc.public_subnets, self.az, 'public')
+            ) if self.az and looked_up(self.vpc) else ec2.SubnetSelection(subnet_type=ec2.SubnetType('PUBLIC'))
         )
 
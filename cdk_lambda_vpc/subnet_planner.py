@@ -0,0 +1,168 @@
+"""
+CIDR planning for NAT egress subnets
+
+The VPC construct allocates its own subnet tiers first - one subnet per tier per AZ, in subnet_configuration
+order, packed from the start of the VPC CIDR. Egress subnets are packed after them, one per egress route, with
+route n in azs[n % len(azs)] so routes (and their NAT gateways) are spread evenly over every AZ.
+
+plan_egress_subnets() raises PlanError as soon as the VPC CIDR runs out or an AZ would need more NAT gateways than
+max_routes_per_az, and verify() checks the invariants of a finished plan - the stacks call both at synth time, so
+a bad plan never reaches CloudFormation.
+
+    plan = plan_egress_subnets('10.2.0.0/16', ['us-east-1a', 'us-east-1b'], n_routes=100)
+    for route in plan.routes:
+        route.n, route.cidr, route.az
+
+app.py runs property_check() on every synth, planning random VPC sizes, AZ counts and route counts. Run this module
+for a longer sweep.
+"""
+import random
+
+from netaddr import IPAddress, IPNetwork
+
+# (name, cidr mask) for each tier the VPC construct creates itself, as in CombinedStack's subnet_configuration
+DEFAULT_RESERVED_TIERS = (('public-subnet', 26), ('efs-subnet', 26))
+EGRESS_MASK = 26
+# Default AWS quota for NAT gateways per AZ
+NAT_GATEWAYS_PER_AZ = 5
+
+
+class PlanError(ValueError):
+    pass
+
+
+class PlannedSubnet:
+
+    def __init__(self, name, cidr, az, n=None):
+        self.name = name
+        self.cidr = cidr
+        self.az = az
+        self.n = n
+
+    def __repr__(self):
+        return f'PlannedSubnet({self.name!r}, {str(self.cidr)!r}, {self.az!r})'
+
+
+class SubnetPlan:
+
+    def __init__(self, vpc_cidr, azs, reserved, routes, max_routes_per_az=None):
+        self.vpc_cidr = vpc_cidr
+        self.azs = azs
+        self.reserved = reserved
+        self.routes = routes
+        self.max_routes_per_az = max_routes_per_az
+
+    def routes_in(self, az):
+        return [r for r in self.routes if r.az == az]
+
+    def free_addresses(self):
+        used = sum(s.cidr.size for s in self.reserved + self.routes)
+        return self.vpc_cidr.size - used
+
+
+class Allocator:
+    """
+    Hands out aligned blocks in address order from the start of the VPC CIDR
+    """
+
+    def __init__(self, vpc_cidr):
+        self.vpc_cidr = vpc_cidr
+        self.cursor = vpc_cidr.first
+
+    def next(self, mask):
+        if mask < self.vpc_cidr.prefixlen:
+            raise PlanError(f'/{mask} subnet is larger than the VPC {self.vpc_cidr}')
+        size = 2 ** (32 - mask)
+        start = -(-self.cursor // size) * size
+        if start + size - 1 > self.vpc_cidr.last:
+            raise PlanError(f'{self.vpc_cidr} is exhausted, no room for another /{mask}')
+        self.cursor = start + size
+        return IPNetwork(f'{IPAddress(start)}/{mask}')
+
+
+def plan_egress_subnets(vpc_cidr, azs, n_routes, reserved_tiers=DEFAULT_RESERVED_TIERS, egress_mask=EGRESS_MASK,
+                        max_routes_per_az=NAT_GATEWAYS_PER_AZ, reserved_azs=None):
+    """
+    reserved_azs are the AZs the VPC construct created its tiers in, when it differs from azs
+    """
+    vpc_cidr = IPNetwork(vpc_cidr)
+    azs = list(azs)
+    if not azs:
+        raise PlanError('Need at least one AZ')
+    if len(set(azs)) != len(azs):
+        raise PlanError(f'Duplicate AZs in {azs}')
+    if max_routes_per_az is not None and -(-n_routes // len(azs)) > max_routes_per_az:
+        raise PlanError(f'{n_routes} egress routes over {len(azs)} AZs needs more than {max_routes_per_az} NAT '
+                        f'gateways per AZ - add AZs or raise the quota and max_routes_per_az')
+
+    allocator = Allocator(vpc_cidr)
+    reserved = []
+    for name, mask in reserved_tiers:
+        for az in (reserved_azs or azs):
+            reserved.append(PlannedSubnet(name, allocator.next(mask), az))
+
+    routes = []
+    for n in range(n_routes):
+        routes.append(PlannedSubnet(f'lambda_vpc_private_{n}', allocator.next(egress_mask), azs[n % len(azs)], n))
+
+    plan = SubnetPlan(vpc_cidr, azs, reserved, routes, max_routes_per_az)
+    verify(plan)
+    return plan
+
+
+def verify(plan):
+    """
+    Raise PlanError unless every subnet is inside the VPC, no two subnets overlap, routes are numbered 0..n-1,
+    and routes are balanced over the AZs (no AZ has more than one more route than another)
+    """
+    subnets = sorted(plan.reserved + plan.routes, key=lambda s: s.cidr.first)
+    for subnet in subnets:
+        if subnet.cidr not in plan.vpc_cidr:
+            raise PlanError(f'{subnet} is outside the VPC {plan.vpc_cidr}')
+    for a, b in zip(subnets, subnets[1:]):
+        if a.cidr.last >= b.cidr.first:
+            raise PlanError(f'{a} overlaps {b}')
+
+    if [r.n for r in plan.routes] != list(range(len(plan.routes))):
+        raise PlanError('Egress routes are not numbered 0..n-1')
+
+    counts = [len(plan.routes_in(az)) for az in plan.azs]
+    if sum(counts) != len(plan.routes):
+        raise PlanError('Egress routes placed outside the planned AZs')
+    if max(counts) - min(counts) > 1:
+        raise PlanError(f'Egress routes unbalanced over AZs: {dict(zip(plan.azs, counts))}')
+    if plan.max_routes_per_az is not None and max(counts) > plan.max_routes_per_az:
+        raise PlanError(f'More than {plan.max_routes_per_az} egress routes in one AZ')
+
+
+def property_check(cases=500, seed=0):
+    """
+    Plan random VPCs, AZ counts and route counts: every plan must verify, and any PlanError must be a genuine
+    exhaustion (the routes really don't fit in the addresses left after the reserved tiers)
+    """
+    rng = random.Random(seed)
+    planned = exhausted = 0
+    for _ in range(cases):
+        prefix = rng.randint(16, 24)
+        vpc_cidr = f'10.{rng.randint(0, 255)}.0.0/{prefix}'
+        azs = [f'us-east-1{c}' for c in 'abcdef'[:rng.randint(1, 6)]]
+        egress_mask = rng.randint(max(prefix + 1, 24), 28)
+        n_routes = rng.randint(0, 300)
+        try:
+            plan = plan_egress_subnets(vpc_cidr, azs, n_routes, egress_mask=egress_mask, max_routes_per_az=None)
+        except PlanError:
+            reserved = len(DEFAULT_RESERVED_TIERS) * len(azs) * 2 ** (32 - 26)
+            if reserved + n_routes * 2 ** (32 - egress_mask) <= IPNetwork(vpc_cidr).size:
+                raise
+            exhausted += 1
+            continue
+        assert len(plan.routes) == n_routes
+        planned += 1
+    return {'planned': planned, 'exhausted': exhausted}
+
+
+if __name__ == '__main__':
+    print(property_check(cases=5000))
+    plan = plan_egress_subnets('10.2.0.0/16', ['us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d',
+                                               'us-east-1e', 'us-east-1f'], 120, max_routes_per_az=20)
+    print(len(plan.routes), 'routes, last', plan.routes[-1], 'free addresses', plan.free_addresses())
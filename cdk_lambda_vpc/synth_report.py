@@ -0,0 +1,41 @@
+"""
+Resources per synthesized template, nested stacks included
+
+CloudFormation rejects a template with more than 500 resources, and big templates are slow to deploy and roll
+back. app.py prints this after every synth (to stderr, the CLI owns stdout) so growth is visible long before the
+limit:
+
+    template                                                resources  headroom
+    combined-vpc.template.json                                     62       438
+    combinedvpcegressroutes0A1B2C3D4.nested.template.json         300       200
+    combinedvpcegressroutes1E5F6A7B8.nested.template.json         420        80  !
+"""
+import json
+import os
+import sys
+
+MAX_RESOURCES = 500
+# Flag templates with less headroom than this
+WARN_FRACTION = 0.8
+
+
+def template_resources(directory):
+    """
+    {template file name: resource count} for every template in a cloud assembly directory
+    """
+    counts = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.template.json'):
+            with open(os.path.join(directory, name)) as f:
+                counts[name] = len(json.load(f).get('Resources', {}))
+    return counts
+
+
+def report(assembly, out=sys.stderr):
+    counts = template_resources(assembly.directory)
+    width = max([len(name) for name in counts] + [len('template')])
+    print(f'{"template":<{width}}  resources  headroom', file=out)
+    for name, count in counts.items():
+        flag = '  !' if count > MAX_RESOURCES * WARN_FRACTION else ''
+        print(f'{name:<{width}}  {count:>9}  {MAX_RESOURCES - count:>8}{flag}', file=out)
+    return counts
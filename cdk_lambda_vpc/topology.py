@@ -0,0 +1,80 @@
+"""
+AZ affinity between hcache, its ingestion box and the egress workers
+
+Every cross-AZ hop adds latency to a Redis round trip that is otherwise well under a millisecond, and is billed per
+GB both ways. With config.HCACHE_AZ set the stacks keep the hot path in that AZ:
+
+    - RedisStack: the subnet group only has the AZ's isolated subnets (so shards added by the autoscaler land there
+      too), every primary prefers the AZ, and the ingestion box goes in the AZ's public subnet
+    - CombinedStack: every egress route - subnet and NAT gateway - is planned in the AZ
+    - LambdaStack: every egress worker must be in the AZ, and combined-vpc is peered with the hcache VPC when they
+      are different VPCs, routed both ways (the peering is also made, to all of hcache's isolated subnets, whenever
+      the tiering or eviction worker runs without HCACHE_AZ)
+
+All of it is checked at synth time and fails with TopologyError, rather than deploying something that quietly
+crosses AZs. While a Vpc.from_lookup isn't in cdk.context.json yet the checks on it are skipped: that pass gets a
+dummy VPC, and the CLI looks the VPC up and synths again.
+"""
+from aws_cdk import core
+import aws_cdk.aws_ec2 as ec2
+from netaddr import IPNetwork
+
+
+# The VPC id Vpc.from_lookup returns before the lookup is resolved
+DUMMY_VPC_ID = 'vpc-12345'
+
+
+class TopologyError(ValueError):
+    pass
+
+
+def looked_up(vpc):
+    """
+    False while vpc is the dummy Vpc.from_lookup returns until cdk.context.json has the lookup
+    """
+    return vpc.vpc_id != DUMMY_VPC_ID
+
+
+def subnets_in(subnets, az, what):
+    """
+    The subnets in az, at least one of them
+    """
+    found = [s for s in subnets if s.availability_zone == az]
+    if not found:
+        azs = sorted({s.availability_zone for s in subnets})
+        raise TopologyError(f'No {what} subnet in {az}, there are {what} subnets in: {", ".join(azs) or "none"}')
+    return found
+
+
+def check_in_az(subnets, az, what):
+    outside = [f'{s.subnet_id} ({s.availability_zone})' for s in subnets if s.availability_zone != az]
+    if outside:
+        raise TopologyError(f'{what} subnets outside {az}: {", ".join(outside)}')
+
+
+class VpcPeering(core.Construct):
+    """
+    Peer vpc with peer_vpc (same account and region) and route each side's subnets to the other VPC's CIDR
+    """
+
+    def __init__(self, scope: core.Construct, id: str, vpc, peer_vpc, subnets, peer_subnets) -> None:
+        super().__init__(scope, id)
+
+        # Two CIDR blocks overlap when one contains the other
+        cidr, peer_cidr = IPNetwork(vpc.vpc_cidr_block), IPNetwork(peer_vpc.vpc_cidr_block)
+        if cidr in peer_cidr or peer_cidr in cidr:
+            raise TopologyError(f'Can\'t peer {vpc.vpc_id} ({vpc.vpc_cidr_block}) with {peer_vpc.vpc_id} '
+                                f'({peer_vpc.vpc_cidr_block}), their CIDRs overlap')
+
+        self.peering = ec2.CfnVPCPeeringConnection(self, 'peering', vpc_id=vpc.vpc_id, peer_vpc_id=peer_vpc.vpc_id)
+
+        self.add_routes('route', subnets, peer_vpc.vpc_cidr_block)
+        self.add_routes('peer-route', peer_subnets, vpc.vpc_cidr_block)
+
+    def add_routes(self, id, subnets, destination_cidr_block):
+        # Subnets can share a route table, each table gets one route
+        route_table_ids = sorted({s.route_table.route_table_id for s in subnets})
+        for n, route_table_id in enumerate(route_table_ids):
+            ec2.CfnRoute(self, f'{id}-{n}', route_table_id=route_table_id,
+                         destination_cidr_block=destination_cidr_block,
+                         vpc_peering_connection_id=self.peering.ref)
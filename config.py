@@ -1,5 +1,7 @@
 from aws_cdk import core
 
+from cdk_lambda_vpc import efs_profile
+
 
 env_dev = core.Environment(account="972734064061", region="us-east-1")
 #env_prod = core.Environment(...
@@ -17,3 +19,33 @@ PREALLOCATED_EIP_LIST = [
             'eipalloc-057f9076151e73657'
         ]
 N_SUBNETS = 5
+# Keep the hcache primaries, its ingestion box and the egress routes / workers in this AZ, peering combined-vpc with
+# the hcache VPC (see cdk_lambda_vpc/topology.py). None leaves placement as it is.
+# Setting it on a deployed fleet is not an in-place update: the egress subnets (and their NAT gateways) move to this
+# AZ with the same CIDRs, and CloudFormation creates each replacement before deleting the old subnet, so the CIDRs
+# conflict and the update fails. Set it before the first deploy, or take the egress routes down and deploy them again
+HCACHE_AZ = None
+HCACHE_VPC_ID = 'vpc-0981d256693b6ff86'
+
+# Fraction of the egress workers' outbound requests timed per phase (DNS/connect/TLS/TTFB) and logged as EMF, 0 is off
+REQUEST_METRICS_SAMPLE_RATE = 0
+
+# Copy trades about to expire out of hcache onto the EFS share this often (lambda/hcache/tiering.py), None is off.
+# The share is combined-vpc's, /mnt/efs/tiering beside the egress cache, not EFSStack's high-performance-storage: a
+# Lambda can only mount an EFS its VPC reaches, and efs-vpc can't be peered with combined-vpc (same CIDR). Include
+# the tiering writes and the segments' size in EFS_WORKLOAD. At most half of evict_trades_after_minutes (15 with the
+# default 30), the horizon is capped there
+HCACHE_TIERING_INTERVAL_MINUTES = None
+
+# Enforce /hcache/evict_trades_after_minutes and /hcache/evict_orderbooks_after_minutes on what is already in hcache
+# this often (lambda/hcache/eviction.py), None is off
+HCACHE_EVICTION_INTERVAL_MINUTES = None
+
+# What the combined-vpc EFS share is used for, its performance / throughput modes are chosen from it (see
+# cdk_lambda_vpc/efs_profile.py), e.g. for the egress workers' cache:
+#   efs_profile.Workload(size_gib=20, sustained_mibps=5, peak_mibps=200, clients=200)
+# None keeps General Purpose / bursting. Throughput mode changes in place, but the performance mode can't: a workload
+# that moves the deployed share between General Purpose and Max I/O replaces the file system, and as it is created
+# with RemovalPolicy.DESTROY that deletes the egress cache and the tiered segments on it. Check the chosen
+# performance_mode (efs_profile.choose(workload).as_dict()) against the deployed one before deploying
+EFS_WORKLOAD = None